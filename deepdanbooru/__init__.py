@@ -1,8 +1,13 @@
-import deepdanbooru.commands
-import deepdanbooru.data
-import deepdanbooru.extra
-import deepdanbooru.image
-import deepdanbooru.io
-import deepdanbooru.model
-import deepdanbooru.project
-import deepdanbooru.train
+import importlib
+
+SUBMODULE_NAMES = ['commands', 'data', 'extra', 'image', 'io', 'metrics', 'model', 'project', 'server', 'train']
+
+
+def __getattr__(name):
+    """
+    Import submodules on first access, so that each command only pays for the modules it uses.
+    """
+    if name in SUBMODULE_NAMES:
+        return importlib.import_module(f'.{name}', __name__)
+
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
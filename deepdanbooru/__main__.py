@@ -1,4 +1,5 @@
 import sys
+import time
 
 import click
 
@@ -43,8 +44,14 @@ def derpi_import_tags(path, limit, minimum_post_count, overwrite, postgres_uri):
 @main.command('download-images')
 @click.argument('project_path', type=click.Path(exists=True, resolve_path=True, file_okay=False, dir_okay=True))
 @click.option('--overwrite', help='Overwrite images if they exist.', is_flag=True)
-def download_images(project_path, overwrite):
-    dd.commands.download_images(project_path, overwrite)
+@click.option('--concurrency', default=16, help='Maximum number of images downloaded at the same time.')
+@click.option('--rate-limit', default=10.0, help='Maximum number of requests per second. It is lowered automatically when server responds 429. 0 means unlimited.')
+@click.option('--timeout', default=60.0, help='Timeout in seconds for downloading an image.')
+@click.option('--max-retries', default=8, help='Maximum number of retries of an image which is rate limited.')
+@click.option('--max-size', type=int, help='Resize images to fit in this size (px) keeping aspect ratio before saving. Default is download_max_size of the project. 0 saves original images.')
+@click.option('--resize-workers', type=int, help='Number of processes resizing images. Default is number of CPUs.')
+def download_images(project_path, overwrite, concurrency, rate_limit, timeout, max_retries, max_size, resize_workers):
+    dd.commands.download_images(project_path, overwrite, concurrency, rate_limit, timeout, max_retries, max_size, resize_workers)
 
 
 @main.command('make-training-database')
@@ -54,12 +61,24 @@ def download_images(project_path, overwrite):
 @click.option('--start-id', default=0, help='Start id.', )
 @click.option('--end-id', default=sys.maxsize, help='End id.')
 @click.option('--use-deleted', help='Use deleted posts.', is_flag=True)
-@click.option('--chunk-size', default=5000000, help='Chunk size for internal processing.')
+@click.option('--chunk-size', default=10000, help='Number of rows fetched from source and inserted at once.')
+@click.option('--workers', 'worker_count', default=1, help='Number of processes copying id range partitions in parallel.')
 @click.option('--overwrite', help='Overwrite view if exists.', is_flag=True)
+@click.option('--resume', help='Continue interrupted build of existing database from its last committed ids. Use the same source and id options as the interrupted build.', is_flag=True)
 @click.option('--vacuum', help='Execute VACUUM command after configuring database.', is_flag=True)
-def make_training_database(source_format, source_uri, output_path, start_id, end_id, use_deleted, chunk_size, overwrite, vacuum):
+def make_training_database(source_format, source_uri, output_path, start_id, end_id, use_deleted, chunk_size, worker_count, overwrite, resume, vacuum):
     dd.commands.make_training_database(source_format, source_uri, output_path, start_id, end_id,
-                                       use_deleted, chunk_size, overwrite, vacuum)
+                                       use_deleted, chunk_size, worker_count, overwrite, resume, vacuum)
+
+
+@main.command('make-training-shards', help='Write pre-resized images and encoded labels of the project as TFRecord shards for training.')
+@click.argument('project_path', type=click.Path(exists=True, resolve_path=True, file_okay=False, dir_okay=True))
+@click.option('--output-path', type=click.Path(resolve_path=True, file_okay=False, dir_okay=True), help='Output folder. Default is shards_path of the project, or "shards" folder in the project.')
+@click.option('--shard-size', default=4096, help='Number of records in each shard.')
+@click.option('--image-format', type=click.Choice(['raw', 'png'], case_sensitive=False), default='raw', help='raw is fastest to read, png is smaller.')
+@click.option('--overwrite', help='Overwrite shards if exists.', is_flag=True)
+def make_training_shards(project_path, output_path, shard_size, image_format, overwrite):
+    dd.commands.make_training_shards(project_path, output_path, shard_size, image_format, overwrite)
 
 
 @main.command('train-project')
@@ -85,6 +104,25 @@ def grad_cam(project_path, target_path, output_path, threshold):
     dd.commands.grad_cam(project_path, target_path, output_path, threshold)
 
 
+@main.command('export-model', help='Export int8 quantized TensorFlow Lite model for CPU serving, and report score drift against float model.')
+@click.option('--project-path', type=click.Path(exists=True, resolve_path=True, file_okay=False, dir_okay=True),
+              help='Project path. Calibration images are sampled from image records of the project.')
+@click.option('--model-path', type=click.Path(exists=True, resolve_path=True, file_okay=True, dir_okay=False))
+@click.option('--tags-path', type=click.Path(exists=True, resolve_path=True, file_okay=True, dir_okay=False))
+@click.option('--output-path', type=click.Path(resolve_path=True, file_okay=True, dir_okay=False), help='Output .tflite file. Default is model path with .tflite extension.')
+@click.option('--calibration-path', type=click.Path(exists=True, resolve_path=True, file_okay=False, dir_okay=True),
+              help='Folder of calibration images. Use this when project has no image records.')
+@click.option('--calibration-count', default=200, help='Number of images for calibration.')
+@click.option('--report-count', default=100, help='Number of images, other than calibration images, for drift report.')
+@click.option('--threshold', default=0.5, help='Threshold for counting flipped tags in drift report.')
+@click.option('--random-seed', default=0)
+@click.option('--overwrite', help='Overwrite output file if exists.', is_flag=True)
+@click.option('--verbose', default=False, is_flag=True)
+def export_model(project_path, model_path, tags_path, output_path, calibration_path, calibration_count, report_count, threshold, random_seed, overwrite, verbose):
+    dd.commands.export_model(project_path, model_path, tags_path, output_path, calibration_path, calibration_count, report_count,
+                             threshold, random_seed, overwrite, verbose)
+
+
 @main.command('evaluate', help='Evaluate model by estimating image tag.')
 @click.argument('target_paths', nargs=-1, type=click.Path(exists=True, resolve_path=True, file_okay=True, dir_okay=True))
 @click.option('--project-path', type=click.Path(exists=True, resolve_path=True, file_okay=False, dir_okay=True),
@@ -92,13 +130,26 @@ def grad_cam(project_path, target_path, output_path, threshold):
 @click.option('--model-path', type=click.Path(exists=True, resolve_path=True, file_okay=True, dir_okay=False))
 @click.option('--tags-path', type=click.Path(exists=True, resolve_path=True, file_okay=True, dir_okay=False))
 @click.option('--threshold', default=0.5)
+@click.option('--top-k', type=int, default=None, help='Only report this many highest scoring tags per image.')
 @click.option('--allow-gpu', default=False, is_flag=True)
 @click.option('--compile/--no-compile', 'compile_model', default=False)
+@click.option('--precision', type=click.Choice(['float32', 'mixed_float16', 'mixed_bfloat16']), help='Compute precision of model. Default is precision of project, or float32 if --model-path is used. Not allowed for .tflite model.')
 @click.option('--allow-folder', default=False, is_flag=True, help='If this option is enabled, TARGET_PATHS can be folder path and all images (using --folder-filters) in that folder is estimated recursively. If there are file and folder which has same name, the file is skipped and only folder is used.')
 @click.option('--folder-filters', default='*.[Pp][Nn][Gg],*.[Jj][Pp][Gg],*.[Jj][Pp][Ee][Gg],*.[Gg][Ii][Ff]', help='Glob pattern for searching image files in folder. You can specify multiple patterns by separating comma. This is used when --allow-folder is enabled. Default:*.[Pp][Nn][Gg],*.[Jj][Pp][Gg],*.[Jj][Pp][Ee][Gg],*.[Gg][Ii][Ff]')
+@click.option('--batch-size', default=1, help='Number of images evaluated together in one forward pass.')
+@click.option('--workers', 'worker_count', default=4, help='Number of threads for reading, decoding and resizing images ahead of the model.')
+@click.option('--cache-path', type=click.Path(resolve_path=True, file_okay=True, dir_okay=False), help='SQLite file for caching model outputs by image contents. Disabled if not specified.')
+@click.option('--cache-size', default=100000, help='Maximum number of cached images. Least recently used entries are evicted.')
 @click.option('--verbose', default=False, is_flag=True)
-def evaluate(target_paths, project_path, model_path, tags_path, threshold, allow_gpu, compile_model, allow_folder, folder_filters, verbose):
-    dd.commands.evaluate(target_paths, project_path, model_path, tags_path, threshold, allow_gpu, compile_model, allow_folder, folder_filters, verbose)
+def evaluate(target_paths, project_path, model_path, tags_path, threshold, top_k, allow_gpu, compile_model, precision, allow_folder, folder_filters, batch_size, worker_count, cache_path, cache_size, verbose):
+    started = time.time()
+    evaluate_command = dd.commands.evaluate
+
+    if verbose:
+        print(f'Imported modules in {time.time() - started:.2f} s')
+
+    evaluate_command(target_paths, project_path, model_path, tags_path, threshold, top_k, allow_gpu, compile_model, allow_folder, folder_filters,
+                     batch_size, worker_count, cache_path, cache_size, precision, verbose)
 
 
 @main.command('serve', help='Serve model by estimating image tag.')
@@ -110,9 +161,47 @@ def evaluate(target_paths, project_path, model_path, tags_path, threshold, allow
 @click.option('--default-threshold', default=0.5)
 @click.option('--allow-gpu', default=False, is_flag=True)
 @click.option('--compile/--no-compile', 'compile_model', default=False)
+@click.option('--precision', type=click.Choice(['float32', 'mixed_float16', 'mixed_bfloat16']), help='Compute precision of model. Default is precision of project, or float32 if --model-path is used. Not allowed for .tflite model.')
+@click.option('--max-batch-size', default=8, help='Maximum number of images evaluated together in one forward pass.')
+@click.option('--max-batch-wait-ms', default=5.0, help='Maximum time in milliseconds to wait for more images before running a batch.')
+@click.option('--decode-workers', default=4, help='Number of threads for decoding and resizing images.')
+@click.option('--fetch-connections', default=64, help='Maximum number of pooled connections for fetching images by url.')
+@click.option('--fetch-timeout', default=10.0, help='Timeout in seconds for fetching an image by url.')
+@click.option('--max-concurrent-fetches', default=32, help='Maximum number of images fetched by url at the same time. 0 means unlimited.')
+@click.option('--max-image-bytes', default=20 * 1024 * 1024, help='Maximum size in bytes of an image fetched by url. 0 means unlimited.')
+@click.option('--max-pending-images', default=256, help='Maximum number of images being evaluated by each worker. Requests over it are rejected with 429. 0 means unlimited.')
+@click.option('--request-timeout', default=30.0, help='Seconds after which queued images of a request are dropped before reaching the model. 0 means no timeout.')
+@click.option('--cache-path', type=click.Path(resolve_path=True, file_okay=True, dir_okay=False), help='SQLite file for caching model outputs by image contents. Disabled if not specified.')
+@click.option('--cache-size', default=100000, help='Maximum number of cached images. Least recently used entries are evicted.')
+@click.option('--models-config', 'models_config_path', type=click.Path(exists=True, resolve_path=True, file_okay=True, dir_okay=False),
+              help='JSON file of models to serve, like {"name": {"project_path": ...} or {"model_path": ..., "tags_path": ..., "categories_path": ...}}. Select model by "model" query argument.')
+@click.option('--reload-interval', default=0.0, help='Interval in seconds for checking model files. Changed models are reloaded in background. Disabled if 0.')
+@click.option('--workers', 'worker_count', default=1,
+              help='Number of worker processes sharing the port. Each worker loads its own copy of models, so all models must be .tflite models exported by export-model. /metrics reports the worker which answers the scrape. Use --reload-interval for reloading models of all workers.')
+@click.option('--max-restarts', default=100, help='Maximum number of restarts of crashed workers.')
+@click.option('--allow-model-admin', default=False, is_flag=True,
+              help='Allow reloading configured models by POST /models/<name>. Model files are only read from server options and --models-config file. Not supported with --workers, which reload by --reload-interval. Do not expose it to untrusted clients.')
 @click.option('--verbose', default=False, is_flag=True)
-def serve(port, project_path, model_path, tags_path, default_threshold, allow_gpu, compile_model, verbose):
-    dd.commands.serve_model(port, project_path, model_path, tags_path, default_threshold, allow_gpu, compile_model, verbose)
+def serve(port, project_path, model_path, tags_path, default_threshold, allow_gpu, compile_model, precision, max_batch_size, max_batch_wait_ms, decode_workers, fetch_connections,
+          fetch_timeout, max_concurrent_fetches, max_image_bytes, max_pending_images, request_timeout, cache_path, cache_size, models_config_path, reload_interval, worker_count, max_restarts,
+          allow_model_admin, verbose):
+    started = time.time()
+    sockets = None
+
+    if worker_count > 1:
+        # fork before serve_model imports TensorFlow
+        model_configs = dd.server.load_model_configs(project_path, model_path, tags_path, precision, models_config_path)
+        sockets = dd.server.start_workers(port, model_configs, worker_count, max_restarts, verbose)
+
+    serve_model = dd.commands.serve_model
+
+    if verbose:
+        print(f'Imported modules in {time.time() - started:.2f} s')
+
+    serve_model(port, project_path, model_path, tags_path, default_threshold, allow_gpu, compile_model, max_batch_size, max_batch_wait_ms,
+                decode_workers, fetch_connections, fetch_timeout, max_concurrent_fetches, max_image_bytes,
+                max_pending_images, request_timeout, cache_path, cache_size, precision, models_config_path, reload_interval,
+                worker_count, allow_model_admin, verbose, sockets)
 
 
 if __name__ == '__main__':
@@ -1,9 +1,42 @@
-from .create_project import create_project
-from .download_tags import download_tags, derpi_import_tags
-from .download_images import download_images
-from .make_training_database import make_training_database
-from .train_project import train_project
-from .evaluate_project import evaluate_project
-from .grad_cam import grad_cam
-from .evaluate import evaluate, evaluate_image
-from .serve import serve_model
+import importlib
+import sys
+import types
+
+# command name -> module name. Modules are imported on first access, because most of them import
+# TensorFlow or database drivers which are not needed by other commands.
+COMMAND_MODULE_NAMES = {
+    'create_project': 'create_project',
+    'download_tags': 'download_tags',
+    'derpi_import_tags': 'download_tags',
+    'download_images': 'download_images',
+    'make_training_database': 'make_training_database',
+    'make_training_shards': 'make_training_shards',
+    'train_project': 'train_project',
+    'evaluate_project': 'evaluate_project',
+    'grad_cam': 'grad_cam',
+    'evaluate': 'evaluate',
+    'evaluate_image': 'evaluate',
+    'serve_model': 'serve',
+    'export_model': 'export_model',
+}
+
+
+class CommandsModule(types.ModuleType):
+    """
+    Resolve command names on every access. A submodule, once imported, is bound to its name in this
+    package and would shadow the command of same name, so module __getattr__ is not enough.
+    """
+
+    def __getattribute__(self, name):
+        module_name = COMMAND_MODULE_NAMES.get(name)
+
+        if module_name is None:
+            return super().__getattribute__(name)
+
+        return getattr(importlib.import_module(f'.{module_name}', __name__), name)
+
+    def __dir__(self):
+        return sorted(set(super().__dir__()) | set(COMMAND_MODULE_NAMES))
+
+
+sys.modules[__name__].__class__ = CommandsModule
@@ -1,203 +1,488 @@
-import glob
-import json
+import asyncio
+import email.utils
+import hashlib
+import io
 import logging
 import os
-import random
-import requests
-import shutil
 import sys
-import threading
 import time
-import traceback
-
 from concurrent.futures import ProcessPoolExecutor
-from pathlib import Path
 
-import requests
+import aiohttp
 import sqlite3
+from PIL import Image
 
 import deepdanbooru as dd
 
 
-threadSessionHolder = threading.local()
+class ImageFetchFailed(Exception):
+    def __init__(self, message, http_status=None):
+        super().__init__(message)
+        self.http_status = http_status
+
+
+class DownloadManifest:
+    """
+    Download state of posts (status, size, sha256, HTTP status and error), stored in downloads table
+    of the project database. Results are written in batches, and resuming selects unfinished posts
+    by one query joined on the primary key.
+    """
+    table = 'downloads'
+
+    def __init__(self, connection, flush_size=1000):
+        self.connection = connection
+        self.flush_size = flush_size
+        self.results = []
+
+        self.connection.execute(f"""CREATE TABLE IF NOT EXISTS {self.table} (
+            post_id INTEGER NOT NULL PRIMARY KEY,
+            status TEXT NOT NULL,
+            size INTEGER,
+            sha256 TEXT,
+            http_status INTEGER,
+            error TEXT,
+            attempt_count INTEGER NOT NULL DEFAULT 1,
+            updated_at REAL NOT NULL,
+            width INTEGER,
+            height INTEGER )""")
+
+        # table made by older version
+        column_names = [row[1] for row in self.connection.execute(f'PRAGMA table_info({self.table})')]
+        for column_name in ['width', 'height']:
+            if column_name not in column_names:
+                self.connection.execute(f'ALTER TABLE {self.table} ADD COLUMN {column_name} INTEGER')
+
+        self.connection.commit()
+
+    def get_pending_posts(self, is_overwrite):
+        """
+        Cursor of (post id, foldername, filename, extension, download_url) of posts to download.
+        Completed posts are skipped unless is_overwrite.
+        """
+        return self.connection.execute(
+            f"""SELECT p.id, p.foldername, p.filename, p.extension, p.download_url FROM posts p
+            LEFT JOIN {self.table} d ON d.post_id = p.id
+            WHERE p.extension IN ('png', 'jpg', 'jpeg') AND (? OR d.status IS NULL OR d.status != 'complete')
+            ORDER BY p.id""",
+            (bool(is_overwrite),))
+
+    def record(self, post_id, status, size=None, sha256=None, http_status=None, error=None, width=None, height=None):
+        self.results.append((post_id, status, size, sha256, http_status, error, time.time(), width, height))
+
+        if len(self.results) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if not self.results:
+            return
+
+        with self.connection:
+            self.connection.executemany(
+                f"""INSERT INTO {self.table} (post_id, status, size, sha256, http_status, error, updated_at, width, height)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (post_id) DO UPDATE SET
+                status = excluded.status, size = excluded.size, sha256 = excluded.sha256,
+                http_status = excluded.http_status, error = excluded.error,
+                attempt_count = attempt_count + 1, updated_at = excluded.updated_at,
+                width = excluded.width, height = excluded.height""",
+                self.results)
+
+        self.results = []
+
+    def get_status_counts(self):
+        return dict(self.connection.execute(f'SELECT status, count(*) FROM {self.table} GROUP BY status').fetchall())
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all downloads. Tokens are added at rate per second up to burst, and each request takes one.
+    When server responds 429, rate is halved and all requests wait until Retry-After, then rate is recovered
+    gradually by successful requests (AIMD). rate 0 means unlimited, but 429 still pauses requests.
+    """
+
+    def __init__(self, rate, burst=None, min_rate=0.1):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(rate, 1.0)
+        self.min_rate = min(min_rate, rate) if rate > 0 else min_rate
+        self.tokens = self.burst
+        self.updated_at = None
+        self.blocked_until = 0.0
+
+    async def acquire(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            now = loop.time()
+
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
 
+            if self.rate <= 0:
+                return
 
-class ImageFetchFailed(Exception):
-    pass
+            if self.updated_at is not None:
+                self.tokens = min(self.tokens + (now - self.updated_at) * self.rate, self.burst)
+            self.updated_at = now
+
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return
+
+            await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+    def on_rate_limited(self, retry_after=None):
+        now = asyncio.get_event_loop().time()
+
+        if self.max_rate > 0:
+            self.rate = max(self.rate / 2.0, self.min_rate)
+            self.tokens = 0.0
+
+        self.blocked_until = max(self.blocked_until, now + (retry_after if retry_after is not None else 1.0))
+        logging.info(f'Rate limited, waiting {self.blocked_until - now:.1f} s (rate {self.rate:.2f}/s)')
 
+    def on_success(self):
+        if self.max_rate > 0 and self.rate < self.max_rate:
+            self.rate = min(self.rate + self.max_rate * 0.01, self.max_rate)
 
 
-def download_images(project_path, is_overwrite):
+class ImageResizer:
+    """
+    Decode, resize to fit in max_size x max_size keeping aspect ratio and re-encode downloaded images
+    on worker processes, so the event loop keeps downloading meanwhile. Images are passed as whole bytes,
+    so memory use grows with --concurrency times size of original images.
+    """
+
+    def __init__(self, max_size, worker_count=None):
+        self.max_size = max_size
+        self.executor = ProcessPoolExecutor(max_workers=worker_count)
+
+    async def save(self, data, path):
+        """
+        Save resized image of data to path and return (size, sha256, width, height) of the file.
+        """
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, resize_and_save_image, data, path, self.max_size)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def download_images(project_path, is_overwrite, concurrency=16, rate_limit=10.0, timeout=60.0, max_retries=8,
+                    max_size=None, resize_workers=None):
+    """
+    Download images of posts in the project database. Images are streamed to files by concurrent requests
+    of one pooled HTTP client, so a slow image does not hold back the others.
+    If max_size (or download_max_size of the project) is given, images larger than it are resized before saving.
+    """
     project_context_path = os.path.join(project_path, 'project.json')
     project_context = dd.io.deserialize_from_json(project_context_path)
     if project_context['source'] not in ['derpibooru']:
         raise Exception('download-images is only available on derpibooru projects')
-    
+
     sqlite_path = project_context['database_path']
     image_folder_path = os.path.join(os.path.dirname(sqlite_path), 'images')
 
+    if max_size is None:
+        max_size = project_context.get('download_max_size')
+
+    if max_size:
+        load_size = max(project_context['image_width'], project_context['image_height']) * max(project_context['scale_range'] or [1.0])
+        if max_size < load_size:
+            print(f'Warning: max size {max_size} is smaller than {int(load_size)}, which training loads images at.')
+        print(f'Images are resized to fit in {max_size}x{max_size}.')
+
     print(
         f'Start downloading images from URLs listed in {sqlite_path} to {image_folder_path}')
 
     dd.io.try_create_directory(image_folder_path)
 
     connection = sqlite3.connect(sqlite_path)
-    connection.row_factory = sqlite3.Row
-    cursor = connection.cursor()
+    manifest = DownloadManifest(connection)
+    # results are written to rows which are already read, so the cursor is not disturbed
+    cursor = manifest.get_pending_posts(is_overwrite)
+
+    def get_images():
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
 
-    cursor.execute("SELECT foldername, filename, extension, download_url FROM posts WHERE (extension = 'png' OR extension = 'jpg' OR extension = 'jpeg') ORDER BY id")
+            for post_id, foldername, filename, extension, download_url in rows:
+                yield (post_id, download_url, os.path.join(image_folder_path, foldername, f'{filename}.{extension}'))
 
     setup_logging()
 
-    processed_images = 0
-    succeeded_images = 0
+    counts = {'processed': 0, 'succeeded': 0}
+    resizer = ImageResizer(max_size, resize_workers) if max_size else None
+
     try:
-        while True:
-            batch = cursor.fetchmany(1000)
-            if not batch:
-                break
-            batch_data = []
-            for row in batch:
-                foldername = row['foldername']
-                filename = row['filename']
-                extension = row['extension']
-                image_path = os.path.join(
-                    image_folder_path, foldername, f'{filename}.{extension}')
-                download_url = row['download_url']
-                batch_data.append((download_url, image_path, is_overwrite))
-
-            results = list(fetch_images_parallel(batch_data))
-            succeeded = len(batch_data) - results.count(None)
-
-            processed_images += len(batch_data)
-            succeeded_images += succeeded
-
-            logging.info(f"BATCH: attempted to fetch {len(batch_data)} images, {succeeded} succeeded")
-
-            if free_space_left(image_folder_path) < 10_000*1024*1024:
-                logging.warn(f"only {free_space_left(image_folder_path)//(1024*1024)}MB left, stopping")
-                break
+        asyncio.run(download_all(
+            get_images(), image_folder_path, is_overwrite, concurrency, RateLimiter(rate_limit), timeout, max_retries,
+            counts, manifest, resizer))
     except KeyboardInterrupt:
-        print('Got KeyboardInterrupt, stopping. (This may take a few seconds.)')
+        print('Got KeyboardInterrupt, stopping.')
+    finally:
+        manifest.flush()
+        if resizer:
+            resizer.close()
 
-    print(f'A total of {processed_images} images were processed for download, '
-          f'of which {succeeded_images} images were successfully downloaded.')
+    print(f'A total of {counts["processed"]} images were processed for download, '
+          f'of which {counts["succeeded"]} images were successfully downloaded.')
+    print('Download status : ' + ', '.join(
+        f'{status} {count}' for status, count in sorted(manifest.get_status_counts().items())))
 
+    connection.close()
 
-def fetch_image_instrumented(image):
-    return print_before(f"starting {image}",
-        print_exc,
-        rate_limit, 1.0, 8,
-        print_success, f"finished {image}",
-        download_image, *image
-    )
 
+async def download_all(images, image_folder_path, is_overwrite, concurrency, rate_limiter, timeout, max_retries,
+                       counts, manifest=None, resizer=None):
+    """
+    Download (post id, url, path) of images keeping up to concurrency downloads in flight.
+    counts is updated and results are recorded to manifest as they finish.
+    """
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    started = time.time()
 
-# May be slightly slower than fetch_images_parallel, but more debuggable.
-def fetch_images_sequential(images):
-    results = []
-    for image in images:
-        results.append(fetch_image_instrumented(image))
-    return results
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+        pending = set()
 
+        async def wait_for_any():
+            nonlocal pending
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
 
-# May or may not be faster than fetch_images_sequential (with Session reuse).
-# When it is, we'll take what we can get.
-def fetch_images_parallel(images, executor=None):
-    if executor is None:
-        with ProcessPoolExecutor(max_workers=10) as executor:
-            return executor.map(fetch_image_instrumented, images)
-    else:
-        return executor.map(fetch_image_instrumented, images)
+            has_space = True
 
+            for task in done:
+                post_id, status, size, sha256, http_status, error, width, height = task.result()
+                counts['processed'] += 1
+                counts['succeeded'] += status == 'complete'
 
-def download_image(url, path, is_overwrite):
-    # So ideally, if is_overwrite is False, we don't want to download
-    # the image if the file already exists. However, we don't get a
-    # FileExistsError until we're inside the file open block.
-    # (For this we cheat and use os.path.exists to avoid creating the file
-    # and then failing to download it.) Additionally, the directory may not
-    # exist, so we need to catch that case and create the directory and then
-    # retry.
+                if manifest:
+                    manifest.record(post_id, status, size, sha256, http_status, error, width, height)
 
-    if not is_overwrite and os.path.exists(path):
-        # The file already exists, so just return
-        return True
-
-    local_session = thread_local_session()
-    r = local_session.get(url, stream=True)
-    if r.status_code != 200:
-        raise ImageFetchFailed(
-            "Fetching from URL {} to file {} failed: {}".format(
-                url, path, r.status
-            )
-        )
-    def write_file():
-        with open(path, "wb" if is_overwrite else "xb") as f:
-            for chunk in r:
-                f.write(chunk)
+                if counts['processed'] % 1000 == 0:
+                    logging.info(f'{counts["processed"]} images are processed, {counts["succeeded"]} succeeded '
+                                 f'({counts["processed"] / (time.time() - started):.1f} images/s)')
+
+                    if free_space_left(image_folder_path) < 10_000 * 1024 * 1024:
+                        logging.warning(f'only {free_space_left(image_folder_path) // (1024 * 1024)}MB left, stopping')
+                        has_space = False
+
+            return has_space
+
+        try:
+            for post_id, url, path in images:
+                if len(pending) >= concurrency and not await wait_for_any():
+                    break
+
+                pending.add(asyncio.ensure_future(
+                    try_download_image(session, rate_limiter, post_id, url, path, is_overwrite, max_retries, resizer)))
+
+            while pending:
+                await wait_for_any()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+async def try_download_image(session, rate_limiter, post_id, url, path, is_overwrite, max_retries, resizer=None):
+    """
+    Download image and return (post id, status, size, sha256, HTTP status, error, width, height).
+    Errors are returned instead of raised.
+    """
     try:
-        write_file()
-    except FileNotFoundError:
-        dd.io.try_create_directory(os.path.dirname(path))
-        write_file()
-    except FileExistsError:
-        # unexpected as we already checked the existence earlier
-        return True
-    return True
+        size, sha256, width, height = await download_image(
+            session, rate_limiter, url, path, is_overwrite, max_retries, resizer)
+        logging.debug(f'finished {url}')
+        return (post_id, 'complete', size, sha256, 200, None, width, height)
+    except asyncio.CancelledError:
+        raise
+    except ImageFetchFailed as e:
+        logging.debug(f'Encountered error: {url} : {e}')
+        return (post_id, 'failed', None, None, e.http_status, str(e), None, None)
+    except Exception as e:
+        logging.debug(f'Encountered error: {url} : {e!r}')
+        return (post_id, 'failed', None, None, None, repr(e), None, None)
+
+
+async def download_image(session, rate_limiter, url, path, is_overwrite, max_retries, resizer=None,
+                         chunk_size=64 * 1024):
+    """
+    Download url to path and return (size, sha256, width, height) of the file. width and height are known
+    only if resizer is given or the file already exists. The file is written to temporary file and renamed when it is complete,
+    so path never has partial image.
+    Without resizer the body is streamed to the file. With resizer the whole body is read into memory,
+    and it is sent to a worker process after the connection is released.
+    """
+    if not is_overwrite and os.path.exists(path):
+        # downloaded by older version without manifest, which may be cut off. Hashing and decoding
+        # take long for large files, so they are kept off the event loop.
+        image_info = await asyncio.get_event_loop().run_in_executor(
+            resizer.executor if resizer else None, get_existing_image_info, path)
 
+        if image_info is not None:
+            return image_info
 
-def thread_local_session():
-    if  getattr(threadSessionHolder, 'initialised', None) is None:
-        threadSessionHolder.session = requests.Session()
-        logging.debug("Made new session")
-        threadSessionHolder.initialised = True
-    return threadSessionHolder.session
+        logging.info(f'{path} is broken, downloading it again')
 
+    for _ in range(max_retries + 1):
+        await rate_limiter.acquire()
 
-def setup_logging():
-    log_level = logging.INFO
-    if os.getenv("DEBUG", "false") == "true":
-        log_level = logging.DEBUG
-    logging.basicConfig(
-        format='%(asctime)s %(levelname)-8s %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S',
-        stream=sys.stderr,
-        level=log_level,
-    )
+        async with session.get(url) as response:
+            if response.status == 429:
+                rate_limiter.on_rate_limited(parse_retry_after(response.headers.get('Retry-After')))
+                continue
+
+            if response.status != 200:
+                raise ImageFetchFailed(
+                    f'Fetching from URL {url} to file {path} failed: {response.status}', http_status=response.status)
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
 
+            if resizer:
+                # decoding is done by the worker process, which needs the whole image
+                data = await response.read()
+            else:
+                size, sha256 = await save_response(response, path, chunk_size)
+                rate_limiter.on_success()
+                return (size, sha256, None, None)
 
-def print_success(message, f, *args, **kwargs):
-    ret = f(*args, **kwargs)
-    logging.debug(message)
-    return ret
+        # connection is back in the pool while resizing, so slow resizing does not hold back downloads
+        result = await resizer.save(data, path)
+        rate_limiter.on_success()
+        return result
 
+    raise ImageFetchFailed(f'Fetching from URL {url} is rate limited {max_retries + 1} times', http_status=429)
 
-def print_before(message, f, *args, **kwargs):
-    logging.debug(message)
-    return f(*args, **kwargs)
 
+async def save_response(response, path, chunk_size):
+    """
+    Stream response body to path and return (size, sha256) of it.
+    """
+    temporary_path = f'{path}.part'
+    size = 0
+    file_hash = hashlib.sha256()
 
-def print_exc(f, *args, **kwargs):
     try:
-        return f(*args, **kwargs)
+        with open(temporary_path, 'wb') as stream:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                stream.write(chunk)
+                size += len(chunk)
+                file_hash.update(chunk)
+
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+    return (size, file_hash.hexdigest())
+
+
+def get_existing_image_info(path):
+    """
+    (size, sha256, width, height) of existing image file, or None if it does not decode,
+    for example when its download was interrupted.
+    """
+    try:
+        with Image.open(path) as image:
+            # decode whole image, truncated images fail only here
+            image.load()
+            width, height = image.size
     except Exception as e:
-        formatted = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
-        logging.debug(f"Encountered error: {str(e)}: \n{formatted}")
+        logging.debug(f'Decoding {path} failed : {e!r}')
         return None
 
+    return (*get_file_size_and_hash(path), width, height)
+
+
+def resize_and_save_image(data, path, max_size):
+    """
+    Resize image data to fit in max_size x max_size keeping aspect ratio, and save it to path in the format
+    of its extension. Images which already fit are saved as they are. Runs on worker process.
+    Return (size, sha256, width, height) of the saved file.
+    """
+    image = Image.open(io.BytesIO(data))
+    image_format = 'JPEG' if os.path.splitext(path)[1].lower() in ['.jpg', '.jpeg'] else 'PNG'
+
+    if max(image.size) > max_size or image.format != image_format:
+        # draft lets JPEG decoder skip resolution which is not needed
+        image.draft('RGB', (max_size, max_size))
+
+        # palette images can only be resized by nearest neighbor
+        if image.mode in ['P', '1']:
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+        image.thumbnail((max_size, max_size), Image.BOX)
+
+        if image_format == 'JPEG' and image.mode not in ['RGB', 'L']:
+            image = image.convert('RGB')
+
+        stream = io.BytesIO()
+        image.save(stream, format=image_format, **({'quality': 95} if image_format == 'JPEG' else {}))
+        data = stream.getvalue()
+    else:
+        # still decode whole image, so broken image is not saved
+        image.load()
+
+    temporary_path = f'{path}.part'
 
-def rate_limit(sleep, tries, f, *args, **kwargs):
     try:
-        return f(*args, **kwargs)
-    except Exception as e:
-        if '429' in str(e) and tries > 0:
-            random_sleep = sleep * 2 * random.random()
-            logging.debug(f"backing off ~{sleep}s ({random_sleep:.2f}s)")
-            time.sleep(random_sleep)
-            return rate_limit(sleep * 2, tries - 1, f, *args, **kwargs)
-        else:
-            raise
+        with open(temporary_path, 'wb') as stream:
+            stream.write(data)
+
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+    return (len(data), hashlib.sha256(data).hexdigest(), image.width, image.height)
+
+
+def get_file_size_and_hash(path, chunk_size=1024 * 1024):
+    file_hash = hashlib.sha256()
+    size = 0
+
+    with open(path, 'rb') as stream:
+        while chunk := stream.read(chunk_size):
+            file_hash.update(chunk)
+            size += len(chunk)
+
+    return (size, file_hash.hexdigest())
+
+
+def parse_retry_after(value):
+    """
+    Seconds of Retry-After header, which is seconds or HTTP date. None if it is not given or invalid.
+    """
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def setup_logging():
+    log_level = logging.INFO
+    if os.getenv("DEBUG", "false") == "true":
+        log_level = logging.DEBUG
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        stream=sys.stderr,
+        level=log_level,
+    )
 
 
 def free_space_left(path):
@@ -1,6 +1,7 @@
 import os
-from typing import Any, Iterable, List, Tuple, Union
+from typing import Any, Iterable, List, Optional, Tuple, Union
 
+import numpy as np
 import six
 import tensorflow as tf
 
@@ -19,41 +20,83 @@ def evaluate_image_raw(
     image_shape = image.shape
     image = image.reshape(
         (1, image_shape[0], image_shape[1], image_shape[2]))
-    y = model.predict(image)[0]
+    with dd.metrics.time_stage('model'):
+        y = model.predict(image)[0]
 
     return y
 
 def evaluate_image(
-    image_input: Union[str, six.BytesIO], model: Any, tags: List[str], threshold: float
+    image_input: Union[str, six.BytesIO], model: Any, tags: List[str], threshold: float, top_k: Optional[int] = None
 ) -> Iterable[Tuple[str, float]]:
     y = evaluate_image_raw(image_input, model)
 
-    result_dict = {}
+    indices, scores = select_tags(y[np.newaxis], threshold, top_k)[0]
 
-    for i, tag in enumerate(tags):
-        result_dict[tag] = y[i]
+    return decode_tags(indices, scores, tags)
 
-    for tag in tags:
-        if result_dict[tag] >= threshold:
-            yield tag, result_dict[tag]
 
+def select_tags(
+    y: Any, threshold: float, top_k: Optional[int] = None
+) -> List[Tuple[Any, Any]]:
+    """
+    Select tags from (batch, n_tags) model output using array operations.
+    Scores below threshold are dropped and, if top_k is given, only the k highest
+    scores of each row are kept. Returns (indices, scores) arrays for each row,
+    ordered by tag index.
+    """
+    y = np.asarray(y)
+    mask = y >= threshold
 
-def load_model(project_path, model_path, tags_path, compile_model, verbose):
+    if top_k is not None and top_k < y.shape[1]:
+        top_indices = np.argpartition(-y, max(top_k - 1, 0), axis=1)[:, :max(top_k, 0)]
+        top_mask = np.zeros_like(mask)
+        np.put_along_axis(top_mask, top_indices, True, axis=1)
+        mask &= top_mask
+
+    rows, indices = np.nonzero(mask)
+    splits = np.searchsorted(rows, np.arange(1, y.shape[0]))
+
+    return list(zip(np.split(indices, splits), np.split(y[rows, indices], splits)))
+
+
+def decode_tags(indices: Any, scores: Any, tags: List[str]) -> List[Tuple[str, float]]:
+    return [(tags[index], score) for index, score in zip(indices, scores)]
+
+
+def load_model(project_path, model_path, tags_path, compile_model, verbose, precision=None):
     if not model_path and not project_path:
         raise Exception('You must provide project path or model path.')
 
     if not tags_path and not project_path:
         raise Exception('You must provide project path or tags path.')
 
+    if model_path and model_path.endswith('.tflite') and precision:
+        raise Exception(f'Precision can not be set for quantized TensorFlow Lite model : {model_path}')
+
     if model_path:
         if verbose:
             print(f'Loading model from {model_path} ...')
-        model = tf.keras.models.load_model(model_path, compile=compile_model)
+        if model_path.endswith('.tflite'):
+            # same thread limit as TensorFlow, which is set per worker by serve
+            model = dd.model.TFLiteModel(
+                model_path, num_threads=tf.config.threading.get_intra_op_parallelism_threads() or None)
+        else:
+            model = tf.keras.models.load_model(model_path, compile=compile_model)
+
+            if not compile_model:
+                model = dd.model.optimize_for_inference(model)
     else:
         if verbose:
             print(f'Loading model from project {project_path} ...')
         model = dd.project.load_model_from_project(project_path, compile_model=compile_model)
 
+    precision = get_precision(project_path, precision)
+
+    if not isinstance(model, dd.model.TFLiteModel):
+        if verbose:
+            print(f'Using {precision} precision ...')
+        model = dd.model.convert_model_precision(model, precision)
+
     if tags_path:
         if verbose:
             print(f'Loading tags from {tags_path} ...')
@@ -65,11 +108,75 @@ def load_model(project_path, model_path, tags_path, compile_model, verbose):
 
     return model, tags
 
-def evaluate(target_paths, project_path, model_path, tags_path, threshold, allow_gpu, compile_model, allow_folder, folder_filters, verbose):
+
+def get_precision(project_path, precision):
+    """
+    Precision given, or precision of project, or float32 if there is no project.
+    """
+    if precision:
+        return precision
+
+    if project_path:
+        project_context = dd.io.deserialize_from_json(os.path.join(project_path, 'project.json'))
+        return project_context.get('precision', 'float32')
+
+    return 'float32'
+
+
+def load_result_cache(cache_path, cache_size, project_path, model_path, tags, verbose, precision=None):
+    if not cache_path:
+        return None
+
+    if not model_path:
+        model_path = dd.project.get_model_path_from_project(project_path)
+
+    if verbose:
+        print(f'Opening result cache {cache_path} ...')
+
+    fingerprint = dd.data.create_model_fingerprint(model_path, tags, get_precision(project_path, precision))
+
+    return dd.data.ResultCache(cache_path, fingerprint, max_entries=cache_size)
+
+
+def evaluate_image_paths_raw(image_paths, model, batch_size, worker_count, result_cache=None):
+    """
+    Yield (image_path, y) in input order. Images found in result_cache are not decoded nor evaluated.
+    """
+    width = model.input_shape[2]
+    height = model.input_shape[1]
+
+    batches = dd.data.load_image_batches_for_evaluate(
+        image_paths, width, height, batch_size, worker_count=worker_count, result_cache=result_cache)
+
+    for batch in batches:
+        if result_cache:
+            batch_image_paths, images, keys, cached_ys = batch
+        else:
+            batch_image_paths, images = batch
+            keys = cached_ys = [None] * len(batch_image_paths)
+
+        if images is not None:
+            dd.metrics.BATCH_SIZE.observe(len(images))
+            with dd.metrics.time_stage('model'):
+                y_batch = iter(model.predict_on_batch(images))
+
+        for image_path, key, y in zip(batch_image_paths, keys, cached_ys):
+            if y is None:
+                y = next(y_batch)
+
+                if result_cache:
+                    result_cache.put(key, y)
+
+            yield image_path, y
+
+
+def evaluate(target_paths, project_path, model_path, tags_path, threshold, top_k, allow_gpu, compile_model, allow_folder, folder_filters,
+             batch_size, worker_count, cache_path, cache_size, precision, verbose):
     if not allow_gpu:
         os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
 
-    model, tags = load_model(project_path, model_path, tags_path, compile_model, verbose)
+    model, tags = load_model(project_path, model_path, tags_path, compile_model, verbose, precision)
+    result_cache = load_result_cache(cache_path, cache_size, project_path, model_path, tags, verbose, precision)
 
     target_image_paths = []
 
@@ -81,11 +188,25 @@ def evaluate(target_paths, project_path, model_path, tags_path, threshold, allow
 
     target_image_paths = dd.extra.natural_sorted(target_image_paths)
 
-    for image_path in target_image_paths:
+    if verbose:
+        print(f'Evaluating {len(target_image_paths)} images (batch size {batch_size}, {worker_count} workers) ...')
+
+    results = evaluate_image_paths_raw(
+        target_image_paths, model, batch_size, worker_count, result_cache=result_cache)
+
+    for image_path, y in results:
+        indices, scores = select_tags(y[np.newaxis], threshold, top_k)[0]
+
         print(f'Tags of {image_path}:')
-        tags_gen = evaluate_image(image_path, model, tags, threshold)
+        tags_gen = decode_tags(indices, scores, tags)
         for tag, score in sorted(tags_gen, key=lambda tag_score: tag_score[1]):
             print(f'({score:05.3f}) {tag}')
 
         print()
 
+    if result_cache:
+        result_cache.close()
+
+    if verbose:
+        for stage, count, mean_seconds in dd.metrics.get_stage_summary():
+            print(f'{stage} : {count} times, {mean_seconds * 1000.0:.2f} ms on average')
@@ -2,6 +2,8 @@ import os
 
 import deepdanbooru as dd
 
+from .evaluate import select_tags, decode_tags
+
 
 def evaluate_project(project_path, target_path, threshold):
     if not os.path.exists(target_path):
@@ -33,19 +35,14 @@ def evaluate_project(project_path, target_path, threshold):
             image_path, width=width, height=height)
 
         image_shape = image.shape
-        # image = image.astype(np.float16)
         image = image.reshape(
             (1, image_shape[0], image_shape[1], image_shape[2]))
-        y = model.predict(image)[0]
-
-        result_dict = {}
+        y = model.predict(image)
 
-        for i, tag in enumerate(tags):
-            result_dict[tag] = y[i]
+        indices, scores = select_tags(y, threshold)[0]
 
         print(f'Tags of {image_path}:')
-        for tag in tags:
-            if result_dict[tag] >= threshold:
-                print(f'({result_dict[tag]:05.3f}) {tag}')
+        for tag, score in decode_tags(indices, scores, tags):
+            print(f'({score:05.3f}) {tag}')
 
         print()
@@ -0,0 +1,128 @@
+import os
+import random
+import time
+
+import numpy as np
+
+import deepdanbooru as dd
+from .evaluate import load_model
+
+
+def load_calibration_image_paths(project_path, calibration_path, count, random_seed):
+    """
+    Sample image paths from image records of the project, or from images in calibration_path folder.
+    """
+    if calibration_path:
+        image_paths = dd.io.get_image_file_paths_recursive(
+            calibration_path, '*.[Pp][Nn][Gg],*.[Jj][Pp][Gg],*.[Jj][Pp][Ee][Gg],*.[Gg][Ii][Ff]')
+    elif project_path:
+        project_context = dd.io.deserialize_from_json(os.path.join(project_path, 'project.json'))
+        image_records = dd.data.load_image_records(
+            project_context['database_path'], project_context['minimum_tag_count'])
+        image_paths = image_records.get_image_paths()
+    else:
+        raise Exception('You must provide project path or calibration path.')
+
+    if not image_paths:
+        raise Exception('There is no image for calibration.')
+
+    image_paths = sorted(image_paths)
+    random.Random(random_seed).shuffle(image_paths)
+
+    return image_paths[:count]
+
+
+def predict_one_by_one(model, images):
+    """
+    Return (y, elapsed seconds). Images are evaluated one by one, like single image requests.
+    """
+    started = time.time()
+    y = np.concatenate([model.predict_on_batch(image[np.newaxis]) for image in images])
+
+    return y, time.time() - started
+
+
+def create_drift_report(model, quantized_model, images, tags, threshold):
+    """
+    Compare scores of quantized model against float model on given images.
+    """
+    y, float_seconds = predict_one_by_one(model, images)
+    y_quantized, quantized_seconds = predict_one_by_one(quantized_model, images)
+
+    difference = np.abs(y - y_quantized)
+    tag_differences = difference.mean(axis=0)
+    flipped = (y >= threshold) != (y_quantized >= threshold)
+
+    return {
+        'image_count': len(images),
+        'mean_absolute_difference': float(difference.mean()),
+        'max_absolute_difference': float(difference.max()),
+        'threshold': threshold,
+        'flipped_tag_rate': float(flipped.mean()),
+        'images_with_flipped_tag': int(flipped.any(axis=1).sum()),
+        'float_ms_per_image': float_seconds * 1000.0 / len(images),
+        'quantized_ms_per_image': quantized_seconds * 1000.0 / len(images),
+        'most_drifted_tags': [
+            {'tag': tags[index], 'mean_absolute_difference': float(tag_differences[index])}
+            for index in np.argsort(-tag_differences)[:20]
+        ]
+    }
+
+
+def export_model(project_path, model_path, tags_path, output_path, calibration_path, calibration_count, report_count,
+                 threshold, random_seed, overwrite, verbose):
+    """
+    Export int8 quantized TensorFlow Lite model and report score drift against float model.
+    """
+    if not output_path:
+        if not model_path and not project_path:
+            raise Exception('You must provide project path or model path.')
+
+        float_model_path = model_path or dd.project.get_model_path_from_project(project_path)
+        output_path = os.path.splitext(float_model_path)[0] + '.tflite'
+
+    if os.path.exists(output_path) and not overwrite:
+        raise Exception(f'{output_path} is already exists.')
+
+    model, tags = load_model(project_path, model_path, tags_path, False, verbose, 'float32')
+
+    width = model.input_shape[2]
+    height = model.input_shape[1]
+
+    image_paths = load_calibration_image_paths(
+        project_path, calibration_path, calibration_count + report_count, random_seed)
+    calibration_image_paths = image_paths[:calibration_count]
+    report_image_paths = image_paths[calibration_count:]
+    reused_calibration_images = not report_image_paths
+
+    if reused_calibration_images:
+        print(f'Warning: there are only {len(image_paths)} images, drift is reported on calibration images, '
+              'which underestimates it.')
+        report_image_paths = calibration_image_paths
+
+    print(f'Calibrating with {len(calibration_image_paths)} images ... ')
+    calibration_images = (dd.data.load_image_for_evaluate(image_path, width, height)
+                          for image_path in calibration_image_paths)
+    quantized_model_content = dd.model.quantize_model(model, calibration_images)
+
+    with open(output_path, 'wb') as stream:
+        stream.write(quantized_model_content)
+
+    print(f'Quantized model is saved to {output_path} ({len(quantized_model_content) / 1024 / 1024:.2f} MB).')
+
+    print(f'Comparing scores on {len(report_image_paths)} images ... ')
+    report_images = np.stack([dd.data.load_image_for_evaluate(image_path, width, height)
+                              for image_path in report_image_paths])
+    report = create_drift_report(
+        model, dd.model.TFLiteModel(output_path), report_images, tags, threshold)
+    report['reused_calibration_images'] = reused_calibration_images
+
+    report_path = os.path.splitext(output_path)[0] + '.report.json'
+    dd.io.serialize_as_json(report, report_path)
+
+    print(f'Mean absolute difference : {report["mean_absolute_difference"]:.6f}')
+    print(f'Max absolute difference : {report["max_absolute_difference"]:.6f}')
+    print(f'Flipped tags at threshold {threshold} : {report["flipped_tag_rate"] * 100.0:.4f} % '
+          f'({report["images_with_flipped_tag"]} of {report["image_count"]} images)')
+    print(f'Latency : {report["float_ms_per_image"]:.2f} ms -> {report["quantized_ms_per_image"]:.2f} ms per image')
+    print(f'Report is saved to {report_path}.')
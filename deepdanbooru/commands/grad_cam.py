@@ -6,6 +6,8 @@ from PIL import Image
 import deepdanbooru as dd
 from scipy import ndimage
 
+from .evaluate import select_tags, decode_tags
+
 
 @tf.function
 def get_gradient(model, x, output_mask):
@@ -75,23 +77,16 @@ def grad_cam(project_path, target_path, output_path, threshold):
         image_for_result = image
         image_shape = image.shape
         y = model.predict(image.reshape(
-            (1, image_shape[0], image_shape[1], image_shape[2])))[0]
-
-        result_dict = {}
-
-        estimated_tags = []
+            (1, image_shape[0], image_shape[1], image_shape[2])))
 
-        for i, tag in enumerate(tags):
-            result_dict[tag] = y[i]
+        indices, scores = select_tags(y, threshold)[0]
 
-            if y[i] >= threshold:
-                estimated_tags.append((i, tag))
+        estimated_tags = [(index, tags[index]) for index in indices]
 
         print(f'Tags of {image_path}:')
 
-        for tag in tags:
-            if result_dict[tag] >= threshold:
-                print(f'({result_dict[tag]:05.3f}) {tag}')
+        for tag, score in decode_tags(indices, scores, tags):
+            print(f'({score:05.3f}) {tag}')
 
         image = image.astype(np.float32)
 
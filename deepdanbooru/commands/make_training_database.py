@@ -1,13 +1,18 @@
 import os
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import psycopg2
 import psycopg2.extras
 
 
 def make_training_database(source_format, source_uri, output_path, start_id, end_id,
-                           use_deleted, chunk_size, overwrite, vacuum):
+                           use_deleted, chunk_size, worker_count, overwrite, resume, vacuum):
     '''
     Make sqlite database for training. Also add system tags.
+    Id range is split into partitions which are copied by worker processes. Rows are streamed from the source
+    and inserted in batches of chunk_size, and progress of each partition is committed with its rows,
+    so interrupted build continues from the last committed id with resume.
     '''
 
     if source_uri == output_path:
@@ -15,44 +20,102 @@ def make_training_database(source_format, source_uri, output_path, start_id, end
 
     if os.path.exists(output_path):
         if overwrite:
-            os.remove(output_path)
-        else:
-            raise Exception(f'{output_path} is already exists.')
+            for path in [output_path, f'{output_path}-wal', f'{output_path}-shm']:
+                if os.path.exists(path):
+                    os.remove(path)
+        elif not resume:
+            raise Exception(f'{output_path} is already exists. Use --resume to continue building it.')
 
-    if source_format == 'danbooru':
-        src = DanbooruSource(file_path=source_uri)
-    elif source_format == 'derpibooru':
-        src = DerpibooruSource(postgres_uri=source_uri)
+    out = OutputDatabase(file_path=output_path)
+    out.create_tables()
+
+    partitions = out.load_partitions()
+    # options which decide the copied rows, resumed build must use the same
+    build_options = {
+        'source_format': source_format, 'start_id': start_id, 'end_id': end_id, 'use_deleted': use_deleted}
+
+    if partitions:
+        saved_build_options = out.load_build_options()
+        different_names = [name for name, value in build_options.items()
+                           if name in saved_build_options and saved_build_options[name] != str(value)]
+
+        if different_names:
+            saved = ', '.join(f'{name}={saved_build_options[name]}' for name in different_names)
+            out.connection.close()
+            raise Exception(f'Options are different from the interrupted build ({saved}). Use the same options to resume it.')
+
+        if saved_build_options.get('worker_count', str(worker_count)) != str(worker_count):
+            print(f'Partitions of the interrupted build with {saved_build_options["worker_count"]} workers are kept, '
+                  f'{worker_count} workers copy them.')
+
+        print(f'Resuming {len(partitions)} partitions ({partitions[0][0]}~{partitions[-1][1]}) ...')
+    elif out.has_posts():
+        out.connection.close()
+        raise Exception(f'{output_path} has posts but no build progress, so it is not resumable. Use --overwrite to rebuild it.')
     else:
-        raise ValueError("Unhandled source format %s" % source_format)
+        src = create_source_database(source_format, source_uri)
+        min_id, max_id = src.get_id_range(start_id, end_id)
+        src.connection.close()
+
+        if min_id is not None:
+            partitions = split_id_range(min_id, max_id, worker_count * 4 if worker_count > 1 else 1)
+        out.save_partitions(partitions)
+        out.save_build_options({**build_options, 'worker_count': worker_count})
+
+    remaining_partitions = [partition for partition in partitions if partition[2] < partition[1]]
+    print(f'Copying {len(remaining_partitions)} of {len(partitions)} partitions with {worker_count} workers ...')
+
+    copy_args = [
+        (source_format, source_uri, output_path, partition_start, partition_end, last_id, use_deleted, chunk_size)
+        for partition_start, partition_end, last_id in remaining_partitions]
+    total_count = 0
+
+    if worker_count > 1 and len(copy_args) > 1:
+        with ProcessPoolExecutor(max_workers=worker_count) as executor:
+            futures = {executor.submit(copy_partition, *args): args for args in copy_args}
+            for future in as_completed(futures):
+                total_count += future.result()
+                print(f'Partition {futures[future][3]}~{futures[future][4]} is complete. ({total_count} rows)')
+    else:
+        for args in copy_args:
+            total_count += copy_partition(*args)
+            print(f'Partition {args[3]}~{args[4]} is complete. ({total_count} rows)')
+
+    print('Creating indexes and counting tags ...')
+    out.create_indexes()
+    out.update_tag_counts()
+
+    # back to single file database for readers
+    out.cursor.execute('PRAGMA journal_mode=DELETE')
+
+    if vacuum:
+        print('Vacuum ...')
+        out.cursor.execute('vacuum')
+        out.connection.commit()
+
+    out.connection.close()
+
 
+def copy_partition(source_format, source_uri, output_path, partition_start, partition_end, last_id,
+                   use_deleted, chunk_size):
+    '''
+    Copy posts of id in (last_id, partition_end] and return number of inserted rows.
+    Runs in worker process, so connections are opened here.
+    '''
+    src = create_source_database(source_format, source_uri)
     out = OutputDatabase(file_path=output_path)
 
-    # Create output table
-    print('Creating table ...')
-    out.cursor.execute(f"""CREATE TABLE {out.table} (
-        {out.id.column} INTEGER NOT NULL PRIMARY KEY,
-        {out.foldername.column} TEXT,
-        {out.filename.column} TEXT,
-        {out.extension.column} TEXT,
-        {out.download_url.column} TEXT,
-        {out.tag_string.column} TEXT,
-        {out.tag_count_general.column} INTEGER )""")
-    out.connection.commit()
-    print('Creating table is complete.')
-
-    current_start_id = start_id
+    cursor = src.create_streaming_cursor(chunk_size)
+    cursor.execute(
+        f"""SELECT
+            {src.id._as},{src.filename._as},{src.foldername._as},{src.extension._as},{src.download_url._as},{src.tag_string._as},{src.tag_count_general._as},{src.score._as},{src.deleted._as}
+        FROM {src.from_clause} WHERE ({src.id.query} > {src.placeholder}) AND ({src.id.query} <= {src.placeholder}) AND {src.where_clause} GROUP BY {src.group_by_clause} ORDER BY {src.id.query} ASC""",
+        (last_id, partition_end))
 
-    while True:
-        print(
-            f'Fetching source rows ... ({current_start_id}~)')
-        src.cursor.execute(
-            f"""SELECT
-                {src.id._as},{src.filename._as},{src.foldername._as},{src.extension._as},{src.download_url._as},{src.tag_string._as},{src.tag_count_general._as},{src.score._as},{src.deleted._as}
-            FROM {src.from_clause} WHERE ({src.id.query} >= {src.placeholder}) AND {src.where_clause} GROUP BY {src.group_by_clause} ORDER BY {src.id.query} ASC LIMIT {src.placeholder}""",
-            (current_start_id, chunk_size))
+    inserted_count = 0
 
-        rows = src.cursor.fetchall()
+    while True:
+        rows = cursor.fetchmany(chunk_size)
 
         if not rows:
             break
@@ -70,9 +133,6 @@ def make_training_database(source_format, source_uri, output_path, start_id, end
             # score = row[src.score.column]
             is_deleted = row[src.deleted.column]
 
-            if post_id > end_id:
-                break
-
             if is_deleted and not use_deleted:
                 continue
 
@@ -90,35 +150,46 @@ def make_training_database(source_format, source_uri, output_path, start_id, end
             insert_params.append(
                 (post_id, foldername, filename, extension, download_url, tag_string, general_tag_count))
 
-        if insert_params:
-            print('Inserting ...')
-            out.cursor.executemany(
-                f"""INSERT INTO {out.table} (
-                {out.id.column},{out.foldername.column},{out.filename.column},{out.extension.column},{out.download_url.column},{out.tag_string.column},{out.tag_count_general.column})
-                values (?, ?, ?, ?, ?, ?, ?)""", insert_params)
-            out.connection.commit()
+        out.insert_posts(insert_params, partition_start, rows[-1][src.id.column], src.tag_delimiter)
+        inserted_count += len(insert_params)
 
-        current_start_id = rows[-1][src.id.column] + 1
+    cursor.close()
+    src.connection.close()
+    out.connection.close()
 
-        if current_start_id > end_id or len(rows) < chunk_size:
-            break
+    return inserted_count
 
-    if vacuum:
-        print('Vacuum ...')
-        out.cursor.execute('vacuum')
-        out.connection.commit()
 
-    src.connection.close()
-    out.connection.close()
+def split_id_range(min_id, max_id, partition_count):
+    '''
+    Split [min_id, max_id] into (start id, end id, last copied id) partitions of equal id range.
+    '''
+    partition_size = max(-(-(max_id - min_id + 1) // partition_count), 1)
+
+    return [(partition_start, min(partition_start + partition_size - 1, max_id), partition_start - 1)
+            for partition_start in range(min_id, max_id + 1, partition_size)]
+
+
+def create_source_database(source_format, source_uri):
+    if source_format == 'danbooru':
+        return DanbooruSource(file_path=source_uri)
+    elif source_format == 'derpibooru':
+        return DerpibooruSource(postgres_uri=source_uri)
+    else:
+        raise ValueError("Unhandled source format %s" % source_format)
 
 
 class SqliteDatabase:
-    def __init__(self, file_path):
-        self.connection = sqlite3.connect(file_path)
+    def __init__(self, file_path, timeout=5.0):
+        self.connection = sqlite3.connect(file_path, timeout=timeout)
         self.connection.row_factory = sqlite3.Row
         self.cursor = self.connection.cursor()
         self.placeholder = '?'
 
+    def create_streaming_cursor(self, chunk_size):
+        # sqlite cursors already step through rows lazily
+        return self.connection.cursor()
+
 
 class PostgresDatabase:
     def __init__(self, postgres_uri):
@@ -126,6 +197,16 @@ class PostgresDatabase:
         self.cursor = self.connection.cursor(cursor_factory = psycopg2.extras.DictCursor)
         self.placeholder = '%s'
 
+    def create_streaming_cursor(self, chunk_size):
+        """
+        Named (server-side) cursor, which sends rows in chunks instead of the whole result at once.
+        """
+        cursor = self.connection.cursor(
+            name=f'make_training_database_{os.getpid()}', cursor_factory=psycopg2.extras.DictCursor)
+        cursor.itersize = chunk_size
+
+        return cursor
+
 
 class QueryColumn:
     def __init__(self, column_name):
@@ -151,16 +232,27 @@ class SourceDatabase(TagDatabase):
     from_clause = 'posts'
     where_clause = 'true'
     group_by_clause = 'id'
+    id_table = 'posts'
 
     score = QueryColumn('score')
     deleted = QueryColumn('is_deleted')
 
+    def get_id_range(self, start_id, end_id):
+        """
+        (min id, max id) of posts between start_id and end_id, or (None, None) if there is no post.
+        """
+        self.cursor.execute(
+            f'SELECT min(id), max(id) FROM {self.id_table} WHERE id >= {self.placeholder} AND id <= {self.placeholder}',
+            (start_id, end_id))
+
+        return tuple(self.cursor.fetchone())
+
 
 class DanbooruSource(SqliteDatabase, SourceDatabase):
     def __init__(self, file_path):
         super().__init__(file_path)
         self.tag_delimiter = ' '
-        self.foldername.query = 'left(md5, 2)'
+        self.foldername.query = 'substr(md5, 1, 2)'
         self.filename.query = 'md5'
         # concat rating tag with rest of tag string
         self.tag_string.query = f"""
@@ -196,6 +288,7 @@ class DerpibooruSource(PostgresDatabase, SourceDatabase):
         ))
         """
         self.group_by_clause = 'i.id'
+        self.id_table = 'images'
 
         self.tag_delimiter = ','
 
@@ -223,4 +316,130 @@ class DerpibooruSource(PostgresDatabase, SourceDatabase):
 
 
 class OutputDatabase(SqliteDatabase, TagDatabase):
+    """
+    Training database. Besides posts with tag strings, tags are normalized into tags (with post counts)
+    and post_tags tables, so records and tag statistics are loaded by indexed queries.
+    """
     table = 'posts'
+    tags_table = 'tags'
+    post_tags_table = 'post_tags'
+    progress_table = 'build_progress'
+    options_table = 'build_options'
+
+    def __init__(self, file_path):
+        # workers write to the same file, so wait for each other instead of failing
+        super().__init__(file_path, timeout=600.0)
+        self.cursor.execute('PRAGMA journal_mode=WAL')
+        self.cursor.execute('PRAGMA synchronous=OFF')
+        self.tag_ids = {}
+
+    def create_tables(self):
+        self.cursor.execute(f"""CREATE TABLE IF NOT EXISTS {self.table} (
+            {self.id.column} INTEGER NOT NULL PRIMARY KEY,
+            {self.foldername.column} TEXT,
+            {self.filename.column} TEXT,
+            {self.extension.column} TEXT,
+            {self.download_url.column} TEXT,
+            {self.tag_string.column} TEXT,
+            {self.tag_count_general.column} INTEGER )""")
+        self.cursor.execute(f"""CREATE TABLE IF NOT EXISTS {self.tags_table} (
+            id INTEGER NOT NULL PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            post_count INTEGER NOT NULL DEFAULT 0 )""")
+        self.cursor.execute(f"""CREATE TABLE IF NOT EXISTS {self.post_tags_table} (
+            post_id INTEGER NOT NULL,
+            tag_id INTEGER NOT NULL,
+            PRIMARY KEY (post_id, tag_id) ) WITHOUT ROWID""")
+        self.cursor.execute(f"""CREATE TABLE IF NOT EXISTS {self.progress_table} (
+            start_id INTEGER NOT NULL PRIMARY KEY,
+            end_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL )""")
+        self.cursor.execute(f"""CREATE TABLE IF NOT EXISTS {self.options_table} (
+            name TEXT NOT NULL PRIMARY KEY,
+            value TEXT NOT NULL )""")
+        self.connection.commit()
+
+    def has_posts(self):
+        self.cursor.execute(f'SELECT 1 FROM {self.table} LIMIT 1')
+
+        return self.cursor.fetchone() is not None
+
+    def load_partitions(self):
+        self.cursor.execute(f'SELECT start_id, end_id, last_id FROM {self.progress_table} ORDER BY start_id')
+
+        return [tuple(row) for row in self.cursor.fetchall()]
+
+    def save_partitions(self, partitions):
+        with self.connection:
+            self.cursor.executemany(
+                f'INSERT INTO {self.progress_table} (start_id, end_id, last_id) VALUES (?, ?, ?)', partitions)
+
+    def load_build_options(self):
+        self.cursor.execute(f'SELECT name, value FROM {self.options_table}')
+
+        return {row[0]: row[1] for row in self.cursor.fetchall()}
+
+    def save_build_options(self, build_options):
+        with self.connection:
+            self.cursor.executemany(
+                f'INSERT OR REPLACE INTO {self.options_table} (name, value) VALUES (?, ?)',
+                [(name, str(value)) for name, value in build_options.items()])
+
+    def insert_posts(self, insert_params, partition_start, last_id, tag_delimiter):
+        """
+        Insert rows with their normalized tags, and move progress of partition to last_id in one transaction.
+        """
+        post_tag_names = [(params[0], tag) for params in insert_params for tag in (params[5] or '').split(tag_delimiter) if tag]
+
+        with self.connection:
+            self.cursor.executemany(
+                f"""INSERT INTO {self.table} (
+                {self.id.column},{self.foldername.column},{self.filename.column},{self.extension.column},{self.download_url.column},{self.tag_string.column},{self.tag_count_general.column})
+                values (?, ?, ?, ?, ?, ?, ?)""", insert_params)
+            tag_ids = self.get_tag_ids(tag for _, tag in post_tag_names)
+            self.cursor.executemany(
+                f'INSERT OR IGNORE INTO {self.post_tags_table} (post_id, tag_id) VALUES (?, ?)',
+                [(post_id, tag_ids[tag]) for post_id, tag in post_tag_names])
+            self.cursor.execute(
+                f'UPDATE {self.progress_table} SET last_id = ? WHERE start_id = ?', (last_id, partition_start))
+
+    def get_tag_ids(self, tag_names):
+        """
+        Dict of tag name to id including given tag names, which are inserted if they are new.
+        Called inside write transaction, so concurrent workers always agree on ids.
+        """
+        # in order of appearance, so ids are deterministic
+        new_tag_names = list(dict.fromkeys(tag for tag in tag_names if tag not in self.tag_ids))
+
+        if new_tag_names:
+            self.cursor.executemany(
+                f'INSERT OR IGNORE INTO {self.tags_table} (name) VALUES (?)', [(tag,) for tag in new_tag_names])
+
+            # stay under the limit of number of variables
+            for start in range(0, len(new_tag_names), 500):
+                chunk = new_tag_names[start:start + 500]
+                self.cursor.execute(
+                    f'SELECT name, id FROM {self.tags_table} WHERE name IN ({",".join("?" * len(chunk))})', chunk)
+                self.tag_ids.update((row[0], row[1]) for row in self.cursor.fetchall())
+
+        return self.tag_ids
+
+    def create_indexes(self):
+        """
+        Covering index of the training filter of load_image_records, and index of posts by tag.
+        Created after copying, which is faster than updating them for every insert.
+        """
+        self.cursor.execute(
+            f"""CREATE INDEX IF NOT EXISTS {self.table}_training_index ON {self.table} (
+            {self.extension.column},{self.tag_count_general.column},{self.foldername.column},{self.filename.column},{self.download_url.column})""")
+        self.cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS {self.post_tags_table}_tag_id_index ON {self.post_tags_table} (tag_id, post_id)')
+        self.cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS {self.tags_table}_post_count_index ON {self.tags_table} (post_count)')
+        self.connection.commit()
+
+    def update_tag_counts(self):
+        with self.connection:
+            self.cursor.execute(
+                f"""UPDATE {self.tags_table} SET post_count = (
+                SELECT count(*) FROM {self.post_tags_table} WHERE {self.post_tags_table}.tag_id = {self.tags_table}.id)""")
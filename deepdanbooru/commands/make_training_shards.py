@@ -0,0 +1,42 @@
+import os
+import shutil
+
+import deepdanbooru as dd
+
+
+def make_training_shards(project_path, output_path, shard_size, image_format, overwrite):
+    """
+    Write pre-resized images and encoded labels of the project as TFRecord shards.
+    """
+    project_context_path = os.path.join(project_path, 'project.json')
+    project_context = dd.io.deserialize_from_json(project_context_path)
+
+    if not output_path:
+        output_path = project_context.get('shards_path') or os.path.join(project_path, 'shards')
+
+    if os.path.exists(output_path):
+        if overwrite:
+            shutil.rmtree(output_path)
+        else:
+            raise Exception(f'{output_path} is already exists.')
+
+    print('Loading tags ... ')
+    tags = dd.project.load_tags_from_project(project_path)
+
+    print('Loading database ... ')
+    image_records = dd.data.load_image_records(
+        project_context['database_path'], project_context['minimum_tag_count'])
+
+    print(f'Writing {len(image_records)} records to {output_path} ... ')
+    metadata = dd.data.write_training_shards(
+        image_records, tags, output_path,
+        width=project_context['image_width'],
+        height=project_context['image_height'],
+        scale_range=project_context['scale_range'],
+        shard_size=shard_size,
+        image_format=image_format)
+
+    print(f'{metadata["record_count"]} records are written to {len(metadata["shard_file_names"])} shards.')
+
+    if project_context.get('shards_path') != output_path:
+        print(f'Set "shards_path" to "{output_path}" in project.json for training from these shards.')
@@ -1,74 +1,511 @@
+import asyncio
+import functools
+import io
+import json
 import os
+import time
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Iterable, List, Tuple, Union
 
+import numpy as np
 import six
 import tensorflow as tf
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.web
-import requests
-import io
+from PIL import Image
 
 import deepdanbooru as dd
 
-from deepdanbooru.commands.evaluate import load_model, evaluate_image
+from deepdanbooru.commands.evaluate import load_model, load_result_cache, select_tags, decode_tags
 
 
 class MainHandler(tornado.web.RequestHandler):
     def set_default_headers(self):
-        print("setting headers")
         self.set_header("Access-Control-Allow-Origin", "*")
-        self.set_header("Access-Control-Allow-Headers", "x-requested-with")
+        self.set_header("Access-Control-Allow-Headers", "x-requested-with, content-type")
         self.set_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
 
-    def initialize(self, model, tags, default_threshold):
-        self.model = model
-        self.tags = tags
+    def initialize(self, model_registry, image_fetcher, decode_executor, default_threshold,
+                   admission_controller, request_timeout):
+        self.model_registry = model_registry
+        self.image_fetcher = image_fetcher
+        self.decode_executor = decode_executor
         self.default_threshold = default_threshold
+        self.admission_controller = admission_controller
+        self.request_timeout = request_timeout
+        self.deadline = None
 
-    def get(self):
-        if (file := self.get_query_argument("file", default=None)) != None:
-            data_handle = file
-        elif (url := self.get_query_argument("url", default=None)) != None:
-            resp = requests.get(url, stream=True)
-            data_handle = io.BytesIO(resp.content)
-        else:
+    def prepare(self):
+        dd.metrics.REQUESTS_IN_FLIGHT.inc()
+
+        if self.request_timeout > 0:
+            self.deadline = tornado.ioloop.IOLoop.current().time() + self.request_timeout
+
+    def on_finish(self):
+        dd.metrics.REQUESTS_IN_FLIGHT.dec()
+        dd.metrics.REQUESTS.inc(method=self.request.method, code=self.get_status())
+
+    async def get(self):
+        if (served_model := self.get_served_model()) is None:
+            return
+
+        file = self.get_query_argument("file", default=None)
+        url = self.get_query_argument("url", default=None)
+
+        if file is None and url is None:
             self.set_status(400)
             self.write({"message": "'file' or 'url' must be specified"})
             return
 
-        threshold = float(self.get_query_argument("threshold", default=self.default_threshold))
+        if (threshold_and_top_k := self.get_threshold_and_top_k()) is None:
+            return
 
-        results = []
+        threshold, top_k = threshold_and_top_k
+
+        if not self.admit(1):
+            return
+
+        # in-flight requests keep using this version even if a new one is swapped in
+        served_model.acquire()
+        try:
+            data_handle = file if file is not None else io.BytesIO(await self.image_fetcher.fetch(url))
+            y = await self.evaluate_image_raw(served_model, data_handle)
+        except dd.server.ImageFetchError as e:
+            self.set_status(e.status_code)
+            self.write({"message": str(e)})
+            return
+        except dd.server.DeadlineExceededError as e:
+            self.set_status(503)
+            self.write({"message": str(e)})
+            return
+        finally:
+            served_model.release()
+            self.admission_controller.release(1)
 
-        tags_gen = evaluate_image(data_handle, self.model, self.tags, threshold)
-        for tag, score in sorted(tags_gen, key=lambda tag_score: tag_score[1], reverse=True):
-            results.append({"tag": tag, "confidence": float(score)})
+        results = self.get_matching_tags(served_model, y, threshold, top_k)
 
-        self.write({"matching_tags": results})
+        self.write({"model": served_model.name, "version": served_model.version, "matching_tags": results})
         self.write("\n")
 
+    async def post(self):
+        """
+        Evaluate many images in one request. Body is multipart/form-data of image files, JSON list of urls
+        (or {"urls": [...], "files": [...]}), or bytes of single image. Images are evaluated together
+        through the batcher, and the response has a result for each image in the same order.
+        """
+        if (served_model := self.get_served_model()) is None:
+            return
+
+        try:
+            inputs = self.get_post_inputs()
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"message": f"Invalid request body : {e}"})
+            return
+
+        if not inputs:
+            self.set_status(400)
+            self.write({"message": "No image is given"})
+            return
+
+        if (threshold_and_top_k := self.get_threshold_and_top_k()) is None:
+            return
+
+        threshold, top_k = threshold_and_top_k
+
+        if not self.admit(len(inputs)):
+            return
+
+        served_model.acquire()
+        try:
+            results = await asyncio.gather(*(
+                self.evaluate_input(served_model, name, source_type, source, threshold, top_k)
+                for name, source_type, source in inputs))
+        finally:
+            served_model.release()
+            self.admission_controller.release(len(inputs))
+
+        self.write({"model": served_model.name, "version": served_model.version, "results": results})
+        self.write("\n")
+
+    def get_served_model(self):
+        model_name = self.get_query_argument("model", default=None)
+        served_model = self.model_registry.get(model_name)
+
+        if served_model is None:
+            self.set_status(404)
+            self.write({"message": f"Model {model_name} is not loaded"})
+
+        return served_model
+
+    def admit(self, count):
+        """
+        Admit count images of this request all together, or respond with 429 (or 413 if they can never fit).
+        """
+        max_pending_count = self.admission_controller.max_pending_count
+
+        if max_pending_count and count > max_pending_count:
+            dd.metrics.REJECTED.inc(count, reason='too_many_images')
+            self.set_status(413)
+            self.write({"message": f"At most {max_pending_count} images can be evaluated in one request"})
+            return False
+
+        if not self.admission_controller.try_admit(count):
+            dd.metrics.REJECTED.inc(count, reason='queue_full')
+            self.set_status(429)
+            self.set_header("Retry-After", "1")
+            self.write({"message": "Server is busy, try again later"})
+            return False
+
+        return True
+
+    def get_threshold_and_top_k(self):
+        """
+        (threshold, top_k) of query arguments, or None after responding 400 if they are invalid.
+        """
+        try:
+            threshold = float(self.get_query_argument("threshold", default=self.default_threshold))
+            top_k = self.get_query_argument("top_k", default=None)
+            top_k = int(top_k) if top_k is not None else None
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"message": f"Invalid query argument : {e}"})
+            return None
+
+        if top_k is not None and top_k < 1:
+            self.set_status(400)
+            self.write({"message": "'top_k' must be positive"})
+            return None
+
+        return threshold, top_k
+
+    def get_post_inputs(self):
+        """
+        List of (name, source type, source) of images in request body. Source type is "bytes", "url" or "file".
+        """
+        content_type = self.request.headers.get("Content-Type", "")
+
+        if content_type.startswith("multipart/form-data"):
+            return [(file.filename or field_name, "bytes", file.body)
+                    for field_name, files in self.request.files.items() for file in files]
+        elif content_type.startswith("application/json"):
+            request = json.loads(self.request.body)
+            if isinstance(request, list):
+                request = {"urls": request}
+            if not isinstance(request, dict):
+                raise ValueError("JSON body must be list of urls or object")
+
+            return ([(url, "url", url) for url in request.get("urls", [])]
+                    + [(file, "file", file) for file in request.get("files", [])])
+        elif self.request.body:
+            return [("0", "bytes", self.request.body)]
+        else:
+            return []
+
+    async def evaluate_input(self, served_model, name, source_type, source, threshold, top_k):
+        try:
+            if source_type == "url":
+                data_handle = io.BytesIO(await self.image_fetcher.fetch(source))
+            elif source_type == "bytes":
+                data_handle = io.BytesIO(source)
+            else:
+                data_handle = source
+
+            y = await self.evaluate_image_raw(served_model, data_handle)
+        except Exception as e:
+            # one broken image should not fail the others
+            return {"name": name, "error": str(e)}
+
+        return {"name": name, "matching_tags": self.get_matching_tags(served_model, y, threshold, top_k)}
+
+    def get_matching_tags(self, served_model, y, threshold, top_k):
+        results = []
+
+        indices, scores = select_tags(y[np.newaxis], threshold, top_k)[0]
+        tags_gen = decode_tags(indices, scores, served_model.tags)
+        for (tag, score), index in sorted(zip(tags_gen, indices), key=lambda result: result[0][1], reverse=True):
+            result = {"tag": tag, "confidence": float(score)}
+            if served_model.categories:
+                result["category"] = get_category_name(served_model.categories, index)
+            results.append(result)
+
+        return results
+
+    async def evaluate_image_raw(self, served_model, data_handle):
+        io_loop = tornado.ioloop.IOLoop.current()
+        result_cache = served_model.result_cache
+        key = None
+
+        if result_cache:
+            key = await io_loop.run_in_executor(
+                self.decode_executor, get_image_key, data_handle, result_cache)
+            y = await io_loop.run_in_executor(self.decode_executor, result_cache.get, key)
+            dd.metrics.CACHE_REQUESTS.inc(result='hit' if y is not None else 'miss')
+            if y is not None:
+                return y
+
+        self.check_deadline()
+
+        # decoding and resizing are CPU-bound, keep them off the event loop
+        width = served_model.model.input_shape[2]
+        height = served_model.model.input_shape[1]
+        image = await io_loop.run_in_executor(
+            self.decode_executor, dd.data.load_image_for_evaluate, data_handle, width, height)
+
+        self.check_deadline()
+
+        y = await served_model.batch_predictor.predict(image, self.deadline)
+
+        if key:
+            await io_loop.run_in_executor(self.decode_executor, result_cache.put, key, y)
+
+        return y
+
+    def check_deadline(self):
+        if self.deadline is not None and tornado.ioloop.IOLoop.current().time() > self.deadline:
+            dd.metrics.REJECTED.inc(reason='deadline')
+            raise dd.server.DeadlineExceededError('Request deadline exceeded before evaluation')
+
     def options(self):
-        print("recieved options request")
         # no body
         self.set_status(204)
         self.finish()
 
 
-def make_app(model, tags, default_threshold):
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        """
+        Metrics of this process. With several workers, each scrape reaches one of them, so metrics are per worker.
+        """
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(dd.metrics.REGISTRY.render())
+
+
+class ModelsHandler(tornado.web.RequestHandler):
+    def initialize(self, model_registry, load_model_configs=None, worker_count=1):
+        self.model_registry = model_registry
+        self.load_model_configs = load_model_configs
+        self.worker_count = worker_count
+
+    def get(self, model_name=None):
+        model_infos = self.model_registry.get_model_infos()
+
+        if model_name is None:
+            self.write({"models": model_infos})
+            return
+
+        for model_info in model_infos:
+            if model_info["name"] == model_name:
+                self.write(model_info)
+                return
+
+        self.set_status(404)
+        self.write({"message": f"Model {model_name} is not configured"})
+
+    def post(self, model_name=None):
+        """
+        Load new version of configured model in background. Model config is read again from server options
+        and --models-config file, so a new checkpoint is served by editing the file and posting its name.
+        """
+        if model_name is None:
+            self.set_status(405)
+            return
+
+        if self.load_model_configs is None:
+            self.set_status(403)
+            self.write({"message": "Reloading models is disabled, start server with --allow-model-admin"})
+            return
+
+        if self.worker_count > 1:
+            # the request reaches only one of the workers, others would keep serving the old version
+            self.set_status(409)
+            self.write({"message": "Reloading models by request is not supported with several workers, use --reload-interval"})
+            return
+
+        if self.request.body:
+            self.set_status(400)
+            self.write({"message": "Model config can not be given by request, edit --models-config file instead"})
+            return
+
+        model_config = self.load_model_configs().get(model_name)
+
+        if model_config is None or model_name not in self.model_registry.model_configs:
+            self.set_status(404)
+            self.write({"message": f"Model {model_name} is not configured"})
+            return
+
+        if model_name in self.model_registry.loading_names:
+            self.set_status(409)
+            self.write({"message": f"Model {model_name} is already being loaded"})
+            return
+
+        self.model_registry.start_reload(model_name, model_config)
+
+        self.set_status(202)
+        self.write({"message": f"Loading model {model_name} ..."})
+
+
+def get_image_key(data_handle, result_cache):
+    return result_cache.get_key(dd.data.read_image_bytes(data_handle))
+
+
+def get_category_name(categories, index):
+    start_indices = [category['start_index'] for category in categories]
+
+    return categories[max(bisect_right(start_indices, index) - 1, 0)]['name']
+
+
+def make_app(model_registry, image_fetcher, decode_executor, default_threshold,
+             admission_controller=None, request_timeout=0.0, load_model_configs=None, worker_count=1):
+    """
+    load_model_configs is a function returning current model configs, used for reloading models by
+    POST /models/<name>. Reloading by request is disabled if it is None, and refused if worker_count > 1.
+    """
+    models_options = dict(model_registry=model_registry, load_model_configs=load_model_configs, worker_count=worker_count)
+
     return tornado.web.Application([
         (r"/evaluate", MainHandler, dict(
-            model=model, tags=tags, default_threshold=default_threshold,
+            model_registry=model_registry, image_fetcher=image_fetcher, decode_executor=decode_executor,
+            default_threshold=default_threshold,
+            admission_controller=admission_controller or dd.server.AdmissionController(),
+            request_timeout=request_timeout,
         )),
+        (r"/metrics", MetricsHandler),
+        (r"/models", ModelsHandler, models_options),
+        (r"/models/([^/]+)", ModelsHandler, models_options),
     ])
 
 
+def get_blank_image():
+    stream = io.BytesIO()
+    Image.new('RGB', (8, 8)).save(stream, format='PNG')
+    stream.seek(0)
+
+    return stream
+
+
+def get_categories_path(model_config):
+    """
+    categories.json given by model config, or found in project folder or next to tags file.
+    """
+    if model_config.get('categories_path'):
+        return model_config['categories_path']
+
+    for folder_path in (model_config.get('project_path'), os.path.dirname(model_config.get('tags_path') or '')):
+        if folder_path and os.path.isfile(os.path.join(folder_path, 'categories.json')):
+            return os.path.join(folder_path, 'categories.json')
+
+    return None
+
+
+def load_served_model(name, model_config, version, compile_model, max_batch_size, max_batch_wait_ms,
+                      cache_path, cache_size, verbose):
+    """
+    Load model, tags and categories of model config, and warm it up for serving.
+    """
+    project_path = model_config.get('project_path')
+    model_path = model_config.get('model_path')
+    tags_path = model_config.get('tags_path')
+
+    timings = []
+    started = time.time()
+
+    model, tags = load_model(project_path, model_path, tags_path, compile_model, verbose, model_config.get('precision'))
+    categories_path = get_categories_path(model_config)
+    categories = dd.data.load_categories(categories_path) if categories_path else None
+    timings.append(('load model', time.time() - started))
+
+    started = time.time()
+    result_cache = load_result_cache(
+        cache_path, cache_size, project_path, model_path, tags, verbose, model_config.get('precision'))
+    timings.append(('open cache', time.time() - started))
+
+    batch_predictor = dd.server.BatchPredictor(
+        model, max_batch_size=max_batch_size, max_wait_ms=max_batch_wait_ms)
+
+    started = time.time()
+    batch_predictor.warm_up()
+    with dd.metrics.not_recorded():
+        dd.data.load_image_for_evaluate(get_blank_image(), model.input_shape[2], model.input_shape[1])
+    timings.append(('warm up', time.time() - started))
+
+    if verbose:
+        print(f'Loaded model {name} version {version} in ' + ', '.join(f'{step} {seconds:.2f} s' for step, seconds in timings))
+
+    return dd.server.ServedModel(
+        name, version, model, tags, categories, batch_predictor,
+        result_cache=result_cache, model_path=model_path or dd.project.get_model_path_from_project(project_path))
+
+
 def serve_model(port, project_path, model_path, tags_path,
                 default_threshold, allow_gpu, compile_model,
-                verbose):
+                max_batch_size, max_batch_wait_ms,
+                decode_workers, fetch_connections, fetch_timeout, max_concurrent_fetches, max_image_bytes,
+                max_pending_images, request_timeout,
+                cache_path, cache_size, precision, models_config_path, reload_interval,
+                worker_count, allow_model_admin, verbose, sockets=None):
+    """
+    Serve models on port. With worker_count > 1, sockets must be given by dd.server.start_workers,
+    which forks worker processes before TensorFlow is imported.
+    """
     if not allow_gpu:
         os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
 
-    model, tags = load_model(project_path, model_path, tags_path, compile_model, verbose)
-    app = make_app(model, tags, default_threshold)
-    app.listen(port)
+    started = time.time()
+
+    if worker_count > 1:
+        if sockets is None:
+            raise Exception('Start workers by dd.server.start_workers before serving with several workers.')
+
+        # split cores between workers instead of letting every worker use all of them
+        thread_count = max(1, (os.cpu_count() or 1) // worker_count)
+        tf.config.threading.set_intra_op_parallelism_threads(thread_count)
+        tf.config.threading.set_inter_op_parallelism_threads(thread_count)
+
+        if verbose:
+            print(f'Worker (pid {os.getpid()}) uses {thread_count} threads.')
+    elif sockets is None:
+        sockets = tornado.netutil.bind_sockets(port)
+
+    if verbose:
+        print(f'Batching up to {max_batch_size} images, waiting at most {max_batch_wait_ms} ms ...')
+
+    model_configs = dd.server.load_model_configs(project_path, model_path, tags_path, precision, models_config_path)
+
+    if worker_count > 1:
+        dd.server.check_worker_model_configs(model_configs)
+
+    loader = functools.partial(
+        load_served_model, compile_model=compile_model, max_batch_size=max_batch_size, max_batch_wait_ms=max_batch_wait_ms,
+        cache_path=cache_path, cache_size=cache_size, verbose=verbose)
+    model_registry = dd.server.ModelRegistry(model_configs, loader)
+    model_registry.load_all()
+
+    image_fetcher = dd.server.ImageFetcher(
+        max_connections=fetch_connections, timeout=fetch_timeout,
+        max_concurrent_fetches=max_concurrent_fetches, max_image_bytes=max_image_bytes)
+    decode_executor = ThreadPoolExecutor(max_workers=decode_workers)
+
+    # limits are per worker
+    admission_controller = dd.server.AdmissionController(max_pending_images)
+
+    reload_model_configs = None
+    if allow_model_admin:
+        reload_model_configs = functools.partial(
+            dd.server.load_model_configs, project_path, model_path, tags_path, precision, models_config_path)
+
+    app = make_app(model_registry, image_fetcher, decode_executor, default_threshold,
+                   admission_controller, request_timeout, reload_model_configs, worker_count)
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+
+    if reload_interval > 0:
+        tornado.ioloop.PeriodicCallback(model_registry.check_model_files, reload_interval * 1000.0).start()
+
+    if verbose:
+        print(f'Started in {time.time() - started:.2f} s')
+        print(f'Listening on port {port} ...')
     tornado.ioloop.IOLoop.current().start()
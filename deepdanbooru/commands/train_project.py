@@ -1,5 +1,4 @@
 import os
-import random
 import time
 import datetime
 
@@ -15,6 +14,8 @@ def train_project(project_path):
     width = project_context['image_width']
     height = project_context['image_height']
     database_path = project_context['database_path']
+    shards_path = project_context['shards_path'] if 'shards_path' in project_context else None
+    pre_encode_tags = project_context['pre_encode_tags'] if 'pre_encode_tags' in project_context else False
     pretrained_model_path = project_context['pretrained_model_path']
     reset_pretrained_tag_layers = project_context['reset_pretrained_tag_layers']
     minimum_tag_count = project_context['minimum_tag_count']
@@ -28,6 +29,8 @@ def train_project(project_path):
         'export_model_per_epoch'] if 'export_model_per_epoch' in project_context else 10
     checkpoint_frequency_mb = project_context['checkpoint_frequency_mb']
     console_logging_frequency_mb = project_context['console_logging_frequency_mb']
+    steps_per_execution = project_context['steps_per_execution'] if 'steps_per_execution' in project_context else 1
+    precision = project_context['precision'] if 'precision' in project_context else 'float32'
     rotation_range = project_context['rotation_range']
     scale_range = project_context['scale_range']
     shift_range = project_context['shift_range']
@@ -37,9 +40,11 @@ def train_project(project_path):
     # tf.logging.set_verbosity(tf.logging.ERROR)
 
     # tf.keras.backend.set_epsilon(1e-4)
-    # tf.keras.mixed_precision.experimental.set_policy('infer_float32_vars')
     # tf.config.gpu.set_per_process_memory_growth(True)
 
+    print(f'Using {precision} precision ... ')
+    dd.model.set_precision_policy(precision)
+
     if optimizer_type == 'adam':
         optimizer = tf.optimizers.Adam(learning_rate)
         print('Using Adam optimizer ... ')
@@ -54,6 +59,10 @@ def train_project(project_path):
         raise Exception(
             f"Not supported optimizer : {optimizer_type}")
 
+    if precision == 'mixed_float16':
+        # float16 gradients underflow without loss scaling
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+
     if model_type == 'resnet_152':
         model_delegate = dd.model.resnet.create_resnet_152
     elif model_type == 'resnet_custom_v1':
@@ -78,12 +87,25 @@ def train_project(project_path):
     model = tf.keras.Model(inputs=inputs, outputs=ouputs, name=model_type)
     print(f'Model : {model.input_shape} -> {model.output_shape}')
 
-    model.compile(optimizer=optimizer, loss=dd.model.losses.binary_crossentropy(),
-                  metrics=[tf.keras.metrics.Precision(), tf.keras.metrics.Recall()])
+    loss_function = dd.model.losses.binary_crossentropy()
+    model.compile(optimizer=optimizer, loss=loss_function)
 
-    print(f'Loading database ... ')
-    image_records_orig = dd.data.load_image_records(
-        database_path, minimum_tag_count)
+    loss_metric = tf.keras.metrics.Mean()
+    precision_metric = tf.keras.metrics.Precision()
+    recall_metric = tf.keras.metrics.Recall()
+
+    if shards_path:
+        print(f'Loading shards from {shards_path} ... ')
+        shard_dataset_wrapper = dd.data.ShardDatasetWrapper(
+            shards_path, tags, width, height, scale_range=scale_range, rotation_range=rotation_range, shift_range=shift_range)
+        epoch_size = shard_dataset_wrapper.record_count
+    else:
+        print(f'Loading database ... ')
+        image_records = dd.data.load_image_records(
+            database_path, minimum_tag_count, tag_encoder=dd.data.TagEncoder(tags) if pre_encode_tags else None)
+        epoch_size = len(image_records)
+        dataset_wrapper = dd.data.DatasetWrapper(
+            image_records, tags, width, height, scale_range=scale_range, rotation_range=rotation_range, shift_range=shift_range)
 
     # Checkpoint variables
     used_epoch = tf.Variable(0, dtype=tf.int64)
@@ -129,19 +151,19 @@ def train_project(project_path):
     else:
         print('No checkpoint. Starting new training ...')
 
-    epoch_size = len(image_records_orig)
-    slice_size = minibatch_size * checkpoint_frequency_mb
-    loss_sum = 0.0
-    loss_count = 0
-    used_sample_sum = 0
+    checkpoint_callback = dd.train.CheckpointCallback(
+        manager, checkpoint_frequency_mb)
+    train_function = dd.train.create_train_function(
+        model, optimizer, loss_function, loss_metric, [precision_metric, recall_metric],
+        used_minibatch=used_minibatch, used_sample=used_sample, offset=offset)
+    last_used_sample = int(used_sample)
     last_time = time.time()
 
     while int(used_epoch) < epoch_count:
-        print(f'Shuffling samples (epoch {int(used_epoch)}) ... ')
-        # need to copy image_records so shuffle doesn't compose over itself
-        image_records = image_records_orig.copy()
-        epoch_random = random.Random(int(random_seed))
-        epoch_random.shuffle(image_records)
+        if not shards_path:
+            print(f'Shuffling samples (epoch {int(used_epoch)}) ... ')
+            # only record indices are shuffled, records themselves are never copied
+            record_indices = image_records.get_permutation(int(random_seed))
 
         # Udpate learning rate
         if learning_rates:
@@ -152,70 +174,58 @@ def train_project(project_path):
         optimizer.learning_rate.assign(learning_rate)
         print(f'Learning rate is changed to {optimizer.learning_rate} ...')
 
-        while int(offset) < epoch_size:
-            image_records_slice = image_records[int(offset):min(
-                int(offset) + slice_size, epoch_size)]
-
-            image_paths = [image_record[0]
-                           for image_record in image_records_slice]
-            tag_strings = [image_record[1]
-                          for image_record in image_records_slice]
-
-            dataset_wrapper = dd.data.DatasetWrapper(
-                (image_paths, tag_strings), tags, width, height, scale_range=scale_range, rotation_range=rotation_range, shift_range=shift_range)
-            dataset = dataset_wrapper.get_dataset(minibatch_size)
-
-            for (x_train, y_train) in dataset:
-                sample_count = x_train.shape[0]
-
-                step_result = model.train_on_batch(
-                    x_train, y_train, reset_metrics=False)
-
-                used_minibatch.assign_add(1)
-                used_sample.assign_add(sample_count)
-                used_sample_sum += sample_count
-                loss_sum += step_result[0]
-                loss_count += 1
-
-                if int(used_minibatch) % console_logging_frequency_mb == 0:
-                    # calculate logging informations
-                    current_time = time.time()
-                    delta_time = current_time - last_time
-                    step_metric_precision = step_result[1]
-                    step_metric_recall = step_result[2]
-                    if step_metric_precision + step_metric_recall > 0.0:
-                        step_metric_f1_score = 2.0 * \
-                            (step_metric_precision * step_metric_recall) / \
-                            (step_metric_precision + step_metric_recall)
-                    else:
-                        step_metric_f1_score = 0.0
-                    average_loss = loss_sum / float(loss_count)
-                    samples_per_seconds = float(
-                        used_sample_sum) / max(delta_time, 0.001)
-                    progress = float(int(used_sample)) / \
-                        float(epoch_size * epoch_count) * 100.0
-                    remain_seconds = float(
-                        epoch_size * epoch_count - int(used_sample)) / max(samples_per_seconds, 0.001)
-                    eta_datetime = datetime.datetime.now() + datetime.timedelta(seconds=remain_seconds)
-                    eta_datetime_string = eta_datetime.strftime(
-                        '%Y-%m-%d %H:%M:%S')
-                    print(
-                        f'Epoch[{int(used_epoch)}] Loss={average_loss:.6f}, P={step_metric_precision:.6f}, R={step_metric_recall:.6f}, F1={step_metric_f1_score:.6f}, Speed = {samples_per_seconds:.1f} samples/s, {progress:.2f} %, ETA = {eta_datetime_string}')
-
-                    # reset for next logging
-                    model.reset_metrics()
-                    loss_sum = 0.0
-                    loss_count = 0
-                    used_sample_sum = 0
-                    last_time = current_time
-
-            offset.assign_add(slice_size)
-            print('Saving checkpoint ... ')
-            manager.save()
+        # one input pipeline for whole epoch, resumed from offset
+        if shards_path:
+            dataset = shard_dataset_wrapper.get_dataset(
+                minibatch_size, random_seed=int(random_seed), offset=int(offset), with_offset=True)
+        else:
+            dataset = dataset_wrapper.get_dataset(
+                minibatch_size, offset=int(offset), with_offset=True, indices=record_indices)
+
+        iterator = iter(dataset)
+        minibatch_counts = dd.train.run_train_function(
+            train_function, iterator, int(used_minibatch), steps_per_execution,
+            [console_logging_frequency_mb, checkpoint_frequency_mb])
+
+        for minibatch_count in minibatch_counts:
+            if minibatch_count % console_logging_frequency_mb == 0:
+                # calculate logging informations
+                current_time = time.time()
+                delta_time = current_time - last_time
+                current_used_sample = int(used_sample)
+                step_metric_precision = float(precision_metric.result())
+                step_metric_recall = float(recall_metric.result())
+                if step_metric_precision + step_metric_recall > 0.0:
+                    step_metric_f1_score = 2.0 * \
+                        (step_metric_precision * step_metric_recall) / \
+                        (step_metric_precision + step_metric_recall)
+                else:
+                    step_metric_f1_score = 0.0
+                average_loss = float(loss_metric.result())
+                samples_per_seconds = float(
+                    current_used_sample - last_used_sample) / max(delta_time, 0.001)
+                progress = float(current_used_sample) / \
+                    float(epoch_size * epoch_count) * 100.0
+                remain_seconds = float(
+                    epoch_size * epoch_count - current_used_sample) / max(samples_per_seconds, 0.001)
+                eta_datetime = datetime.datetime.now() + datetime.timedelta(seconds=remain_seconds)
+                eta_datetime_string = eta_datetime.strftime(
+                    '%Y-%m-%d %H:%M:%S')
+                print(
+                    f'Epoch[{int(used_epoch)}] Loss={average_loss:.6f}, P={step_metric_precision:.6f}, R={step_metric_recall:.6f}, F1={step_metric_f1_score:.6f}, Speed = {samples_per_seconds:.1f} samples/s, {progress:.2f} %, ETA = {eta_datetime_string}')
+
+                # reset for next logging
+                for metric in [loss_metric, precision_metric, recall_metric]:
+                    metric.reset_state()
+                last_used_sample = current_used_sample
+                last_time = current_time
+
+            checkpoint_callback.on_minibatch_end(minibatch_count)
 
         used_epoch.assign_add(1)
         random_seed.assign_add(1)
         offset.assign(0)
+        checkpoint_callback.on_epoch_end()
 
         if int(used_epoch) % export_model_per_epoch == 0:
             print('Saving model ... (per epoch {export_model_per_epoch})')
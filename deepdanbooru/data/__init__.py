@@ -1,29 +1,114 @@
-from typing import Any, Union
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterable, Iterator, List, Tuple, Union
 
+import numpy as np
 import six
 import tensorflow as tf
 
 import deepdanbooru as dd
 
-from .dataset import load_image_records, load_tags
+from .dataset import load_image_records, load_tags, load_categories, load_tag_counts
+from .image_records import ImageRecords
+from .tag_encoder import TagEncoder
 from .dataset_wrapper import DatasetWrapper
+from .shards import ShardDatasetWrapper, load_shards_metadata, write_training_shards
+from .result_cache import ResultCache, create_model_fingerprint
 
 
 def load_image_for_evaluate(
         input_: Union[str, six.BytesIO], width: int, height: int, normalize: bool = True
 ) -> Any:
-    if isinstance(input_, six.BytesIO):
-        image_raw = input_.getvalue()
-    else:
-        image_raw = tf.io.read_file(input_)
-    image = tf.io.decode_png(image_raw, channels=3)
+    with dd.metrics.time_stage('decode'):
+        if isinstance(input_, six.BytesIO):
+            image_raw = input_.getvalue()
+        else:
+            image_raw = tf.io.read_file(input_)
+        image = tf.io.decode_png(image_raw, channels=3)
 
-    image = tf.image.resize(
-        image, size=(height, width), method=tf.image.ResizeMethod.AREA, preserve_aspect_ratio=True)
-    image = image.numpy()  # EagerTensor to np.array
-    image = dd.image.transform_and_pad_image(image, width, height)
+    with dd.metrics.time_stage('resize'):
+        image = tf.image.resize(
+            image, size=(height, width), method=tf.image.ResizeMethod.AREA, preserve_aspect_ratio=True)
+        image = image.numpy()  # EagerTensor to np.array
+        image = dd.image.transform_and_pad_image(image, width, height)
 
     if normalize:
         image = image / 255.0
 
     return image
+
+
+def read_image_bytes(input_: Union[str, six.BytesIO]) -> bytes:
+    with dd.metrics.time_stage('read'):
+        if isinstance(input_, six.BytesIO):
+            return input_.getvalue()
+
+        with open(input_, 'rb') as stream:
+            return stream.read()
+
+
+def load_image_or_cached_scores(input_: Union[str, six.BytesIO], width: int, height: int, result_cache) -> Tuple[str, Any, Any]:
+    """
+    (key, cached scores, None) if input is found in result_cache, or (key, None, image).
+    Image bytes are read once, for both key and decoding.
+    """
+    image_raw = read_image_bytes(input_)
+    key = result_cache.get_key(image_raw)
+    y = result_cache.get(key)
+    dd.metrics.CACHE_REQUESTS.inc(result='hit' if y is not None else 'miss')
+
+    if y is not None:
+        return key, y, None
+
+    return key, None, load_image_for_evaluate(six.BytesIO(image_raw), width, height)
+
+
+def load_image_batches_for_evaluate(
+        inputs: Iterable[Union[str, six.BytesIO]], width: int, height: int, batch_size: int,
+        worker_count: int = 4, prefetch_batch_count: int = 2, result_cache=None
+) -> Iterator[Tuple[Any, ...]]:
+    """
+    Decode and resize images on worker threads and yield (inputs, images) batches in input order.
+    Up to prefetch_batch_count batches are prepared while the caller consumes the current one.
+
+    If result_cache is given, yield (inputs, images, keys, cached_ys) instead. Inputs found in the cache
+    are not decoded, their scores are in cached_ys, and images has only images of the other inputs
+    (None if all inputs of the batch are cached).
+    """
+    max_pending_count = batch_size * (prefetch_batch_count + 1)
+    pending = collections.deque()  # type: ignore
+    inputs_iterator = iter(inputs)
+
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        def fill_pending():
+            while len(pending) < max_pending_count:
+                input_ = next(inputs_iterator, None)
+                if input_ is None:
+                    break
+                if result_cache:
+                    future = executor.submit(load_image_or_cached_scores, input_, width, height, result_cache)
+                else:
+                    future = executor.submit(load_image_for_evaluate, input_, width, height)
+                pending.append((input_, future))
+
+        fill_pending()
+
+        while pending:
+            batch_inputs = []
+            batch_images = []
+
+            while pending and len(batch_inputs) < batch_size:
+                input_, future = pending.popleft()
+                batch_inputs.append(input_)
+                batch_images.append(future.result())
+
+            fill_pending()
+
+            if not result_cache:
+                yield batch_inputs, np.stack(batch_images)
+                continue
+
+            keys, cached_ys, images = zip(*batch_images)
+            images = [image for image in images if image is not None]
+
+            yield batch_inputs, np.stack(images) if images else None, list(keys), list(cached_ys)
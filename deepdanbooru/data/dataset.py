@@ -1,6 +1,12 @@
+import itertools
+import json
 import os
 import sqlite3
 
+from .image_records import ImageRecords
+
+TRAINING_POSTS_CONDITION = "extension IN ('png', 'jpg', 'jpeg') AND tag_count_general >= ?"
+
 
 def load_tags(tags_path):
     with open(tags_path, 'r') as tags_stream:
@@ -8,39 +14,118 @@ def load_tags(tags_path):
         return tags
 
 
-def load_image_records(sqlite_path, minimum_tag_count):
+def load_categories(categories_path):
+    """
+    Load tag categories as list of {"name": ..., "start_index": ...} sorted by start index.
+    Tags from start index to start index of next category belong to the category.
+    """
+    with open(categories_path, 'r') as categories_stream:
+        categories = json.load(categories_stream)
+
+    return sorted(categories, key=lambda category: category['start_index'])
+
+
+def load_image_records(sqlite_path, minimum_tag_count, tag_encoder=None, fetch_size=10000):
+    """
+    Load (image_path, tag_string, download_url) of images for training as ImageRecords.
+    Rows are streamed from the database and stored column-wise, so memory stays proportional to the
+    size of values instead of the number of Python objects.
+    If tag_encoder is given, tag strings are pre-encoded as arrays of tag indices.
+    """
     if not os.path.exists(sqlite_path):
         raise Exception(f'SQLite database is not exists : {sqlite_path}')
 
-    try:
-        connection = sqlite3.connect(sqlite_path)
-    except Exception as e:
-        import pdb; pdb.set_trace()
-        pass
-    connection.row_factory = sqlite3.Row
-    cursor = connection.cursor()
-
+    connection = sqlite3.connect(sqlite_path)
     image_folder_path = os.path.join(os.path.dirname(sqlite_path), 'images')
 
-    cursor.execute(
-        "SELECT foldername, filename, extension, tag_string, download_url FROM posts WHERE (extension = 'png' OR extension = 'jpg' OR extension = 'jpeg') AND (tag_count_general >= ?) ORDER BY id",
+    if has_table(connection, 'post_tags'):
+        image_records = load_normalized_image_records(
+            connection, image_folder_path, minimum_tag_count, tag_encoder, fetch_size)
+    else:
+        # database made by older version, which has tag strings only
+        image_records = ImageRecords(image_folder_path, tag_encoder=tag_encoder)
+
+        cursor = connection.execute(
+            f"SELECT foldername, filename, extension, tag_string, download_url FROM posts WHERE {TRAINING_POSTS_CONDITION} ORDER BY id",
+            (minimum_tag_count,))
+
+        for foldername, filename, extension, tag_string, download_url in iterate_rows(cursor, fetch_size):
+            image_records.append(foldername, filename, extension, tag_string, download_url)
+
+    connection.close()
+
+    return image_records
+
+
+def load_normalized_image_records(connection, image_folder_path, minimum_tag_count, tag_encoder, fetch_size):
+    """
+    Load image records from posts and post_tags tables. Posts are filtered by covering index,
+    and tags are read as ids, so no tag string is parsed.
+    """
+    tag_rows = connection.execute('SELECT id, name FROM tags ORDER BY id').fetchall()
+    tag_id_to_index = [-1] * ((tag_rows[-1][0] + 1) if tag_rows else 0)
+
+    if tag_encoder:
+        image_records = ImageRecords(image_folder_path, tag_encoder=tag_encoder)
+        for tag_id, name in tag_rows:
+            tag_id_to_index[tag_id] = tag_encoder.tag_to_index.get(name, -1)
+    else:
+        image_records = ImageRecords(image_folder_path, vocabulary=[name for _, name in tag_rows])
+        for index, (tag_id, _) in enumerate(tag_rows):
+            tag_id_to_index[tag_id] = index
+
+    post_cursor = connection.execute(
+        f"SELECT id, foldername, filename, extension, download_url FROM posts WHERE {TRAINING_POSTS_CONDITION} ORDER BY id",
         (minimum_tag_count,))
+    post_tag_cursor = connection.execute('SELECT post_id, tag_id FROM post_tags ORDER BY post_id')
 
-    rows = cursor.fetchall()
+    # both are ordered by post id, so tags of posts are merged in one pass
+    post_tag_groups = itertools.groupby(iterate_rows(post_tag_cursor, fetch_size), key=lambda row: row[0])
+    tag_post_id, post_tag_rows = next(post_tag_groups, (None, ()))
 
-    image_records = []
+    for post_id, foldername, filename, extension, download_url in iterate_rows(post_cursor, fetch_size):
+        while tag_post_id is not None and tag_post_id < post_id:
+            tag_post_id, post_tag_rows = next(post_tag_groups, (None, ()))
 
-    for row in rows:
-        foldername = row['foldername']
-        filename = row['filename']
-        extension = row['extension']
-        image_path = os.path.join(
-            image_folder_path, foldername, f'{filename}.{extension}')
-        tag_string = row['tag_string']
-        download_url = row['download_url']
+        tag_indices = []
+        if tag_post_id == post_id:
+            tag_indices = [tag_id_to_index[tag_id] for _, tag_id in post_tag_rows]
+            tag_indices = [index for index in tag_indices if index >= 0]
 
-        image_records.append((image_path, tag_string, download_url))
+        if tag_encoder:
+            tag_indices = sorted(set(tag_indices))
 
-    connection.close()
+        image_records.append_tag_indices(foldername, filename, extension, tag_indices, download_url)
 
     return image_records
+
+
+def load_tag_counts(sqlite_path, minimum_post_count=0):
+    """
+    (tag, post count) of tags in the database made by make-training-database, sorted by post count.
+    """
+    if not os.path.exists(sqlite_path):
+        raise Exception(f'SQLite database is not exists : {sqlite_path}')
+
+    connection = sqlite3.connect(sqlite_path)
+
+    if not has_table(connection, 'tags'):
+        connection.close()
+        raise Exception(f'There is no tags table in {sqlite_path}. Make database again with make-training-database.')
+
+    tag_counts = connection.execute(
+        'SELECT name, post_count FROM tags WHERE post_count >= ? ORDER BY post_count DESC, name',
+        (minimum_post_count,)).fetchall()
+    connection.close()
+
+    return tag_counts
+
+
+def has_table(connection, table_name):
+    return connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)).fetchone() is not None
+
+
+def iterate_rows(cursor, fetch_size):
+    while rows := cursor.fetchmany(fetch_size):
+        yield from rows
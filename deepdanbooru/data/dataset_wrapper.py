@@ -1,5 +1,3 @@
-import random
-
 import numpy as np
 import tensorflow as tf
 
@@ -12,72 +10,123 @@ class DatasetWrapper:
     """
 
     def __init__(self, inputs, tags, width, height, scale_range, rotation_range, shift_range):
+        """
+        inputs is ImageRecords, or (image_paths, tag_inputs) where tag inputs are tag strings or arrays of tag indices.
+        """
         self.inputs = inputs
+        self.tags = tags
+        self.input_tensors = None
         self.width = width
         self.height = height
         self.scale_range = scale_range
         self.rotation_range = rotation_range
         self.shift_range = shift_range
-        self.tag_all_array = np.array(tags)
-
-    def get_dataset(self, minibatch_size):
-        dataset = tf.data.Dataset.from_tensor_slices(self.inputs)
+        self.tag_encoder = dd.data.TagEncoder(tags)
+
+    def get_dataset(self, minibatch_size, offset=0, with_offset=False, indices=None):
+        """
+        Dataset of (images, labels) batches. The first offset records are skipped.
+        If with_offset is True, batches also contain offsets of the record after each sample, for resuming.
+        If indices is given, records are read in the order of indices, e.g. shuffled permutation.
+        """
+        input_tensors = self.get_input_tensors()
+
+        if indices is None:
+            dataset = tf.data.Dataset.from_tensor_slices(input_tensors)
+        else:
+            dataset = tf.data.Dataset.from_tensor_slices(np.asarray(indices, dtype=np.int64))
+            dataset = dataset.map(
+                lambda index: tuple(tf.gather(tensor, index) for tensor in input_tensors))
+        dataset = dataset.enumerate()
+        dataset = dataset.skip(offset)
         dataset = dataset.map(
-            self.map_load_image, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+            lambda index, inputs: (self.map_load_image(*inputs), index + 1), num_parallel_calls=tf.data.experimental.AUTOTUNE)
         dataset = dataset.apply(tf.data.experimental.ignore_errors())
         dataset = dataset.map(
-            self.map_transform_image_and_label, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-        dataset = dataset.batch(minibatch_size)
-        dataset = dataset.prefetch(
-            buffer_size=tf.data.experimental.AUTOTUNE)
-        # dataset = dataset.apply(
-        #    tf.data.experimental.prefetch_to_device('/device:GPU:0'))
+            lambda inputs, next_offset: (*self.map_transform_image_and_label(*inputs), next_offset), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+        return batch_dataset(dataset, minibatch_size, with_offset)
+
+    def get_input_tensors(self):
+        """
+        Tensors of (image_paths, tag_strings), or (image_paths, tag_indices) if records are pre-encoded.
+        Tags of ImageRecords are always given as tag indices. Tensors are built once and reused by every epoch.
+        """
+        if self.input_tensors is not None:
+            return self.input_tensors
+
+        if isinstance(self.inputs, dd.data.ImageRecords):
+            row_splits, tag_indices = self.inputs.get_label_indices(self.tags)
+            self.input_tensors = (
+                tf.constant(self.inputs.get_image_paths(), dtype=tf.string),
+                tf.RaggedTensor.from_row_splits(tag_indices, row_splits))
 
-        return dataset
+            return self.input_tensors
+
+        image_paths, tag_inputs = self.inputs
+
+        if len(tag_inputs) > 0 and not isinstance(tag_inputs[0], str):
+            tag_inputs = tf.RaggedTensor.from_row_lengths(
+                np.concatenate(tag_inputs).astype(np.int32), [len(tag_indices) for tag_indices in tag_inputs])
+
+        self.input_tensors = (image_paths, tag_inputs)
+
+        return self.input_tensors
 
     def map_load_image(self, image_path, tag_string):
         image_raw = tf.io.read_file(image_path)
         image = tf.io.decode_png(image_raw, channels=3)
 
+        image = tf.image.resize(
+            image, size=self.get_load_size(), method=tf.image.ResizeMethod.AREA, preserve_aspect_ratio=True)
+
+        return (image, tag_string)
+
+    def get_load_size(self):
+        """
+        Size of loaded image before transform. Larger than target size by maximum scale.
+        """
         if self.scale_range:
             pre_scale = self.scale_range[1]
         else:
             pre_scale = 1.0
 
-        size = (int(self.height * pre_scale), int(self.width * pre_scale))
+        return (int(self.height * pre_scale), int(self.width * pre_scale))
 
-        image = tf.image.resize(
-            image, size=size, method=tf.image.ResizeMethod.AREA, preserve_aspect_ratio=True)
+    def map_transform_image_and_label(self, image, tag_string):
+        image = self.transform_image(image)
 
-        return (image, tag_string)
+        if tag_string.dtype == tf.string:
+            labels = self.tag_encoder.map_labels(tag_string)
+        else:
+            labels = self.tag_encoder.map_labels_from_indices(tag_string)
 
-    def map_transform_image_and_label(self, image, tag_string):
-        return tf.py_function(self.map_transform_image_and_label_py, (image, tag_string), (tf.float32, tf.float32))
+        return (image, labels)
 
-    def map_transform_image_and_label_py(self, image, tag_string):
-        # transform image
-        image = image.numpy()
+    def map_transform_image(self, image, labels):
+        return (self.transform_image(image), labels)
 
+    def transform_image(self, image):
         if self.scale_range:
-            scale = random.uniform(
-                self.scale_range[0], self.scale_range[1]) * (1.0 / self.scale_range[1])
+            scale = tf.random.uniform(
+                [], self.scale_range[0], self.scale_range[1]) * (1.0 / self.scale_range[1])
         else:
             scale = None
 
         if self.rotation_range:
-            rotation = random.uniform(
-                self.rotation_range[0], self.rotation_range[1])
+            rotation = tf.random.uniform(
+                [], self.rotation_range[0], self.rotation_range[1])
         else:
             rotation = None
 
         if self.shift_range:
-            shift_x = random.uniform(self.shift_range[0], self.shift_range[1])
-            shift_y = random.uniform(self.shift_range[0], self.shift_range[1])
+            shift_x = tf.random.uniform([], self.shift_range[0], self.shift_range[1])
+            shift_y = tf.random.uniform([], self.shift_range[0], self.shift_range[1])
             shift = (shift_x, shift_y)
         else:
             shift = None
 
-        image = dd.image.transform_and_pad_image(
+        image = dd.image.transform_and_pad_image_tf(
             image=image,
             target_width=self.width,
             target_height=self.height,
@@ -86,13 +135,18 @@ class DatasetWrapper:
             shift=shift)
 
         image = image / 255.0  # normalize to 0~1
-        # image = image.astype(np.float32)
 
-        # transform tag
-        tag_string = tag_string.numpy().decode()
-        tag_array = np.array(tag_string.split(','))
+        return image
 
-        labels = np.where(np.isin(self.tag_all_array,
-                                  tag_array), 1, 0).astype(np.float32)
 
-        return (image, labels)
+def batch_dataset(dataset, minibatch_size, with_offset):
+    if not with_offset:
+        dataset = dataset.map(lambda image, labels, next_offset: (image, labels))
+
+    dataset = dataset.batch(minibatch_size)
+    dataset = dataset.prefetch(
+        buffer_size=tf.data.experimental.AUTOTUNE)
+    # dataset = dataset.apply(
+    #    tf.data.experimental.prefetch_to_device('/device:GPU:0'))
+
+    return dataset
@@ -0,0 +1,174 @@
+import os
+from array import array
+
+import numpy as np
+
+
+class StringColumn:
+    """
+    Strings stored in one UTF-8 buffer with offsets, instead of one Python object per row.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offsets = array('q', [0])
+
+    def append(self, value):
+        self.buffer.extend(value.encode('utf-8'))
+        self.offsets.append(len(self.buffer))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.buffer[self.offsets[index]:self.offsets[index + 1]].decode('utf-8')
+
+
+class InternedColumn:
+    """
+    Values with few distinct values (folder names, extensions), stored as indices of distinct values.
+    """
+
+    def __init__(self, values=None, typecode='i'):
+        self.values = list(values or [])
+        self.value_to_index = {value: index for index, value in enumerate(self.values)}
+        self.indices = array(typecode)
+
+    def intern(self, value):
+        index = self.value_to_index.get(value)
+
+        if index is None:
+            index = len(self.values)
+            self.values.append(value)
+            self.value_to_index[value] = index
+
+        return index
+
+    def append(self, value):
+        self.indices.append(self.intern(value))
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        return self.values[self.indices[index]]
+
+
+class ImageRecords:
+    """
+    Memory-compact image records for training, stored column-wise.
+
+    Tags are stored in CSR layout (row offsets and tag indices of a vocabulary), so a record costs
+    a few integers and bytes instead of Python tuple and strings. Rows are (image_path, tags, download_url)
+    built on access, where tags is tag string, or sorted array of tag indices if records are pre-encoded
+    by tag_encoder. Shuffle records by permutation of indices from get_permutation().
+    """
+
+    def __init__(self, image_folder_path, tag_encoder=None, delimiter=',', vocabulary=None):
+        self.image_folder_path = image_folder_path
+        self.tag_encoder = tag_encoder
+        self.delimiter = tag_encoder.delimiter if tag_encoder else delimiter
+
+        self.foldernames = InternedColumn()
+        self.filenames = StringColumn()
+        self.extensions = InternedColumn(typecode='b')
+        self.download_urls = StringColumn()
+        self.has_download_urls = array('b')
+        self.vocabulary = InternedColumn(tag_encoder.tags if tag_encoder else vocabulary)
+        self.tag_offsets = array('q', [0])
+
+    @property
+    def is_pre_encoded(self):
+        return self.tag_encoder is not None
+
+    def append(self, foldername, filename, extension, tag_string, download_url):
+        if self.tag_encoder:
+            tag_indices = self.tag_encoder.encode(tag_string or '')
+        else:
+            tag_indices = [self.vocabulary.intern(tag) for tag in (tag_string or '').split(self.delimiter)]
+
+        self.append_tag_indices(foldername, filename, extension, tag_indices, download_url)
+
+    def append_tag_indices(self, foldername, filename, extension, tag_indices, download_url):
+        """
+        Append record whose tags are already given as indices of vocabulary.
+        """
+        self.foldernames.append(foldername)
+        self.filenames.append(filename)
+        self.extensions.append(extension)
+        self.download_urls.append(download_url or '')
+        self.has_download_urls.append(download_url is not None)
+        self.vocabulary.indices.extend(tag_indices)
+        self.tag_offsets.append(len(self.vocabulary.indices))
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, index):
+        index = self.check_index(index)
+
+        return (self.get_image_path(index), self.get_tags(index), self.get_download_url(index))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def check_index(self, index):
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError(f'Record index out of range : {index}')
+
+        return index
+
+    def get_image_path(self, index):
+        return os.path.join(
+            self.image_folder_path, self.foldernames[index], f'{self.filenames[index]}.{self.extensions[index]}')
+
+    def get_image_paths(self, indices=None):
+        return [self.get_image_path(index) for index in (range(len(self)) if indices is None else indices)]
+
+    def get_tag_indices(self, index):
+        """
+        Indices of tags of record in vocabulary.
+        """
+        return np.frombuffer(self.vocabulary.indices, dtype=np.int32)[self.tag_offsets[index]:self.tag_offsets[index + 1]]
+
+    def get_tags(self, index):
+        tag_indices = self.get_tag_indices(index)
+
+        if self.is_pre_encoded:
+            return tag_indices.copy()
+
+        return self.delimiter.join(self.vocabulary.values[tag_index] for tag_index in tag_indices)
+
+    def get_download_url(self, index):
+        return self.download_urls[index] if self.has_download_urls[index] else None
+
+    def get_permutation(self, random_seed):
+        """
+        Shuffled record indices. Same seed always gives the same order.
+        """
+        return np.random.RandomState(random_seed % 2 ** 32).permutation(len(self))
+
+    def get_label_indices(self, tags):
+        """
+        (row_splits, values) of indices in tags of tags of all records, for building ragged tensor.
+        Tags which are not in tags are dropped.
+        """
+        row_splits = np.frombuffer(self.tag_offsets, dtype=np.int64)
+        values = np.frombuffer(self.vocabulary.indices, dtype=np.int32)
+
+        if list(tags) == self.vocabulary.values:
+            return row_splits, values
+
+        tag_to_index = {tag: index for index, tag in enumerate(tags)}
+        vocabulary_to_index = np.array(
+            [tag_to_index.get(tag, -1) for tag in self.vocabulary.values] or [-1], dtype=np.int32)
+
+        values = vocabulary_to_index[values]
+        is_known = values >= 0
+        known_counts = np.concatenate([[0], np.cumsum(is_known, dtype=np.int64)])
+
+        return known_counts[row_splits], values[is_known]
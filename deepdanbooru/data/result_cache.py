@@ -0,0 +1,132 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+def create_model_fingerprint(model_path, tags, precision=None):
+    """
+    Create fingerprint from model file contents, tag list and compute precision.
+    """
+    digest = hashlib.sha256()
+
+    with open(model_path, 'rb') as model_stream:
+        for chunk in iter(lambda: model_stream.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+    digest.update('\n'.join(tags).encode('utf-8'))
+
+    if precision:
+        digest.update(f'\nprecision={precision}'.encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Persistent cache of raw model outputs, keyed by image contents and model fingerprint.
+    Least recently used entries are evicted when max_entries is exceeded.
+    Several processes can share one file. If it stays locked by another process, lookups miss and
+    results are not stored, instead of failing the evaluation.
+    """
+
+    def __init__(self, path, fingerprint, max_entries=100000, lock_timeout=5.0):
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=lock_timeout, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS results (key TEXT NOT NULL PRIMARY KEY, scores BLOB NOT NULL, last_used REAL NOT NULL)')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+        self.connection.commit()
+        # counts own inserts only, so it is checked against the table before evicting
+        self.entry_count = self.count_entries()
+
+    def get_key(self, image_bytes):
+        digest = hashlib.sha256(self.fingerprint.encode('ascii'))
+        digest.update(image_bytes)
+
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Return cached scores for key, or None.
+        """
+        row = None
+
+        with self.lock:
+            try:
+                row = self.connection.execute(
+                    'SELECT scores FROM results WHERE key = ?', (key,)).fetchone()
+
+                if row is None:
+                    return None
+
+                self.connection.execute(
+                    'UPDATE results SET last_used = ? WHERE key = ?', (time.time(), key))
+                self.connection.commit()
+            except sqlite3.OperationalError as error:
+                self.rollback(error)
+
+                if row is None:
+                    return None
+
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def contains(self, key):
+        with self.lock:
+            try:
+                return self.connection.execute(
+                    'SELECT 1 FROM results WHERE key = ?', (key,)).fetchone() is not None
+            except sqlite3.OperationalError as error:
+                self.rollback(error)
+                return False
+
+    def put(self, key, y):
+        scores = np.asarray(y, dtype=np.float32).tobytes()
+
+        with self.lock:
+            try:
+                cursor = self.connection.execute(
+                    'INSERT OR IGNORE INTO results (key, scores, last_used) VALUES (?, ?, ?)', (key, scores, time.time()))
+
+                self.entry_count += cursor.rowcount
+
+                if self.entry_count > self.max_entries:
+                    # other connections may share the file, count rows before evicting
+                    entry_count = self.count_entries()
+
+                    if entry_count > self.max_entries:
+                        # evict a little more than needed, so rows are not counted again on every insert
+                        evict_count = entry_count - self.max_entries + self.max_entries // 100
+                        self.connection.execute(
+                            'DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)',
+                            (evict_count,))
+                        entry_count -= evict_count
+
+                    self.entry_count = entry_count
+
+                self.connection.commit()
+            except sqlite3.OperationalError as error:
+                self.rollback(error)
+
+    def count_entries(self):
+        return self.connection.execute('SELECT count(*) FROM results').fetchone()[0]
+
+    def rollback(self, error):
+        """
+        Give up the current statement if the file is locked by another connection, re-raise other errors.
+        """
+        if 'locked' not in str(error) and 'busy' not in str(error):
+            raise error
+
+        self.connection.rollback()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
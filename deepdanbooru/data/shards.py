@@ -0,0 +1,168 @@
+import hashlib
+import os
+import random
+
+import numpy as np
+import tensorflow as tf
+
+import deepdanbooru as dd
+
+from .dataset_wrapper import DatasetWrapper, batch_dataset
+from .image_records import ImageRecords
+
+SHARDS_METADATA_FILE_NAME = 'shards.json'
+
+
+def get_tags_hash(tags):
+    return hashlib.sha256('\n'.join(tags).encode('utf-8')).hexdigest()
+
+
+def load_shards_metadata(shards_path):
+    metadata_path = os.path.join(shards_path, SHARDS_METADATA_FILE_NAME)
+
+    if not os.path.exists(metadata_path):
+        raise Exception(f'Shards metadata is not exists : {metadata_path}')
+
+    return dd.io.deserialize_from_json(metadata_path)
+
+
+def write_training_shards(image_records, tags, shards_path, width, height, scale_range, shard_size, image_format='raw'):
+    """
+    Load, resize and write image records as TFRecord shards.
+    Each record contains uint8 image pre-resized by DatasetWrapper.map_load_image and indices of its tags.
+    Tags of image_records may be tag strings or pre-encoded tag indices.
+    """
+    if image_format not in ['raw', 'png']:
+        raise Exception(f'Not supported image format : {image_format}')
+
+    dd.io.try_create_directory(shards_path)
+
+    if not isinstance(image_records, ImageRecords):
+        image_records = ([record[0] for record in image_records], [record[1] for record in image_records])
+
+    dataset_wrapper = DatasetWrapper(
+        image_records, tags, width, height, scale_range=scale_range, rotation_range=None, shift_range=None)
+
+    dataset = tf.data.Dataset.from_tensor_slices(dataset_wrapper.get_input_tensors())
+    dataset = dataset.map(
+        dataset_wrapper.map_load_image, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.apply(tf.data.experimental.ignore_errors())
+    dataset = dataset.map(
+        lambda image, tag_string: (tf.cast(tf.clip_by_value(tf.round(image), 0.0, 255.0), tf.uint8), tag_string),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+
+    shard_file_names = []
+    record_count = 0
+    writer = None
+
+    for image, tag_string in dataset:
+        if record_count % shard_size == 0:
+            if writer:
+                writer.close()
+            shard_file_name = f'shard-{len(shard_file_names):05d}.tfrecord'
+            shard_file_names.append(shard_file_name)
+            writer = tf.io.TFRecordWriter(os.path.join(shards_path, shard_file_name))
+            print(f'Writing {shard_file_name} ... ({record_count} records written)')
+
+        if tag_string.dtype == tf.string:
+            tag_indices = dataset_wrapper.tag_encoder.encode(tag_string.numpy().decode())
+        else:
+            tag_indices = tag_string.numpy()
+
+        if image_format == 'png':
+            image_bytes = tf.io.encode_png(image).numpy()
+        else:
+            image_bytes = image.numpy().tobytes()
+
+        example = tf.train.Example(features=tf.train.Features(feature={
+            'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image_bytes])),
+            'height': tf.train.Feature(int64_list=tf.train.Int64List(value=[image.shape[0]])),
+            'width': tf.train.Feature(int64_list=tf.train.Int64List(value=[image.shape[1]])),
+            'tag_indices': tf.train.Feature(int64_list=tf.train.Int64List(value=tag_indices.tolist())),
+        }))
+        writer.write(example.SerializeToString())
+        record_count += 1
+
+    if writer:
+        writer.close()
+
+    metadata = {
+        'record_count': record_count,
+        'shard_file_names': shard_file_names,
+        'image_format': image_format,
+        'load_size': list(dataset_wrapper.get_load_size()),
+        'tag_count': len(tags),
+        'tags_hash': get_tags_hash(tags),
+    }
+
+    dd.io.serialize_as_json(
+        metadata, os.path.join(shards_path, SHARDS_METADATA_FILE_NAME))
+
+    return metadata
+
+
+class ShardDatasetWrapper(DatasetWrapper):
+    """
+    Wrapper class for data pipelining/augmentation from pre-resized TFRecord shards.
+    """
+
+    def __init__(self, shards_path, tags, width, height, scale_range, rotation_range, shift_range, shuffle_buffer_size=10000):
+        super().__init__(None, tags, width, height, scale_range=scale_range, rotation_range=rotation_range, shift_range=shift_range)
+        self.shards_path = shards_path
+        self.metadata = load_shards_metadata(shards_path)
+        self.shuffle_buffer_size = shuffle_buffer_size
+
+        if self.metadata['tags_hash'] != get_tags_hash(tags):
+            raise Exception(f'Shards in {shards_path} were written with different tags. Please make shards again.')
+
+        if list(self.metadata['load_size']) != list(self.get_load_size()):
+            raise Exception(
+                f'Shards in {shards_path} were written for image size {self.metadata["load_size"]}, but {list(self.get_load_size())} is required. Please make shards again.')
+
+    @property
+    def record_count(self):
+        return self.metadata['record_count']
+
+    def get_dataset(self, minibatch_size, random_seed=0, offset=0, with_offset=False):
+        """
+        Dataset of one epoch, shuffled by random_seed. The first offset records of the epoch are skipped.
+        If with_offset is True, batches also contain offsets of the record after each sample, for resuming.
+        """
+        shard_paths = [os.path.join(self.shards_path, file_name)
+                       for file_name in self.metadata['shard_file_names']]
+        random.Random(random_seed).shuffle(shard_paths)
+
+        dataset = tf.data.Dataset.from_tensor_slices(shard_paths)
+        dataset = dataset.interleave(
+            tf.data.TFRecordDataset, cycle_length=min(len(shard_paths), 8), block_length=1)
+        dataset = dataset.shuffle(self.shuffle_buffer_size, seed=random_seed, reshuffle_each_iteration=False)
+        dataset = dataset.enumerate()
+        dataset = dataset.skip(offset)
+        dataset = dataset.map(
+            lambda index, serialized: (*self.map_parse_record(serialized), index + 1), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.map(
+            lambda image, labels, next_offset: (*self.map_transform_image(image, labels), next_offset), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+        return batch_dataset(dataset, minibatch_size, with_offset)
+
+    def map_parse_record(self, serialized):
+        features = tf.io.parse_single_example(serialized, {
+            'image': tf.io.FixedLenFeature([], tf.string),
+            'height': tf.io.FixedLenFeature([], tf.int64),
+            'width': tf.io.FixedLenFeature([], tf.int64),
+            'tag_indices': tf.io.VarLenFeature(tf.int64),
+        })
+
+        if self.metadata['image_format'] == 'png':
+            image = tf.io.decode_png(features['image'], channels=3)
+        else:
+            image = tf.reshape(tf.io.decode_raw(features['image'], tf.uint8),
+                               tf.stack([features['height'], features['width'], 3]))
+
+        image = tf.cast(image, tf.float32)
+
+        labels = self.tag_encoder.map_labels_from_indices(
+            tf.sparse.to_dense(features['tag_indices']))
+
+        return (image, labels)
@@ -0,0 +1,61 @@
+import numpy as np
+import tensorflow as tf
+
+
+class TagEncoder:
+    """
+    Encode tag strings to indices of the tag list and to label vectors.
+    Tag-to-index map is built once, so encoding takes time proportional to the number of tags of the image.
+    """
+
+    def __init__(self, tags, delimiter=','):
+        self.tags = list(tags)
+        self.tag_count = len(self.tags)
+        self.delimiter = delimiter
+        self.tag_to_index = {tag: index for index, tag in enumerate(self.tags)}
+        self.lookup_table = None
+
+    def encode(self, tag_string):
+        """
+        Sorted indices of known tags in tag_string.
+        """
+        indices = {self.tag_to_index[tag] for tag in tag_string.split(self.delimiter) if tag in self.tag_to_index}
+
+        return np.array(sorted(indices), dtype=np.int32)
+
+    def to_labels(self, indices):
+        labels = np.zeros(self.tag_count, dtype=np.float32)
+        labels[indices] = 1.0
+
+        return labels
+
+    def encode_labels(self, tag_string):
+        return self.to_labels(self.encode(tag_string))
+
+    def get_lookup_table(self):
+        if self.lookup_table is None:
+            self.lookup_table = tf.lookup.StaticHashTable(
+                tf.lookup.KeyValueTensorInitializer(
+                    tf.constant(self.tags, dtype=tf.string), tf.range(self.tag_count, dtype=tf.int64)),
+                default_value=-1)
+
+        return self.lookup_table
+
+    def map_labels(self, tag_string):
+        """
+        Label vector from tag string, using TensorFlow ops only.
+        """
+        indices = self.get_lookup_table().lookup(tf.strings.split(tag_string, self.delimiter))
+        indices = tf.boolean_mask(indices, indices >= 0)
+
+        return self.map_labels_from_indices(indices)
+
+    def map_labels_from_indices(self, indices):
+        """
+        Label vector from tag indices, using TensorFlow ops only.
+        """
+        indices = tf.cast(indices, tf.int64)
+        labels = tf.scatter_nd(
+            tf.expand_dims(indices, -1), tf.ones_like(indices, dtype=tf.float32), [self.tag_count])
+
+        return tf.minimum(labels, 1.0)
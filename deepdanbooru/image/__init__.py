@@ -2,6 +2,7 @@ import math
 
 import numpy as np
 import skimage.transform
+import tensorflow as tf
 
 
 def calculate_image_scale(source_width, source_height, target_width, target_height):
@@ -54,3 +55,72 @@ def transform_and_pad_image(image, target_width, target_height, scale=None, rota
         image_array, (t).inverse, output_shape=warp_shape, order=order, mode=mode)
 
     return image_array
+
+
+def transform_and_pad_image_tf(image, target_width, target_height, scale=None, rotation=None, shift=None):
+    """
+    Transform image and pad by edge pixels, using TensorFlow ops only.
+    Same result as transform_and_pad_image with order=1 and mode='edge', but can run inside tf.data graph.
+    """
+    image_width = tf.cast(tf.shape(image)[1], tf.float32)
+    image_height = tf.cast(tf.shape(image)[0], tf.float32)
+
+    # centerize
+    t = _translation_matrix(-image_width * 0.5, -image_height * 0.5)
+
+    if scale is not None:
+        t = tf.linalg.matmul(_scale_matrix(scale), t)
+
+    if rotation is not None:
+        radian = (tf.cast(rotation, tf.float32) / 180.0) * math.pi
+        t = tf.linalg.matmul(_rotation_matrix(radian), t)
+
+    t = tf.linalg.matmul(_translation_matrix(
+        target_width * 0.5, target_height * 0.5), t)
+
+    if shift is not None:
+        t = tf.linalg.matmul(_translation_matrix(
+            target_width * shift[0], target_height * shift[1]), t)
+
+    # output coordinates to input coordinates, as 8 parameters of projective transform
+    inverse = tf.linalg.inv(t)
+    transforms = tf.reshape(inverse / inverse[2, 2], [9])[:8]
+
+    image_array = tf.raw_ops.ImageProjectiveTransformV3(
+        images=tf.expand_dims(tf.cast(image, tf.float32), 0),
+        transforms=tf.expand_dims(transforms, 0),
+        output_shape=tf.constant([target_height, target_width], dtype=tf.int32),
+        fill_value=0.0,
+        interpolation='BILINEAR',
+        fill_mode='NEAREST')
+
+    return image_array[0]
+
+
+def _translation_matrix(x, y):
+    x = tf.cast(x, tf.float32)
+    y = tf.cast(y, tf.float32)
+
+    return tf.stack([
+        tf.stack([1.0, 0.0, x]),
+        tf.stack([0.0, 1.0, y]),
+        tf.constant([0.0, 0.0, 1.0])])
+
+
+def _scale_matrix(scale):
+    scale = tf.cast(scale, tf.float32)
+
+    return tf.stack([
+        tf.stack([scale, 0.0, 0.0]),
+        tf.stack([0.0, scale, 0.0]),
+        tf.constant([0.0, 0.0, 1.0])])
+
+
+def _rotation_matrix(radian):
+    cos = tf.math.cos(radian)
+    sin = tf.math.sin(radian)
+
+    return tf.stack([
+        tf.stack([cos, -sin, 0.0]),
+        tf.stack([sin, cos, 0.0]),
+        tf.constant([0.0, 0.0, 1.0])])
@@ -0,0 +1,225 @@
+import bisect
+import contextlib
+import threading
+import time
+
+DEFAULT_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+class Metric:
+    """
+    Base of metrics with optional labels. Values are kept per label values, and are safe to update from any thread.
+    """
+    type_name = ''
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get_label_values(self, labels):
+        if set(labels) != set(self.label_names):
+            raise Exception(f'{self.name} requires labels {self.label_names}, but {tuple(labels)} are given.')
+
+        return tuple(str(labels[label_name]) for label_name in self.label_names)
+
+    def format_labels(self, label_values, extra_labels=()):
+        labels = [*zip(self.label_names, label_values), *extra_labels]
+
+        if not labels:
+            return ''
+
+        return '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in labels) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.type_name}']
+
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.extend(self.render_value(label_values, value))
+
+        return lines
+
+    def render_value(self, label_values, value):
+        return [f'{self.name}{self.format_labels(label_values)} {format_value(value)}']
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1.0, **labels):
+        label_values = self.get_label_values(labels)
+
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.get_label_values(labels), 0.0)
+
+
+class Gauge(Counter):
+    type_name = 'gauge'
+
+    def dec(self, amount=1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        label_values = self.get_label_values(labels)
+
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        label_values = self.get_label_values(labels)
+
+        with self.lock:
+            if label_values not in self.values:
+                # per bucket counts (not cumulative) with +Inf at the end, sum
+                self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            bucket_counts, _ = self.values[label_values]
+            bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[label_values][1] += value
+
+    def get_count_and_sum(self, **labels):
+        with self.lock:
+            bucket_counts, total = self.values.get(self.get_label_values(labels), [[0], 0.0])
+
+            return sum(bucket_counts), total
+
+    def render_value(self, label_values, value):
+        bucket_counts, total = value
+        lines = []
+        count = 0
+
+        for bucket, bucket_count in zip([*self.buckets, '+Inf'], bucket_counts):
+            count += bucket_count
+            labels = self.format_labels(label_values, [('le', format_value(bucket))])
+            lines.append(f'{self.name}_bucket{labels} {count}')
+
+        lines.append(f'{self.name}_sum{self.format_labels(label_values)} {format_value(total)}')
+        lines.append(f'{self.name}_count{self.format_labels(label_values)} {count}')
+
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Collection of metrics, rendered in Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+        return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self.register(Counter(name, help_text, label_names))
+
+    def gauge(self, name, help_text, label_names=()):
+        return self.register(Gauge(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+    def render(self):
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value):
+    if isinstance(value, str):
+        return value
+
+    return repr(float(value))
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'deepdanbooru_stage_seconds', 'Time taken by each stage of image evaluation.', ['stage'])
+BATCH_SIZE = REGISTRY.histogram(
+    'deepdanbooru_batch_size', 'Number of images in each forward pass of the model.',
+    buckets=[1, 2, 4, 8, 16, 32, 64, 128, 256])
+REQUESTS_IN_FLIGHT = REGISTRY.gauge(
+    'deepdanbooru_requests_in_flight', 'Number of requests being handled.')
+REQUESTS = REGISTRY.counter(
+    'deepdanbooru_requests_total', 'Number of handled requests by method and status code.', ['method', 'code'])
+CACHE_REQUESTS = REGISTRY.counter(
+    'deepdanbooru_cache_requests_total', 'Number of result cache lookups by result (hit or miss).', ['result'])
+REJECTED = REGISTRY.counter(
+    'deepdanbooru_rejected_total', 'Number of images rejected by admission control by reason.', ['reason'])
+ERRORS = REGISTRY.counter(
+    'deepdanbooru_errors_total', 'Number of failed evaluations by stage.', ['stage'])
+
+
+# per thread, so warm-up on a loading thread does not hide stages of requests
+local = threading.local()
+
+
+@contextlib.contextmanager
+def not_recorded():
+    """
+    Context manager which skips recording of stages on this thread, for warming up.
+    """
+    local.not_recorded = True
+    try:
+        yield
+    finally:
+        local.not_recorded = False
+
+
+@contextlib.contextmanager
+def time_stage(stage):
+    """
+    Context manager recording time taken by stage (fetch, read, decode, resize, queue_wait, model) of evaluation.
+    Errors raised inside are counted for the stage.
+    """
+    if getattr(local, 'not_recorded', False):
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+def get_stage_summary():
+    """
+    List of (stage, count, mean seconds) of recorded stages.
+    """
+    summary = []
+
+    with STAGE_SECONDS.lock:
+        stages = sorted(label_values[0] for label_values in STAGE_SECONDS.values)
+
+    for stage in stages:
+        count, total = STAGE_SECONDS.get_count_and_sum(stage=stage)
+        summary.append((stage, count, total / count if count else 0.0))
+
+    return summary
@@ -5,3 +5,12 @@ from .resnet import create_resnet_152
 from .resnet import create_resnet_custom_v1
 from .resnet import create_resnet_custom_v2
 from .resnet import create_resnet_custom_v3
+
+from .precision import PRECISIONS
+from .precision import set_precision_policy
+from .precision import convert_model_precision
+
+from .tflite import TFLiteModel
+from .tflite import quantize_model
+
+from .optimize import optimize_for_inference
@@ -0,0 +1,157 @@
+import numpy as np
+import tensorflow as tf
+
+NO_OP_LAYER_CLASS_NAMES = ['Dropout', 'SpatialDropout1D', 'SpatialDropout2D', 'SpatialDropout3D', 'GaussianNoise', 'GaussianDropout']
+
+
+def optimize_for_inference(model):
+    """
+    Rebuild functional model for inference. BatchNormalization layers are folded into kernel and bias of
+    preceding Conv2D layers, and layers which do nothing in inference (dropout, linear activation) are removed.
+    """
+    config = model.get_config()
+    layer_configs = config['layers']
+    layer_configs_by_name = {layer_config['config']['name']: layer_config for layer_config in layer_configs}
+
+    reference_counts = {}
+    for layer_config in layer_configs:
+        for history in get_histories(layer_config['inbound_nodes']):
+            reference_counts[history[0]] = reference_counts.get(history[0], 0) + 1
+    for history in get_histories(config['output_layers']):
+        reference_counts[history[0]] = reference_counts.get(history[0], 0) + 1
+
+    # removed layer name -> (layer name, node index, tensor index) of tensor replacing its output
+    replacements = {}
+    folded_layer_names = {}  # conv layer name -> batch normalization layer name
+
+    for layer_config in layer_configs:
+        name = layer_config['config']['name']
+        histories = get_histories(layer_config['inbound_nodes'])
+
+        if len(layer_config['inbound_nodes']) != 1 or len(histories) != 1:
+            continue
+
+        history = replacements.get(histories[0][0], histories[0])
+        inbound_layer_config = layer_configs_by_name[history[0]]
+
+        if is_no_op_layer(layer_config):
+            replacements[name] = history
+        elif (layer_config['class_name'] == 'BatchNormalization'
+              and is_foldable_batch_normalization(layer_config)
+              and is_foldable_conv(inbound_layer_config)
+              and history == histories[0]
+              and reference_counts.get(history[0]) == 1):
+            replacements[name] = history
+            folded_layer_names[history[0]] = name
+
+    if not replacements:
+        return model
+
+    config['layers'] = [
+        layer_config for layer_config in layer_configs if layer_config['config']['name'] not in replacements]
+
+    for layer_config in config['layers']:
+        layer_config['inbound_nodes'] = replace_histories(layer_config['inbound_nodes'], replacements)
+        if layer_config['config']['name'] in folded_layer_names:
+            layer_config['config']['use_bias'] = True
+
+    config['output_layers'] = replace_histories(config['output_layers'], replacements)
+
+    optimized_model = tf.keras.Model.from_config(config)
+
+    for layer in optimized_model.layers:
+        weights = model.get_layer(layer.name).get_weights()
+
+        if layer.name in folded_layer_names:
+            weights = fold_batch_normalization(
+                model.get_layer(layer.name), model.get_layer(folded_layer_names[layer.name]))
+
+        layer.set_weights(weights)
+
+    return optimized_model
+
+
+def fold_batch_normalization(conv_layer, bn_layer):
+    """
+    Return [kernel, bias] of conv_layer followed by bn_layer as a single convolution.
+    """
+    conv_weights = conv_layer.get_weights()
+    kernel = conv_weights[0]
+    bias = conv_weights[1] if conv_layer.use_bias else np.zeros(kernel.shape[-1], dtype=kernel.dtype)
+
+    bn_weights = list(bn_layer.get_weights())
+    gamma = bn_weights.pop(0) if bn_layer.scale else np.ones_like(bias)
+    beta = bn_weights.pop(0) if bn_layer.center else np.zeros_like(bias)
+    moving_mean, moving_variance = bn_weights
+
+    multiplier = gamma / np.sqrt(moving_variance + bn_layer.epsilon)
+
+    return [kernel * multiplier, (bias - moving_mean) * multiplier + beta]
+
+
+def is_no_op_layer(layer_config):
+    class_name = layer_config['class_name']
+
+    if class_name in NO_OP_LAYER_CLASS_NAMES:
+        return True
+
+    return class_name == 'Activation' and layer_config['config']['activation'] == 'linear'
+
+
+def is_foldable_batch_normalization(layer_config):
+    axis = layer_config['config']['axis']
+    if isinstance(axis, (list, tuple)):
+        if len(axis) != 1:
+            return False
+        axis = axis[0]
+
+    return axis in (-1, 3)
+
+
+def is_foldable_conv(layer_config):
+    return (layer_config['class_name'] == 'Conv2D'
+            and len(layer_config['inbound_nodes']) == 1
+            and layer_config['config']['activation'] == 'linear'
+            and layer_config['config'].get('data_format') in (None, 'channels_last'))
+
+
+def get_histories(nodes):
+    """
+    (layer name, node index, tensor index) of all tensors referred in inbound nodes of layer config.
+    Supports both Keras 2 ([name, node index, tensor index, kwargs]) and Keras 3 (keras_history) formats.
+    """
+    histories = []
+
+    def collect(history):
+        histories.append(history)
+        return history
+
+    replace_histories(nodes, collect)
+
+    return histories
+
+
+def replace_histories(nodes, replacements):
+    """
+    Copy of inbound nodes, with tensors of replaced layers referring tensors given in replacements.
+    replacements can be a dict by layer name or a function of (layer name, node index, tensor index).
+    """
+    if callable(replacements):
+        replace = replacements
+    else:
+        def replace(history):
+            return replacements.get(history[0], history)
+
+    if isinstance(nodes, dict):
+        if nodes.get('class_name') == '__keras_tensor__':
+            history = tuple(nodes['config']['keras_history'])
+            return {**nodes, 'config': {**nodes['config'], 'keras_history': list(replace(history))}}
+
+        return {key: replace_histories(value, replace) for key, value in nodes.items()}
+    elif isinstance(nodes, (list, tuple)):
+        if len(nodes) >= 3 and isinstance(nodes[0], str) and isinstance(nodes[1], int) and isinstance(nodes[2], int):
+            return [*replace(tuple(nodes[:3])), *nodes[3:]]
+
+        return [replace_histories(node, replace) for node in nodes]
+    else:
+        return nodes
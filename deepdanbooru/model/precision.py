@@ -0,0 +1,43 @@
+import tensorflow as tf
+
+PRECISIONS = ['float32', 'mixed_float16', 'mixed_bfloat16']
+
+
+def set_precision_policy(precision):
+    """
+    Set global Keras dtype policy. Layers created after this call compute in given precision.
+    """
+    if precision not in PRECISIONS:
+        raise Exception(f'Not supported precision : {precision}')
+
+    tf.keras.mixed_precision.set_global_policy(precision)
+
+
+def convert_model_precision(model, precision):
+    """
+    Rebuild model with given precision and copy its weights. Models trained in mixed precision can be converted back to float32.
+    Output layers are kept in float32, so scores stay numerically safe.
+    """
+    if precision not in PRECISIONS:
+        raise Exception(f'Not supported precision : {precision}')
+
+    if precision == 'float32' and all(layer.compute_dtype == 'float32' for layer in model.layers):
+        return model
+
+    config = model.get_config()
+
+    output_layers = config['output_layers']
+    if output_layers and isinstance(output_layers[0], str):
+        output_layers = [output_layers]
+    output_layer_names = {output_layer[0] for output_layer in output_layers}
+
+    for layer_config in config['layers']:
+        if layer_config['class_name'] == 'InputLayer' or layer_config['config']['name'] in output_layer_names:
+            layer_config['config']['dtype'] = 'float32'
+        else:
+            layer_config['config']['dtype'] = precision
+
+    converted_model = tf.keras.Model.from_config(config)
+    converted_model.set_weights(model.get_weights())
+
+    return converted_model
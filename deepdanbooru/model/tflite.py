@@ -0,0 +1,61 @@
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+
+class TFLiteModel:
+    """
+    Wrapper of TensorFlow Lite interpreter, which can be used in place of keras model for evaluation.
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        self.model_path = model_path
+        self.interpreter = tf.lite.Interpreter(
+            model_path=model_path, num_threads=num_threads)
+        self.lock = threading.Lock()
+
+        input_details = self.interpreter.get_input_details()[0]
+        output_details = self.interpreter.get_output_details()[0]
+
+        self.input_index = input_details['index']
+        self.output_index = output_details['index']
+        self.input_shape = (None, *(int(size) for size in input_details['shape'][1:]))
+        self.output_shape = (None, *(int(size) for size in output_details['shape'][1:]))
+        self.batch_size = None
+
+    def predict_on_batch(self, x):
+        x = np.asarray(x, dtype=np.float32)
+
+        with self.lock:
+            if self.batch_size != x.shape[0]:
+                self.interpreter.resize_tensor_input(
+                    self.input_index, [x.shape[0], *self.input_shape[1:]])
+                self.interpreter.allocate_tensors()
+                self.batch_size = x.shape[0]
+
+            self.interpreter.set_tensor(self.input_index, x)
+            self.interpreter.invoke()
+
+            return self.interpreter.get_tensor(self.output_index).copy()
+
+    def predict(self, x, batch_size=32):
+        x = np.asarray(x, dtype=np.float32)
+
+        return np.concatenate([self.predict_on_batch(x[i:i + batch_size]) for i in range(0, len(x), batch_size)])
+
+
+def quantize_model(model, calibration_images):
+    """
+    Convert keras model to TensorFlow Lite model with int8 weights and activations, calibrated by given images.
+    Input and output stay float32, so the result can be used as a drop-in replacement.
+    """
+    def representative_dataset():
+        for image in calibration_images:
+            yield [image[np.newaxis].astype(np.float32)]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+
+    return converter.convert()
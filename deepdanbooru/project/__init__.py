@@ -1,4 +1,5 @@
 from .project import DEFAULT_PROJECT_CONTEXT
 from .project import load_project
 from .project import load_model_from_project
+from .project import get_model_path_from_project
 from .project import load_tags_from_project
@@ -1,13 +1,15 @@
 import os
 import deepdanbooru as dd
-import tensorflow as tf
 
 DEFAULT_PROJECT_CONTEXT = {
     'source': 'danbooru',
     'image_width': 299,
     'image_height': 299,
     'database_path': None,
+    'shards_path': None,
+    'pre_encode_tags': False,
     'images_path': None,
+    'download_max_size': None,
     'pretrained_model_path': None,
     'reset_pretrained_tag_layers': 'zero',
     'minimum_tag_count': 20,
@@ -17,7 +19,9 @@ DEFAULT_PROJECT_CONTEXT = {
     'export_model_per_epoch': 10,
     'checkpoint_frequency_mb': 200,
     'console_logging_frequency_mb': 10,
+    'steps_per_execution': 1,
     'optimizer': 'adam',
+    'precision': 'float32',
     'learning_rate': 0.001,
     'rotation_range': [0.0, 360.0],
     'scale_range': [0.9, 1.1],
@@ -26,6 +30,8 @@ DEFAULT_PROJECT_CONTEXT = {
 
 
 def load_project(project_path):
+    import tensorflow as tf
+
     project_context_path = os.path.join(project_path, 'project.json')
     project_context = dd.io.deserialize_from_json(project_context_path)
     tags = dd.data.load_tags_from_project(project_path)
@@ -34,17 +40,30 @@ def load_project(project_path):
     model_path = os.path.join(project_path, f'model-{model_type}.h5')
     model = tf.keras.models.load_model(model_path)
 
+    if 'precision' in project_context:
+        model = dd.model.convert_model_precision(model, project_context['precision'])
+
     return project_context, model, tags
 
 
-def load_model_from_project(project_path, compile_model=True):
+def get_model_path_from_project(project_path):
     project_context_path = os.path.join(project_path, 'project.json')
     project_context = dd.io.deserialize_from_json(project_context_path)
 
     model_type = project_context['model']
-    model_path = os.path.join(project_path, f'model-{model_type}.h5')
+
+    return os.path.join(project_path, f'model-{model_type}.h5')
+
+
+def load_model_from_project(project_path, compile_model=True):
+    import tensorflow as tf
+
+    model_path = get_model_path_from_project(project_path)
     model = tf.keras.models.load_model(model_path, compile=compile_model)
 
+    if not compile_model:
+        model = dd.model.optimize_for_inference(model)
+
     return model
 
 
@@ -0,0 +1,5 @@
+from .admission import AdmissionController
+from .batching import BatchPredictor, DeadlineExceededError
+from .fetching import ImageFetcher, ImageFetchError
+from .registry import ModelRegistry, ServedModel, load_model_configs
+from .workers import check_worker_model_configs, start_workers
@@ -0,0 +1,25 @@
+class AdmissionController:
+    """
+    Bounds the number of images being fetched, decoded or waiting for the model.
+    Requests which would exceed max_pending_count are rejected instead of queued,
+    so memory of decoded images and latency stay bounded under load.
+    Used from the event loop thread only.
+    """
+
+    def __init__(self, max_pending_count=0):
+        self.max_pending_count = max_pending_count
+        self.pending_count = 0
+
+    def try_admit(self, count=1):
+        """
+        Admit count images all together and return True, or return False if there is no room. 0 means unlimited.
+        """
+        if self.max_pending_count and self.pending_count + count > self.max_pending_count:
+            return False
+
+        self.pending_count += count
+
+        return True
+
+    def release(self, count=1):
+        self.pending_count -= count
@@ -0,0 +1,123 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import deepdanbooru as dd
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+class BatchPredictor:
+    """
+    Dynamic micro-batching scheduler for model inference.
+
+    Images submitted by concurrent requests are queued and evaluated together
+    in a single forward pass. A batch is closed when it reaches max_batch_size
+    or when max_wait_ms has passed since its first image was queued. The model
+    runs on a dedicated worker thread, so the event loop is never blocked.
+    """
+
+    def __init__(self, model, max_batch_size=8, max_wait_ms=5.0):
+        if max_batch_size < 1:
+            raise Exception(f'max_batch_size must be positive : {max_batch_size}')
+
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max(max_wait_ms, 0.0) / 1000.0
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.task = None
+
+    async def predict(self, image, deadline=None):
+        """
+        Queue single image (HWC) and return its own row of the model output.
+        If deadline (event loop time) has passed before the image reaches the model, DeadlineExceededError is raised.
+        """
+        self.start()
+
+        future = asyncio.get_event_loop().create_future()
+        self.queue.put_nowait((image, future, time.perf_counter(), deadline))
+
+        return await future
+
+    def warm_up(self):
+        """
+        Run the model on blank batches of the smallest and largest sizes, so that graph tracing is done
+        before the first request. Traced functions are relaxed to any batch size after the second shape.
+        """
+        input_shape = tuple(self.model.input_shape[1:])
+
+        for batch_size in sorted({1, self.max_batch_size}):
+            self.model.predict_on_batch(np.zeros((batch_size, *input_shape), dtype=np.float32))
+
+    def start(self):
+        if self.task is None:
+            self.queue = asyncio.Queue()
+            self.task = asyncio.ensure_future(self.run())
+
+    def predict_on_batch(self, images):
+        with dd.metrics.time_stage('model'):
+            return self.model.predict_on_batch(images)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.executor.shutdown(wait=False)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+
+            while len(items) < self.max_batch_size:
+                if not self.queue.empty():
+                    items.append(self.queue.get_nowait())
+                    continue
+
+                timeout = deadline - loop.time()
+                if timeout <= 0.0:
+                    break
+
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # drop images whose request timed out while queued, and skip callers which already went away
+            now = loop.time()
+            for _, future, _, deadline in items:
+                if deadline is not None and deadline < now and not future.done():
+                    dd.metrics.REJECTED.inc(reason='deadline')
+                    future.set_exception(DeadlineExceededError('Request deadline exceeded while waiting for the model'))
+
+            items = [item for item in items if not item[1].done()]
+            if not items:
+                continue
+
+            batch_started = time.perf_counter()
+            for _, _, queued, _ in items:
+                dd.metrics.observe_stage('queue_wait', batch_started - queued)
+            dd.metrics.BATCH_SIZE.observe(len(items))
+
+            images = np.stack([image for image, _, _, _ in items])
+
+            try:
+                y = await loop.run_in_executor(self.executor, self.predict_on_batch, images)
+            except Exception as e:
+                for _, future, _, _ in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            y = np.asarray(y)
+
+            for i, (_, future, _, _) in enumerate(items):
+                if not future.done():
+                    future.set_result(y[i])
@@ -0,0 +1,86 @@
+import asyncio
+
+import aiohttp
+
+import deepdanbooru as dd
+
+
+class ImageFetchError(Exception):
+    def __init__(self, message, status_code=502):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ImageFetcher:
+    """
+    Asynchronous image downloader backed by one pooled aiohttp session.
+    """
+
+    def __init__(self, max_connections=64, max_connections_per_host=8, timeout=10.0, connect_timeout=3.0,
+                 max_concurrent_fetches=0, max_image_bytes=0):
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=connect_timeout)
+        self.max_concurrent_fetches = max_concurrent_fetches
+        self.max_image_bytes = max_image_bytes
+        self.session = None
+        self.semaphore = None
+
+    def get_session(self):
+        # the session must be created inside running event loop
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections, limit_per_host=self.max_connections_per_host)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+
+        return self.session
+
+    async def fetch(self, url):
+        """
+        Download url and return its body as bytes.
+        """
+        if self.semaphore is None:
+            # 0 means unlimited, but keep one code path
+            self.semaphore = asyncio.Semaphore(self.max_concurrent_fetches or 2 ** 31)
+
+        async with self.semaphore:
+            with dd.metrics.time_stage('fetch'):
+                try:
+                    async with self.get_session().get(url) as response:
+                        if response.status != 200:
+                            raise ImageFetchError(f'Fetching {url} failed with status {response.status}')
+
+                        return await self.read_body(url, response)
+                except asyncio.TimeoutError:
+                    raise ImageFetchError(f'Fetching {url} timed out', status_code=504)
+                except aiohttp.ClientError as e:
+                    raise ImageFetchError(f'Fetching {url} failed : {e}')
+
+    async def read_body(self, url, response):
+        """
+        Read response body, and stop as soon as it is larger than max_image_bytes.
+        """
+        if not self.max_image_bytes:
+            return await response.read()
+
+        if response.content_length is not None and response.content_length > self.max_image_bytes:
+            raise self.get_too_large_error(url)
+
+        body = bytearray()
+
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            body.extend(chunk)
+            if len(body) > self.max_image_bytes:
+                raise self.get_too_large_error(url)
+
+        return bytes(body)
+
+    def get_too_large_error(self, url):
+        dd.metrics.REJECTED.inc(reason='too_large')
+
+        return ImageFetchError(f'Image of {url} is larger than {self.max_image_bytes} bytes', status_code=413)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
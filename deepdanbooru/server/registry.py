@@ -0,0 +1,227 @@
+import asyncio
+import gc
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import deepdanbooru as dd
+
+
+class ServedModel:
+    """
+    One loaded version of a named model. Requests acquire it while they use it,
+    so a replaced version is closed only after its in-flight requests are finished.
+    """
+
+    def __init__(self, name, version, model, tags, categories, batch_predictor, result_cache=None, model_path=None):
+        self.name = name
+        self.version = version
+        self.model = model
+        self.tags = tags
+        self.categories = categories
+        self.batch_predictor = batch_predictor
+        self.result_cache = result_cache
+        self.model_path = model_path
+        self.model_stat = get_file_stat(model_path)
+        self.loaded_at = time.time()
+        self.active_request_count = 0
+        self.retired = False
+        # executor for collecting garbage after close, set by ModelRegistry
+        self.close_executor = None
+
+    def acquire(self):
+        self.active_request_count += 1
+
+        return self
+
+    def release(self):
+        self.active_request_count -= 1
+
+        if self.retired and self.active_request_count == 0:
+            self.close()
+
+    def retire(self):
+        self.retired = True
+
+        if self.active_request_count == 0:
+            self.close()
+
+    def close(self):
+        self.batch_predictor.stop()
+
+        if self.result_cache:
+            self.result_cache.close()
+
+        # drop references to weights, so memory is released before next load
+        self.model = None
+        self.batch_predictor = None
+
+        # collecting a large model takes long, keep it off the event loop
+        if self.close_executor is not None:
+            self.close_executor.submit(gc.collect)
+        else:
+            gc.collect()
+
+
+class ModelRegistry:
+    """
+    Named models served by one process.
+
+    New versions are loaded on a background thread and swapped in on the event loop,
+    so requests always see either the old or the new version. Models are loaded one at a time,
+    which bounds peak memory to one extra model.
+    """
+
+    def __init__(self, model_configs, loader):
+        """
+        model_configs is a dict of model name to model config, loader is a function of (name, model_config, version)
+        which returns ServedModel. The first model is the default model.
+        """
+        self.model_configs = dict(model_configs)
+        self.loader = loader
+        self.models = {}
+        self.versions = {}
+        self.loading_names = set()
+        self.load_executor = ThreadPoolExecutor(max_workers=1)
+        self.watched_stats = {}
+
+    @property
+    def default_name(self):
+        return next(iter(self.model_configs), None)
+
+    def get(self, name=None):
+        """
+        Return ServedModel of name, or of the default model if name is None. None if it is not loaded.
+        """
+        return self.models.get(name or self.default_name)
+
+    def load_all(self):
+        """
+        Load all configured models synchronously. Used before the server starts.
+        """
+        for name in self.model_configs:
+            self.swap(self.load_model(name, self.model_configs[name]))
+
+    def load_model(self, name, model_config):
+        version = self.versions.get(name, 0) + 1
+        served_model = self.loader(name, model_config, version)
+        # on the load executor, so garbage of old version is collected before next load
+        served_model.close_executor = self.load_executor
+        self.versions[name] = version
+
+        return served_model
+
+    def swap(self, served_model):
+        old_served_model = self.models.get(served_model.name)
+        self.models[served_model.name] = served_model
+
+        if old_served_model is not None:
+            old_served_model.retire()
+
+    async def reload(self, name, model_config=None):
+        """
+        Load new version of name in background and swap it in. model_config replaces
+        the config of name if given.
+        Return False if the model is already being loaded.
+        """
+        if name in self.loading_names:
+            return False
+
+        model_config = model_config or self.model_configs[name]
+
+        self.loading_names.add(name)
+        try:
+            served_model = await asyncio.get_event_loop().run_in_executor(
+                self.load_executor, self.load_model, name, model_config)
+        finally:
+            self.loading_names.discard(name)
+
+        self.model_configs[name] = model_config
+        self.swap(served_model)
+
+        return True
+
+    def start_reload(self, name, model_config=None):
+        """
+        Start reload without waiting for it. Errors are printed, and the current version keeps serving.
+        """
+        async def reload():
+            try:
+                await self.reload(name, model_config)
+            except Exception:
+                print(f'Reloading model {name} failed.')
+                traceback.print_exc()
+
+        return asyncio.ensure_future(reload())
+
+    def check_model_files(self):
+        """
+        Reload models whose file was changed. A file must be unchanged for two checks in a row,
+        so models which are still being written are not loaded.
+        """
+        for name, served_model in list(self.models.items()):
+            stat = get_file_stat(served_model.model_path)
+
+            if stat is None or stat == served_model.model_stat or name in self.loading_names:
+                self.watched_stats.pop(name, None)
+                continue
+
+            if self.watched_stats.get(name) == stat:
+                del self.watched_stats[name]
+                print(f'Model file of {name} is changed, reloading ...')
+                self.start_reload(name)
+            else:
+                self.watched_stats[name] = stat
+
+    def get_model_infos(self):
+        infos = []
+
+        for name in self.model_configs:
+            served_model = self.models.get(name)
+            info = {'name': name, 'default': name == self.default_name, 'loading': name in self.loading_names}
+
+            if served_model is not None:
+                info.update({
+                    'version': served_model.version,
+                    'model_path': served_model.model_path,
+                    'tag_count': len(served_model.tags),
+                    'loaded_at': served_model.loaded_at,
+                })
+
+            infos.append(info)
+
+        return infos
+
+    def close(self):
+        for served_model in self.models.values():
+            served_model.retire()
+        self.load_executor.shutdown(wait=False)
+
+
+def load_model_configs(project_path, model_path, tags_path, precision, models_config_path):
+    """
+    Model configs of --models-config file, and of "default" model if project path or model path is given.
+    """
+    model_configs = {}
+
+    if project_path or model_path:
+        model_configs['default'] = {
+            'project_path': project_path, 'model_path': model_path, 'tags_path': tags_path, 'precision': precision}
+
+    if models_config_path:
+        model_configs.update(dd.io.deserialize_from_json(models_config_path))
+
+    if not model_configs:
+        raise Exception('You must provide project path, model path or models config.')
+
+    return model_configs
+
+
+def get_file_stat(path):
+    if not path or not os.path.isfile(path):
+        return None
+
+    stat = os.stat(path)
+
+    return (stat.st_mtime, stat.st_size)
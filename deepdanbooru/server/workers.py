@@ -0,0 +1,39 @@
+import os
+import sys
+
+import tornado.netutil
+import tornado.process
+
+
+def check_worker_model_configs(model_configs):
+    """
+    Raise if a model is not .tflite model. Each worker loads its own copy of models,
+    so float models would take their memory once per worker.
+    """
+    for name, model_config in model_configs.items():
+        if not (model_config.get('model_path') or '').endswith('.tflite'):
+            raise Exception(
+                f'Model {name} is not .tflite model. Each worker loads its own copy of models, '
+                'so --workers requires models exported by export-model.')
+
+
+def start_workers(port, model_configs, worker_count, max_restarts, verbose):
+    """
+    Bind listening sockets and fork worker processes accepting connections from them, and return sockets
+    in each worker. The parent process stays as a supervisor, which restarts crashed workers and exits
+    when all workers are finished. TensorFlow does not survive fork, so this must be called before it is imported.
+    """
+    check_worker_model_configs(model_configs)
+
+    if 'tensorflow' in sys.modules:
+        raise Exception('Workers must be started before TensorFlow is imported.')
+
+    sockets = tornado.netutil.bind_sockets(port)
+
+    print(f'Starting {worker_count} workers ...')
+    task_id = tornado.process.fork_processes(worker_count, max_restarts=max_restarts)
+
+    if verbose:
+        print(f'Worker {task_id} (pid {os.getpid()}) is started.')
+
+    return sockets
@@ -0,0 +1,2 @@
+from .checkpoint import CheckpointCallback
+from .step import create_train_function, run_train_function
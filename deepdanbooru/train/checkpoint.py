@@ -0,0 +1,19 @@
+class CheckpointCallback:
+    """
+    Save checkpoint every frequency_mb minibatches while the input pipeline keeps running.
+    """
+
+    def __init__(self, manager, frequency_mb):
+        self.manager = manager
+        self.frequency_mb = frequency_mb
+
+    def on_minibatch_end(self, used_minibatch):
+        if used_minibatch % self.frequency_mb == 0:
+            self.save()
+
+    def on_epoch_end(self):
+        self.save()
+
+    def save(self):
+        print('Saving checkpoint ... ')
+        self.manager.save()
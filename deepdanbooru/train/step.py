@@ -0,0 +1,84 @@
+import tensorflow as tf
+
+
+def create_train_function(model, optimizer, loss_function, loss_metric, metrics, used_minibatch, used_sample, offset):
+    """
+    Create compiled function which runs up to step_count training steps from dataset iterator.
+    Batches are (x, y, next_offset). Metrics and checkpoint variables are updated on device,
+    and the number of executed steps is returned, which is less than step_count at the end of the iterator.
+    """
+    @tf.function
+    def train_step(x, y, next_offset):
+        with tf.GradientTape() as tape:
+            y_pred = model(x, training=True)
+            loss = loss_function(y, y_pred)
+            scaled_loss = get_scaled_loss(optimizer, loss)
+
+        gradients = tape.gradient(scaled_loss, model.trainable_variables)
+        gradients = get_unscaled_gradients(optimizer, gradients)
+        optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+
+        loss_metric.update_state(loss)
+        for metric in metrics:
+            metric.update_state(y, y_pred)
+
+        used_minibatch.assign_add(1)
+        used_sample.assign_add(tf.cast(tf.shape(x)[0], tf.int64))
+        offset.assign(tf.reduce_max(next_offset))
+
+    @tf.function
+    def train_function(iterator, step_count):
+        executed_count = tf.constant(0, dtype=tf.int64)
+
+        for _ in tf.range(step_count):
+            optional = iterator.get_next_as_optional()
+            if not optional.has_value():
+                break
+
+            x, y, next_offset = optional.get_value()
+            train_step(x, y, next_offset)
+            executed_count += 1
+
+        return executed_count
+
+    return train_function
+
+
+def run_train_function(train_function, iterator, minibatch_count, steps_per_execution, boundary_frequencies):
+    """
+    Run train_function until iterator is exhausted and yield minibatch count after each call which executed steps.
+    Each call runs up to steps_per_execution steps, but stops at multiples of boundary_frequencies
+    (logging and checkpoint), so the caller sees the same boundaries as with one step per call.
+    """
+    while True:
+        step_count = min([steps_per_execution] + [
+            frequency - minibatch_count % frequency for frequency in boundary_frequencies])
+
+        executed_count = int(train_function(iterator, tf.constant(step_count, dtype=tf.int64)))
+        minibatch_count += executed_count
+
+        if executed_count > 0:
+            yield minibatch_count
+
+        if executed_count < step_count:
+            return
+
+
+def get_scaled_loss(optimizer, loss):
+    """
+    Scale loss for LossScaleOptimizer of mixed precision training. Otherwise loss is returned as is.
+    """
+    if hasattr(optimizer, 'get_scaled_loss'):
+        return optimizer.get_scaled_loss(loss)
+    elif hasattr(optimizer, 'scale_loss'):
+        # Keras 3 optimizers unscale gradients in apply_gradients
+        return optimizer.scale_loss(loss)
+    else:
+        return loss
+
+
+def get_unscaled_gradients(optimizer, gradients):
+    if hasattr(optimizer, 'get_unscaled_gradients'):
+        return optimizer.get_unscaled_gradients(gradients)
+    else:
+        return gradients
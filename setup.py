@@ -19,8 +19,10 @@ install_requires = [
     'requests>=2.22.0',
     'six>=1.13.0',
     'psycopg2>=2.8.4',
+    'tornado>=6.0.4',
+    'aiohttp>=3.6.2',
 ]
-tensorflow_pkg = 'tensorflow>=2.1.0'
+tensorflow_pkg = 'tensorflow>=2.5.0'
 
 setuptools.setup(
     name="deepdanbooru",
@@ -77,3 +77,977 @@ def test_load_image_for_evaluate(tmp_path, use_bytes_io):
         res = load_image_for_evaluate(image_input, 299, 299)
     assert isinstance(res, numpy.ndarray)
     assert res.shape == (299, 299, 3)
+
+
+def test_batch_predictor_batches_concurrent_requests():
+    import asyncio
+    from deepdanbooru.server import BatchPredictor
+
+    class FakeModel:
+        def __init__(self):
+            self.batch_sizes = []
+
+        def predict_on_batch(self, x):
+            self.batch_sizes.append(x.shape[0])
+            return x.reshape((x.shape[0], -1)).sum(axis=1, keepdims=True)
+
+    model = FakeModel()
+    batch_predictor = BatchPredictor(model, max_batch_size=4, max_wait_ms=50.0)
+
+    async def run():
+        images = [numpy.full((2, 2, 3), i, dtype=numpy.float32) for i in range(6)]
+        return await asyncio.gather(*[batch_predictor.predict(image) for image in images])
+
+    results = asyncio.run(run())
+    batch_predictor.stop()
+
+    assert [float(y[0]) for y in results] == [i * 12.0 for i in range(6)]
+    assert model.batch_sizes == [4, 2]
+
+
+def test_load_image_batches_for_evaluate_keeps_order(tmp_path):
+    from deepdanbooru.data import load_image_batches_for_evaluate
+
+    image_paths = []
+    for i in range(5):
+        image_path = tmp_path / f'{i}.png'
+        Image.new('RGB', (40 + i * 10, 30), color=(i * 50, 0, 0)).save(image_path)
+        image_paths.append(image_path.as_posix())
+
+    batches = list(load_image_batches_for_evaluate(image_paths, 16, 16, batch_size=2, worker_count=3))
+
+    assert [len(batch_paths) for batch_paths, _ in batches] == [2, 2, 1]
+    assert [path for batch_paths, _ in batches for path in batch_paths] == image_paths
+    images = numpy.concatenate([batch_images for _, batch_images in batches])
+    assert images.shape == (5, 16, 16, 3)
+    numpy.testing.assert_allclose(images[:, 8, 8, 0], [i * 50 / 255.0 for i in range(5)], atol=1e-3)
+
+
+def test_select_tags():
+    from deepdanbooru.commands.evaluate import select_tags, decode_tags
+
+    y = numpy.array([
+        [0.9, 0.1, 0.6, 0.7],
+        [0.2, 0.3, 0.1, 0.0],
+        [0.5, 0.8, 0.95, 0.55],
+    ], dtype=numpy.float32)
+
+    results = select_tags(y, 0.5)
+    assert [list(indices) for indices, _ in results] == [[0, 2, 3], [], [0, 1, 2, 3]]
+    numpy.testing.assert_allclose(results[0][1], [0.9, 0.6, 0.7])
+
+    results = select_tags(y, 0.5, top_k=2)
+    assert [list(indices) for indices, _ in results] == [[0, 3], [], [1, 2]]
+
+    assert decode_tags(*results[2], ['a', 'b', 'c', 'd']) == [('b', y[2, 1]), ('c', y[2, 2])]
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    from deepdanbooru.data import ResultCache
+
+    cache_path = (tmp_path / 'cache.sqlite').as_posix()
+    cache = ResultCache(cache_path, 'model-a', max_entries=2)
+    keys = [cache.get_key(f'image-{i}'.encode()) for i in range(3)]
+
+    cache.put(keys[0], [0.0, 1.0])
+    cache.put(keys[1], [1.0, 0.0])
+    assert cache.get(keys[0]) is not None
+    cache.put(keys[2], [0.5, 0.5])
+    cache.close()
+
+    cache = ResultCache(cache_path, 'model-a', max_entries=2)
+    assert cache.get(keys[1]) is None
+    numpy.testing.assert_allclose(cache.get(keys[0]), [0.0, 1.0])
+    numpy.testing.assert_allclose(cache.get(keys[2]), [0.5, 0.5])
+    assert ResultCache(cache_path, 'model-b').get_key(b'image-0') != keys[0]
+
+    # another connection to the same file must not push the cache past max_entries
+    other_cache = ResultCache(cache_path, 'model-a', max_entries=2)
+    other_cache.put(other_cache.get_key(b'image-3'), [0.1, 0.9])
+    cache.put(cache.get_key(b'image-4'), [0.9, 0.1])
+    assert cache.connection.execute('SELECT count(*) FROM results').fetchone()[0] == 2
+
+
+def test_model_fingerprint_includes_precision(tmp_path):
+    from deepdanbooru.data import create_model_fingerprint
+
+    model_path = tmp_path / 'model.h5'
+    model_path.write_bytes(b'model')
+
+    fingerprint = create_model_fingerprint(model_path.as_posix(), ['a', 'b'])
+    assert create_model_fingerprint(model_path.as_posix(), ['a', 'b'], 'float32') != fingerprint
+    assert create_model_fingerprint(model_path.as_posix(), ['a', 'b'], 'mixed_float16') != \
+        create_model_fingerprint(model_path.as_posix(), ['a', 'b'], 'float32')
+
+
+def test_training_shards_roundtrip(tmp_path):
+    from deepdanbooru.data import ShardDatasetWrapper, write_training_shards
+
+    image_records = []
+    for i in range(3):
+        image_path = tmp_path / f'{i}.png'
+        Image.new('RGB', (20, 10 + i), color=(i * 100, 0, 0)).save(image_path)
+        image_records.append((image_path.as_posix(), ['a,c', 'b', 'x,a'][i], None))
+
+    tags = ['a', 'b', 'c']
+    shards_path = (tmp_path / 'shards').as_posix()
+    metadata = write_training_shards(image_records, tags, shards_path, 8, 8, None, shard_size=2)
+
+    assert metadata['record_count'] == 3
+    assert len(metadata['shard_file_names']) == 2
+
+    dataset_wrapper = ShardDatasetWrapper(shards_path, tags, 8, 8, None, None, None)
+    images, labels = next(iter(dataset_wrapper.get_dataset(3)))
+
+    assert images.shape == (3, 8, 8, 3)
+    assert sorted(map(tuple, labels.numpy().tolist())) == [(0, 1, 0), (1, 0, 0), (1, 0, 1)]
+
+
+@pytest.mark.parametrize('scale,rotation,shift', [
+    (None, None, None),
+    (0.9, None, None),
+    (None, 45.0, None),
+    (None, None, (0.1, -0.05)),
+    (0.95, 200.0, (-0.1, 0.1)),
+])
+def test_transform_and_pad_image_tf_parity(scale, rotation, shift):
+    from deepdanbooru.image import transform_and_pad_image, transform_and_pad_image_tf
+
+    image = numpy.random.RandomState(0).uniform(0.0, 255.0, (37, 45, 3)).astype(numpy.float32)
+
+    expected = transform_and_pad_image(image, 32, 30, scale=scale, rotation=rotation, shift=shift)
+    actual = transform_and_pad_image_tf(image, 32, 30, scale=scale, rotation=rotation, shift=shift).numpy()
+
+    assert actual.shape == expected.shape
+    numpy.testing.assert_allclose(actual, expected, atol=0.01)
+
+
+def test_tag_encoder():
+    from deepdanbooru.data import TagEncoder
+
+    tag_encoder = TagEncoder(['a', 'b', 'c', 'd'])
+
+    assert tag_encoder.encode('d,x,b,d').tolist() == [1, 3]
+    assert tag_encoder.encode_labels('c,a').tolist() == [1.0, 0.0, 1.0, 0.0]
+    assert tag_encoder.map_labels('d,x,b,d').numpy().tolist() == [0.0, 1.0, 0.0, 1.0]
+    assert tag_encoder.map_labels_from_indices([0, 2]).numpy().tolist() == [1.0, 0.0, 1.0, 0.0]
+
+
+@pytest.mark.parametrize('pre_encode_tags', [True, False])
+def test_dataset_wrapper_labels(tmp_path, pre_encode_tags):
+    from deepdanbooru.data import DatasetWrapper, TagEncoder
+
+    tags = ['a', 'b', 'c']
+    image_paths = []
+    for i in range(2):
+        image_path = tmp_path / f'{i}.png'
+        Image.new('RGB', (20, 10), color='red').save(image_path)
+        image_paths.append(image_path.as_posix())
+
+    tag_strings = ['a,c', 'x,b']
+    if pre_encode_tags:
+        tag_strings = [TagEncoder(tags).encode(tag_string) for tag_string in tag_strings]
+
+    dataset_wrapper = DatasetWrapper((image_paths, tag_strings), tags, 8, 8, [0.9, 1.1], [0.0, 360.0], [-0.1, 0.1])
+    images, labels = next(iter(dataset_wrapper.get_dataset(2)))
+
+    assert images.shape == (2, 8, 8, 3)
+    assert labels.numpy().tolist() == [[1.0, 0.0, 1.0], [0.0, 1.0, 0.0]]
+
+
+def test_dataset_wrapper_resumes_from_offset(tmp_path):
+    from deepdanbooru.data import DatasetWrapper
+
+    image_paths = []
+    for i in range(3):
+        image_path = tmp_path / f'{i}.png'
+        Image.new('RGB', (10, 10), color='red').save(image_path)
+        image_paths.append(image_path.as_posix())
+
+    dataset_wrapper = DatasetWrapper((image_paths, ['a', 'b', 'a,b']), ['a', 'b'], 8, 8, None, None, None)
+    batches = list(dataset_wrapper.get_dataset(4, offset=1, with_offset=True))
+
+    assert len(batches) == 1
+    _, labels, next_offsets = batches[0]
+    assert labels.numpy().tolist() == [[0.0, 1.0], [1.0, 1.0]]
+    assert next_offsets.numpy().tolist() == [2, 3]
+
+
+def test_download_all_retries_rate_limited_images(tmp_path):
+    import asyncio
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    import hashlib
+    import sqlite3
+    from deepdanbooru.commands.download_images import DownloadManifest, RateLimiter, download_all, parse_retry_after
+
+    request_counts = {}
+
+    async def handle(request):
+        name = request.match_info['name']
+        request_counts[name] = request_counts.get(name, 0) + 1
+        if name == 'missing':
+            return web.Response(status=404)
+        if name == 'limited' and request_counts[name] == 1:
+            return web.Response(status=429, headers={'Retry-After': '0.2'})
+        return web.Response(body=name.encode() * 100000)
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/{name}', handle)
+        server = TestServer(app, host='127.0.0.1')
+        await server.start_server()
+
+        images = [(post_id, str(server.make_url(f'/{name}')), (tmp_path / 'images' / name).as_posix())
+                  for post_id, name in enumerate(['a', 'limited', 'missing'])]
+        counts = {'processed': 0, 'succeeded': 0}
+        rate_limiter = RateLimiter(100.0)
+        started = asyncio.get_event_loop().time()
+        try:
+            await download_all(iter(images), tmp_path.as_posix(), False, 2, rate_limiter, 10.0, 2, counts, manifest)
+        finally:
+            await server.close()
+        elapsed = asyncio.get_event_loop().time() - started
+
+        return counts, rate_limiter, elapsed
+
+    connection = sqlite3.connect((tmp_path / 'test.sqlite').as_posix())
+    connection.execute('CREATE TABLE posts (id INTEGER PRIMARY KEY, foldername TEXT, filename TEXT, extension TEXT, download_url TEXT)')
+    connection.executemany('INSERT INTO posts VALUES (?, ?, ?, ?, ?)', [
+        (post_id, 'images', name, 'png', None) for post_id, name in enumerate(['a', 'limited', 'missing'])])
+    manifest = DownloadManifest(connection)
+
+    counts, rate_limiter, elapsed = asyncio.run(run())
+    manifest.flush()
+
+    assert counts == {'processed': 3, 'succeeded': 2}
+    assert request_counts['limited'] == 2
+    assert elapsed >= 0.2
+    assert rate_limiter.rate < 100.0
+    assert (tmp_path / 'images' / 'limited').read_bytes() == b'limited' * 100000
+    assert not (tmp_path / 'images' / 'missing').exists()
+    assert not list((tmp_path / 'images').glob('*.part'))
+
+    assert manifest.get_status_counts() == {'complete': 2, 'failed': 1}
+    assert connection.execute('SELECT size, sha256 FROM downloads WHERE post_id = 1').fetchone() == (
+        700000, hashlib.sha256(b'limited' * 100000).hexdigest())
+    assert connection.execute('SELECT http_status FROM downloads WHERE post_id = 2').fetchone() == (404,)
+    assert [row[0] for row in manifest.get_pending_posts(False)] == [2]
+    assert parse_retry_after('3') == 3.0
+    assert parse_retry_after('invalid') is None
+
+
+def test_convert_model_precision():
+    import tensorflow as tf
+    from deepdanbooru.model import convert_model_precision
+
+    inputs = tf.keras.Input(shape=(8, 8, 3))
+    x = tf.keras.layers.Conv2D(4, (3, 3), padding='same')(inputs)
+    x = tf.keras.layers.BatchNormalization()(x)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    x = tf.keras.layers.Dense(5)(x)
+    outputs = tf.keras.layers.Activation('sigmoid', dtype='float32')(x)
+    model = tf.keras.Model(inputs=inputs, outputs=outputs)
+
+    image = numpy.random.RandomState(0).uniform(size=(2, 8, 8, 3)).astype(numpy.float32)
+    converted_model = convert_model_precision(model, 'mixed_float16')
+    y = converted_model.predict_on_batch(image)
+
+    assert y.dtype == numpy.float32
+    numpy.testing.assert_allclose(y, model.predict_on_batch(image), atol=1e-2)
+
+
+def test_quantized_tflite_model(tmp_path):
+    import tensorflow as tf
+    from deepdanbooru.model import TFLiteModel, quantize_model
+
+    inputs = tf.keras.Input(shape=(8, 8, 3))
+    x = tf.keras.layers.Conv2D(4, (3, 3), padding='same', activation='relu')(inputs)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    x = tf.keras.layers.Dense(5)(x)
+    outputs = tf.keras.layers.Activation('sigmoid')(x)
+    model = tf.keras.Model(inputs=inputs, outputs=outputs)
+
+    images = numpy.random.RandomState(0).uniform(size=(6, 8, 8, 3)).astype(numpy.float32)
+    model_path = tmp_path / 'model.tflite'
+    model_path.write_bytes(quantize_model(model, images))
+
+    tflite_model = TFLiteModel(str(model_path))
+    assert tflite_model.input_shape == (None, 8, 8, 3)
+    assert tflite_model.output_shape == (None, 5)
+
+    y = model.predict_on_batch(images)
+    numpy.testing.assert_allclose(tflite_model.predict_on_batch(images[:2]), y[:2], atol=0.05)
+    numpy.testing.assert_allclose(tflite_model.predict(images, batch_size=4), y, atol=0.05)
+
+    from deepdanbooru.commands.evaluate import load_model
+
+    tags_path = tmp_path / 'tags.txt'
+    tags_path.write_text('a\nb\nc\nd\ne\n')
+    with pytest.raises(Exception, match='Precision can not be set'):
+        load_model(None, str(model_path), str(tags_path), False, False, 'mixed_float16')
+
+
+def test_optimize_for_inference():
+    import tensorflow as tf
+    import deepdanbooru as dd
+
+    inputs = tf.keras.Input(shape=(8, 8, 3))
+    x = dd.model.layers.conv_bn_relu(inputs, 4, (3, 3))
+    x = tf.keras.layers.Dropout(0.5)(x)
+    c = dd.model.layers.conv_bn(x, 4, (3, 3))
+    x = tf.keras.layers.Add()([c, x])
+    x = tf.keras.layers.Activation('linear')(x)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    outputs = tf.keras.layers.Dense(5)(x)
+    model = tf.keras.Model(inputs=inputs, outputs=outputs)
+
+    random_state = numpy.random.RandomState(0)
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.layers.BatchNormalization):
+            layer.set_weights([random_state.uniform(0.5, 1.5, size=weight.shape) for weight in layer.get_weights()])
+
+    optimized_model = dd.model.optimize_for_inference(model)
+    layer_types = [type(layer) for layer in optimized_model.layers]
+
+    assert tf.keras.layers.BatchNormalization not in layer_types
+    assert tf.keras.layers.Dropout not in layer_types
+    assert len(optimized_model.layers) == len(model.layers) - 4
+
+    image = random_state.uniform(size=(2, 8, 8, 3)).astype(numpy.float32)
+    numpy.testing.assert_allclose(
+        optimized_model.predict_on_batch(image), model.predict_on_batch(image), rtol=1e-4, atol=1e-5)
+
+
+def test_create_project_does_not_import_tensorflow(tmp_path):
+    import subprocess
+    import sys
+
+    code = (
+        'import sys\n'
+        'from click.testing import CliRunner\n'
+        'from deepdanbooru.__main__ import main\n'
+        f'result = CliRunner().invoke(main, ["create-project", {str(tmp_path / "project")!r}])\n'
+        'assert result.exit_code == 0, result.output\n'
+        'assert "tensorflow" not in sys.modules\n'
+    )
+
+    subprocess.run([sys.executable, '-c', code], check=True)
+
+
+def test_model_registry_swaps_after_in_flight_requests():
+    import asyncio
+    from deepdanbooru.server import ModelRegistry, ServedModel
+
+    def loader(name, model_config, version):
+        return ServedModel(name, version, object(), ['a'], None, mock.Mock())
+
+    registry = ModelRegistry({'default': {}}, loader)
+    registry.load_all()
+
+    old_served_model = registry.get().acquire()
+    batch_predictor = old_served_model.batch_predictor
+
+    assert asyncio.run(registry.reload('default'))
+    assert registry.get('default').version == 2
+    batch_predictor.stop.assert_not_called()
+
+    old_served_model.release()
+    batch_predictor.stop.assert_called_once()
+    assert old_served_model.model is None
+
+
+def test_serve_post_evaluates_many_images(tmp_path):
+    import asyncio
+    import json
+    from concurrent.futures import ThreadPoolExecutor
+
+    import tornado.httpclient
+    import tornado.httpserver
+    import tornado.testing
+
+    from deepdanbooru.commands.serve import make_app
+    from deepdanbooru.server import BatchPredictor, ModelRegistry, ServedModel
+
+    model = mock.Mock(input_shape=(None, 4, 4, 3))
+    model.predict_on_batch.side_effect = lambda x: numpy.tile([[0.9, 0.1]], (len(x), 1))
+
+    def loader(name, model_config, version):
+        return ServedModel(name, version, model, ['a', 'b'], None, BatchPredictor(model, max_batch_size=4))
+
+    registry = ModelRegistry({'default': {}}, loader)
+    registry.load_all()
+
+    image_path = tmp_path / 'image.png'
+    Image.new('RGB', (8, 8)).save(image_path)
+
+    async def post_all():
+        socket, port = tornado.testing.bind_unused_port()
+        server = tornado.httpserver.HTTPServer(make_app(registry, None, ThreadPoolExecutor(), 0.5))
+        server.add_sockets([socket])
+        client = tornado.httpclient.AsyncHTTPClient()
+        requests = [
+            (json.dumps({'files': [str(image_path), str(image_path), str(tmp_path / 'none.png')]}), 'application/json'),
+            (image_path.read_bytes(), 'image/png'),
+        ]
+        try:
+            return [json.loads((await client.fetch(
+                f'http://127.0.0.1:{port}/evaluate', method='POST', body=body, headers={'Content-Type': content_type})).body)
+                for body, content_type in requests]
+        finally:
+            server.stop()
+
+    response, raw_response = asyncio.run(post_all())
+
+    assert [result['name'] for result in response['results']] == [str(image_path), str(image_path), str(tmp_path / 'none.png')]
+    assert response['results'][0]['matching_tags'] == [{'tag': 'a', 'confidence': 0.9}]
+    assert 'error' in response['results'][2]
+    assert raw_response['results'][0]['matching_tags'][0]['tag'] == 'a'
+    assert model.predict_on_batch.call_count == 2
+
+
+def test_metrics_render_and_stage_hooks(tmp_path):
+    import deepdanbooru as dd
+    from deepdanbooru.metrics import MetricsRegistry
+
+    registry = MetricsRegistry()
+    counter = registry.counter('test_total', 'Test counter.', ['result'])
+    histogram = registry.histogram('test_seconds', 'Test histogram.', buckets=[0.1, 1.0])
+    counter.inc(result='hit')
+    histogram.observe(0.1)
+    histogram.observe(0.5)
+    histogram.observe(2.0)
+
+    assert registry.render().splitlines() == [
+        '# HELP test_total Test counter.',
+        '# TYPE test_total counter',
+        'test_total{result="hit"} 1.0',
+        '# HELP test_seconds Test histogram.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1.0"} 2',
+        'test_seconds_bucket{le="+Inf"} 3',
+        'test_seconds_sum 2.6',
+        'test_seconds_count 3',
+    ]
+
+    image_path = tmp_path / 'image.png'
+    Image.new('RGB', (8, 8)).save(image_path)
+    decode_count, _ = dd.metrics.STAGE_SECONDS.get_count_and_sum(stage='decode')
+    dd.data.load_image_for_evaluate(str(image_path), 4, 4)
+
+    assert dd.metrics.STAGE_SECONDS.get_count_and_sum(stage='decode')[0] == decode_count + 1
+    assert dd.metrics.STAGE_SECONDS.get_count_and_sum(stage='resize')[0] >= 1
+
+
+def test_commands_are_not_shadowed_by_submodules():
+    import sys
+    import deepdanbooru as dd
+    import deepdanbooru.commands.evaluate
+    import deepdanbooru.commands.serve  # noqa: F401
+
+    assert dd.commands.evaluate is sys.modules['deepdanbooru.commands.evaluate'].evaluate
+    assert callable(dd.commands.serve_model)
+    assert 'evaluate_image' in dir(dd.commands)
+
+
+def test_serve_post_models_reloads_only_configured_models():
+    import asyncio
+    import json
+    from concurrent.futures import ThreadPoolExecutor
+
+    import tornado.httpclient
+    import tornado.httpserver
+    import tornado.testing
+
+    from deepdanbooru.commands.serve import make_app
+    from deepdanbooru.server import ModelRegistry, ServedModel
+
+    model_configs = {'default': {'model_path': 'model.h5'}}
+
+    def loader(name, model_config, version):
+        return ServedModel(name, version, object(), ['a'], None, mock.Mock())
+
+    registry = ModelRegistry(model_configs, loader)
+    registry.load_all()
+
+    async def post_all(load_model_configs, requests, worker_count=1):
+        socket, port = tornado.testing.bind_unused_port()
+        server = tornado.httpserver.HTTPServer(make_app(
+            registry, None, ThreadPoolExecutor(), 0.5, load_model_configs=load_model_configs, worker_count=worker_count))
+        server.add_sockets([socket])
+        client = tornado.httpclient.AsyncHTTPClient()
+        try:
+            responses = [await client.fetch(
+                f'http://127.0.0.1:{port}/models/{name}', method='POST', body=body, raise_error=False)
+                for name, body in requests]
+            await asyncio.sleep(0.1)
+            return [response.code for response in responses]
+        finally:
+            server.stop()
+
+    assert asyncio.run(post_all(None, [('default', '')])) == [403]
+    assert asyncio.run(post_all(lambda: model_configs, [
+        ('default', json.dumps({'model_path': '/etc/passwd'})),
+        ('other', ''),
+        ('default', ''),
+    ])) == [400, 404, 202]
+    assert registry.get('default').version == 2
+    assert registry.model_configs == model_configs
+
+    # other workers would not see the reload
+    assert asyncio.run(post_all(lambda: model_configs, [('default', '')], worker_count=2)) == [409]
+    assert registry.get('default').version == 2
+
+
+def test_result_cache_skips_locked_file(tmp_path):
+    import sqlite3
+    from deepdanbooru.data import ResultCache
+
+    cache_path = (tmp_path / 'cache.sqlite').as_posix()
+    cache = ResultCache(cache_path, 'model-a', lock_timeout=0.01)
+    key = cache.get_key(b'image-0')
+    cache.put(key, [0.0, 1.0])
+
+    other_connection = sqlite3.connect(cache_path)
+    other_connection.execute('BEGIN EXCLUSIVE')
+
+    # writes are skipped, reads still work in WAL mode
+    cache.put(cache.get_key(b'image-1'), [1.0, 0.0])
+    numpy.testing.assert_allclose(cache.get(key), [0.0, 1.0])
+
+    other_connection.rollback()
+    assert not cache.contains(cache.get_key(b'image-1'))
+
+
+def test_admission_control_and_deadline():
+    import asyncio
+    from deepdanbooru.server import AdmissionController, BatchPredictor, DeadlineExceededError
+
+    admission_controller = AdmissionController(max_pending_count=3)
+    assert admission_controller.try_admit(2)
+    assert not admission_controller.try_admit(2)
+    admission_controller.release(2)
+    assert admission_controller.try_admit(3)
+
+    model = mock.Mock()
+    model.predict_on_batch.side_effect = lambda x: x.reshape((x.shape[0], -1))
+    batch_predictor = BatchPredictor(model, max_batch_size=4, max_wait_ms=20.0)
+
+    async def run():
+        now = asyncio.get_event_loop().time()
+        image = numpy.zeros((2, 2, 3), dtype=numpy.float32)
+        return await asyncio.gather(
+            batch_predictor.predict(image, now + 10.0), batch_predictor.predict(image, now),
+            return_exceptions=True)
+
+    results = asyncio.run(run())
+    batch_predictor.stop()
+
+    assert results[0].shape == (12,)
+    assert isinstance(results[1], DeadlineExceededError)
+    # expired image never reaches the model
+    assert model.predict_on_batch.call_args[0][0].shape[0] == 1
+
+
+def test_serve_rejects_invalid_query_arguments_before_admission(tmp_path):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    import tornado.httpclient
+    import tornado.httpserver
+    import tornado.testing
+
+    from deepdanbooru.commands.serve import make_app
+    from deepdanbooru.server import AdmissionController, ModelRegistry, ServedModel
+
+    def loader(name, model_config, version):
+        return ServedModel(name, version, object(), ['a'], None, mock.Mock())
+
+    registry = ModelRegistry({'default': {}}, loader)
+    registry.load_all()
+    admission_controller = AdmissionController(max_pending_count=1)
+
+    async def fetch_all(paths):
+        socket, port = tornado.testing.bind_unused_port()
+        server = tornado.httpserver.HTTPServer(
+            make_app(registry, None, ThreadPoolExecutor(), 0.5, admission_controller))
+        server.add_sockets([socket])
+        client = tornado.httpclient.AsyncHTTPClient()
+        try:
+            return [(await client.fetch(f'http://127.0.0.1:{port}{path}', raise_error=False)).code for path in paths]
+        finally:
+            server.stop()
+
+    image_path = tmp_path / 'image.png'
+    assert asyncio.run(fetch_all([
+        f'/evaluate?file={image_path}&threshold=high',
+        f'/evaluate?file={image_path}&top_k=0',
+    ])) == [400, 400]
+    assert admission_controller.pending_count == 0
+
+
+@pytest.mark.parametrize('pre_encode_tags', [True, False])
+def test_load_image_records(tmp_path, pre_encode_tags):
+    import sqlite3
+    from deepdanbooru.data import DatasetWrapper, TagEncoder, load_image_records
+
+    database_path = (tmp_path / 'test.sqlite').as_posix()
+    connection = sqlite3.connect(database_path)
+    connection.execute(
+        'CREATE TABLE posts (id INTEGER PRIMARY KEY, foldername TEXT, filename TEXT, extension TEXT, '
+        'download_url TEXT, tag_string TEXT, tag_count_general INTEGER)')
+    connection.executemany('INSERT INTO posts VALUES (?, ?, ?, ?, ?, ?, ?)', [
+        (3, 'b', 'z', 'png', None, 'x,b', 2),
+        (1, 'a', 'y', 'jpg', 'https://example.com/y.jpg', 'a,c', 2),
+        (2, 'a', 'w', 'gif', None, 'a', 2),
+        (4, 'b', 'v', 'png', None, 'c,a', 2),
+    ])
+    connection.commit()
+    connection.close()
+
+    tags = ['a', 'b', 'c']
+    image_records = load_image_records(
+        database_path, 1, tag_encoder=TagEncoder(tags) if pre_encode_tags else None, fetch_size=1)
+
+    assert len(image_records) == 3
+    image_path, tag_inputs, download_url = image_records[0]
+    assert image_path == (tmp_path / 'images' / 'a' / 'y.jpg').as_posix()
+    assert download_url == 'https://example.com/y.jpg'
+    assert image_records[-1][2] is None
+    if pre_encode_tags:
+        assert [record[1].tolist() for record in image_records] == [[0, 2], [1], [0, 2]]
+    else:
+        assert [record[1] for record in image_records] == ['a,c', 'x,b', 'c,a']
+
+    indices = image_records.get_permutation(7)
+    assert sorted(indices.tolist()) == [0, 1, 2]
+    assert image_records.get_permutation(7).tolist() == indices.tolist()
+
+    dataset_wrapper = DatasetWrapper(image_records, tags, 8, 8, None, None, None)
+    _, tag_indices = dataset_wrapper.get_input_tensors()
+    assert tag_indices.to_list() == ([[0, 2], [1], [0, 2]] if pre_encode_tags else [[0, 2], [1], [2, 0]])
+
+
+def test_make_training_database_resumes(tmp_path):
+    import sqlite3
+    from deepdanbooru.commands import make_training_database
+    from deepdanbooru.data import TagEncoder, load_image_records, load_tag_counts
+
+    source_path = (tmp_path / 'source.sqlite').as_posix()
+    output_path = (tmp_path / 'output.sqlite').as_posix()
+
+    connection = sqlite3.connect(source_path)
+    connection.execute(
+        'CREATE TABLE posts (id INTEGER PRIMARY KEY, md5 TEXT, extension TEXT, tag_string TEXT, rating TEXT, '
+        'tag_count_general INTEGER, score INTEGER, is_deleted INTEGER)')
+    connection.executemany('INSERT INTO posts VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
+        (i, f'{i:032x}', 'png', 'a b', 's', 2, 0, int(i % 10 == 0)) for i in range(1, 101)])
+    connection.commit()
+    connection.close()
+
+    make_training_database('danbooru', source_path, output_path, 0, 1000, False, 7, 2, False, False, False)
+
+    def get_ids():
+        connection = sqlite3.connect(output_path)
+        ids = [row[0] for row in connection.execute('SELECT id FROM posts ORDER BY id')]
+        connection.close()
+        return ids
+
+    expected_ids = [i for i in range(1, 101) if i % 10 != 0]
+    assert get_ids() == expected_ids
+
+    # interrupted build: rows after the last committed id of each partition are missing
+    connection = sqlite3.connect(output_path)
+    connection.execute('DELETE FROM posts WHERE id > 45')
+    connection.execute('UPDATE build_progress SET last_id = min(last_id, max(start_id - 1, 45))')
+    connection.commit()
+    connection.close()
+
+    with pytest.raises(Exception):
+        make_training_database('danbooru', source_path, output_path, 0, 1000, False, 7, 1, False, False, False)
+    with pytest.raises(Exception, match='end_id=1000'):
+        make_training_database('danbooru', source_path, output_path, 0, 50, False, 7, 1, False, True, False)
+
+    make_training_database('danbooru', source_path, output_path, 0, 1000, False, 7, 1, False, True, False)
+    assert get_ids() == expected_ids
+
+    assert load_tag_counts(output_path) == [('a', 90), ('b', 90), ('rating:safe', 90)]
+
+    # built without progress, like by older versions
+    connection = sqlite3.connect(output_path)
+    connection.execute('DELETE FROM build_progress')
+    connection.commit()
+    connection.close()
+
+    with pytest.raises(Exception, match='not resumable'):
+        make_training_database('danbooru', source_path, output_path, 0, 1000, False, 7, 1, False, True, False)
+    assert get_ids() == expected_ids
+
+    image_records = load_image_records(output_path, 1, tag_encoder=TagEncoder(['rating:safe', 'x', 'a']))
+    assert len(image_records) == 90
+    assert image_records[0][1].tolist() == [0, 2]
+    assert load_image_records(output_path, 1)[0][1] == 'a,b,rating:safe'
+
+
+def test_resize_and_save_image(tmp_path):
+    import io
+    import os
+    from deepdanbooru.commands.download_images import resize_and_save_image
+
+    def encode(size, image_format, mode='RGB'):
+        stream = io.BytesIO()
+        Image.new(mode, size, color=1 if mode == 'P' else 'red').save(stream, format=image_format)
+        return stream.getvalue()
+
+    path = (tmp_path / 'large.jpg').as_posix()
+    size, _, width, height = resize_and_save_image(encode((400, 100), 'PNG', 'P'), path, 64)
+    assert (width, height) == (64, 16)
+    assert Image.open(path).format == 'JPEG'
+    assert size == os.path.getsize(path)
+
+    data = encode((30, 60), 'PNG')
+    path = (tmp_path / 'small.png').as_posix()
+    assert resize_and_save_image(data, path, 64)[2:] == (30, 60)
+    assert open(path, 'rb').read() == data
+
+    with pytest.raises(Exception):
+        resize_and_save_image(data[:50], (tmp_path / 'broken.png').as_posix(), 64)
+    assert not list(tmp_path.glob('broken.png*'))
+
+
+def test_evaluate_image_paths_raw_skips_cached_images(tmp_path):
+    from deepdanbooru.commands.evaluate import evaluate_image_paths_raw
+    from deepdanbooru.data import ResultCache
+
+    image_paths = []
+    for i in range(5):
+        image_path = tmp_path / f'{i}.png'
+        Image.new('RGB', (8, 8), color=(i * 50, 0, 0)).save(image_path)
+        image_paths.append(image_path.as_posix())
+
+    model = mock.Mock(input_shape=(None, 4, 4, 3))
+    model.predict_on_batch.side_effect = lambda x: x.mean(axis=(1, 2))
+    result_cache = ResultCache((tmp_path / 'cache.sqlite').as_posix(), 'model-a')
+
+    expected = list(evaluate_image_paths_raw(image_paths[1:4], model, 2, 2))
+    for (image_path, y), (expected_image_path, expected_y) in zip(
+            evaluate_image_paths_raw(image_paths[1:4], model, 2, 2, result_cache), expected):
+        assert image_path == expected_image_path
+        numpy.testing.assert_allclose(y, expected_y)
+    assert model.predict_on_batch.call_count == 4
+
+    results = list(evaluate_image_paths_raw(image_paths, model, 2, 2, result_cache))
+
+    assert [image_path for image_path, _ in results] == image_paths
+    for (_, y), (_, expected_y) in zip(results[1:4], expected):
+        numpy.testing.assert_allclose(y, expected_y)
+    # only images 0 and 4 are evaluated, in batches [0, 1] and [4]
+    assert [call[0][0].shape[0] for call in model.predict_on_batch.call_args_list[4:]] == [1, 1]
+
+
+def test_train_function_steps_per_execution_keeps_boundaries():
+    import tensorflow as tf
+    import deepdanbooru as dd
+
+    x = numpy.random.RandomState(0).uniform(size=(14, 4)).astype(numpy.float32)
+    y = (x[:, :3] > 0.5).astype(numpy.float32)
+    next_offsets = numpy.arange(1, 15, dtype=numpy.int64)
+    initial_model = tf.keras.Sequential([
+        tf.keras.Input(shape=(4,)), tf.keras.layers.Dense(3, activation='sigmoid', kernel_initializer='zeros')])
+
+    def train(steps_per_execution, loss_scale=False):
+        model = tf.keras.models.clone_model(initial_model)
+        model.set_weights(initial_model.get_weights())
+        optimizer = tf.keras.optimizers.SGD(0.5)
+        if loss_scale:
+            optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+        loss_metric = tf.keras.metrics.Mean()
+        used_minibatch = tf.Variable(0, dtype=tf.int64)
+        used_sample = tf.Variable(0, dtype=tf.int64)
+        offset = tf.Variable(0, dtype=tf.int64)
+        checkpoint_callback = dd.train.CheckpointCallback(mock.Mock(), 3)
+        train_function = dd.train.create_train_function(
+            model, optimizer, tf.keras.losses.BinaryCrossentropy(), loss_metric, [tf.keras.metrics.Precision()],
+            used_minibatch=used_minibatch, used_sample=used_sample, offset=offset)
+
+        iterator = iter(tf.data.Dataset.from_tensor_slices((x, y, next_offsets)).batch(2))
+        minibatch_counts = []
+        losses = []
+        for minibatch_count in dd.train.run_train_function(train_function, iterator, 0, steps_per_execution, [2, 3]):
+            minibatch_counts.append(minibatch_count)
+            if minibatch_count % 2 == 0:
+                losses.append(float(loss_metric.result()))
+                loss_metric.reset_state()
+            checkpoint_callback.on_minibatch_end(minibatch_count)
+
+        return {
+            'used_minibatch': int(used_minibatch), 'used_sample': int(used_sample), 'offset': int(offset),
+            'minibatch_counts': minibatch_counts, 'losses': losses,
+            'save_count': checkpoint_callback.manager.save.call_count, 'weights': model.get_weights(),
+        }
+
+    expected = train(1)
+    assert expected['used_minibatch'] == 7
+    assert expected['used_sample'] == 14
+    assert expected['offset'] == 14
+    assert expected['minibatch_counts'] == [1, 2, 3, 4, 5, 6, 7]
+    assert expected['save_count'] == 2
+    assert expected['losses'][-1] < expected['losses'][0]
+
+    for result in [train(4), train(4, loss_scale=True)]:
+        # steps stop at every logging and checkpoint boundary
+        assert result['minibatch_counts'] == [2, 3, 4, 6, 7]
+        for name in ['used_minibatch', 'used_sample', 'offset', 'save_count']:
+            assert result[name] == expected[name]
+        numpy.testing.assert_allclose(result['losses'], expected['losses'], rtol=1e-5)
+        for weights, expected_weights in zip(result['weights'], expected['weights']):
+            numpy.testing.assert_allclose(weights, expected_weights, rtol=1e-5, atol=1e-6)
+
+
+def test_export_model_reports_reused_calibration_images(tmp_path):
+    import json
+    import tensorflow as tf
+    from deepdanbooru.commands import export_model
+
+    inputs = tf.keras.Input(shape=(8, 8, 3))
+    x = tf.keras.layers.Conv2D(4, (3, 3), padding='same', activation='relu')(inputs)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    outputs = tf.keras.layers.Dense(2, activation='sigmoid')(x)
+    model_path = tmp_path / 'model.h5'
+    tf.keras.Model(inputs=inputs, outputs=outputs).save(model_path.as_posix())
+    tags_path = tmp_path / 'tags.txt'
+    tags_path.write_text('a\nb\n')
+
+    calibration_path = tmp_path / 'images'
+    calibration_path.mkdir()
+    for i in range(3):
+        Image.new('RGB', (8, 8), color=(i * 80, 0, 0)).save(calibration_path / f'{i}.png')
+
+    export_model(None, model_path.as_posix(), tags_path.as_posix(), None, calibration_path.as_posix(), 3, 2,
+                 0.5, 0, False, False)
+
+    report = json.loads((tmp_path / 'model.report.json').read_text())
+    assert report['reused_calibration_images']
+    assert report['image_count'] == 3
+
+
+def test_start_workers_requires_tflite_models_before_tensorflow(tmp_path):
+    import subprocess
+    import sys
+
+    code = (
+        'import sys\n'
+        'import deepdanbooru as dd\n'
+        'from unittest import mock\n'
+        'model_configs = dd.server.load_model_configs(None, "model.h5", "tags.txt", None, None)\n'
+        'with mock.patch("tornado.process.fork_processes") as fork_processes:\n'
+        '    try:\n'
+        '        dd.server.start_workers(0, model_configs, 2, 0, False)\n'
+        '    except Exception as e:\n'
+        '        assert "not .tflite model" in str(e), e\n'
+        '    else:\n'
+        '        raise AssertionError("h5 model is accepted")\n'
+        '    fork_processes.assert_not_called()\n'
+        '    sockets = dd.server.start_workers(0, {"default": {"model_path": "model.tflite"}}, 2, 0, False)\n'
+        '    fork_processes.assert_called_once_with(2, max_restarts=0)\n'
+        'assert sockets\n'
+        'assert "tensorflow" not in sys.modules\n'
+    )
+
+    subprocess.run([sys.executable, '-c', code], check=True)
+
+
+def test_warm_up_and_image_key_metrics(tmp_path):
+    import deepdanbooru as dd
+    from deepdanbooru.commands.serve import get_blank_image, get_image_key
+
+    decode_count = dd.metrics.STAGE_SECONDS.get_count_and_sum(stage='decode')[0]
+    with dd.metrics.not_recorded():
+        dd.data.load_image_for_evaluate(get_blank_image(), 4, 4)
+    assert dd.metrics.STAGE_SECONDS.get_count_and_sum(stage='decode')[0] == decode_count
+
+    result_cache = dd.data.ResultCache((tmp_path / 'cache.sqlite').as_posix(), 'model-a')
+    error_count = dd.metrics.ERRORS.get(stage='read')
+    with pytest.raises(OSError):
+        get_image_key((tmp_path / 'none.png').as_posix(), result_cache)
+    assert dd.metrics.ERRORS.get(stage='read') == error_count + 1
+
+
+def test_download_all_downloads_broken_existing_images_again(tmp_path):
+    import asyncio
+    import io
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    from deepdanbooru.commands.download_images import RateLimiter, download_all
+
+    stream = io.BytesIO()
+    Image.new('RGB', (64, 48), color=(255, 0, 0)).save(stream, format='PNG')
+    image_bytes = stream.getvalue()
+    requested_names = []
+
+    async def handle(request):
+        requested_names.append(request.match_info['name'])
+        return web.Response(body=image_bytes)
+
+    (tmp_path / 'images').mkdir()
+    Image.new('RGB', (32, 16)).save(tmp_path / 'images' / 'valid.png')
+    (tmp_path / 'images' / 'truncated.png').write_bytes(image_bytes[:len(image_bytes) // 2])
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/{name}', handle)
+        server = TestServer(app, host='127.0.0.1')
+        await server.start_server()
+
+        images = [(post_id, str(server.make_url(f'/{name}')), (tmp_path / 'images' / f'{name}.png').as_posix())
+                  for post_id, name in enumerate(['valid', 'truncated'])]
+        counts = {'processed': 0, 'succeeded': 0}
+        manifest = mock.Mock()
+        try:
+            await download_all(iter(images), tmp_path.as_posix(), False, 2, RateLimiter(0), 10.0, 0, counts, manifest)
+        finally:
+            await server.close()
+
+        return counts, sorted(manifest.record.call_args_list, key=lambda call: call[0][0])
+
+    counts, records = asyncio.run(run())
+
+    assert counts == {'processed': 2, 'succeeded': 2}
+    assert requested_names == ['truncated']
+    assert (tmp_path / 'images' / 'truncated.png').read_bytes() == image_bytes
+    assert records[0][0][-2:] == (32, 16)
+
+
+def test_download_image_releases_connection_before_resizing(tmp_path):
+    import asyncio
+    import aiohttp
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    from deepdanbooru.commands.download_images import RateLimiter, download_image
+
+    async def handle(request):
+        return web.Response(body=b'image')
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/{name}', handle)
+        server = TestServer(app, host='127.0.0.1')
+        await server.start_server()
+
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=1)) as session:
+            async def save(data, path):
+                # blocks if the only connection is still held by download_image
+                async with session.get(server.make_url('/other')) as response:
+                    await asyncio.wait_for(response.read(), 5.0)
+                return (len(data), None, 1, 1)
+
+            resizer = mock.Mock(save=save)
+            try:
+                return await asyncio.wait_for(download_image(
+                    session, RateLimiter(0), str(server.make_url('/image')), (tmp_path / 'image.png').as_posix(),
+                    False, 0, resizer), 5.0)
+            finally:
+                await server.close()
+
+    assert asyncio.run(run()) == (5, None, 1, 1)